@@ -2,5 +2,9 @@
 name = "mdx_include"
 
 from .mdx_include import makeExtension
+from .batch import convert_batch
+from .batch import BatchResult
 
 assert makeExtension
+assert convert_batch
+assert BatchResult
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import sys
+from mdx_include.cli import main
+
+if __name__ == "__main__":
+    sys.exit(main())
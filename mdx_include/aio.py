@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+asyncio support for mdx_include (python 3.5+)
+===========================================
+
+Used by md.mdx_include_aconvert(text). Remote includes are downloaded
+concurrently in the executor of the event loop before the conversion, and
+concurrent renders waiting for the same URL share the same download. The
+conversion itself runs in the executor too, one at a time for a Markdown
+instance, with the downloaded content in place of downloading, thus the
+output is the same as md.convert(text). The prefetch scan uses the caches
+of the instance only while no conversion runs, and the downloads of a
+render are counted in the metrics of its own conversion.
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+import os
+import asyncio
+from urllib.parse import urlparse
+from .mdx_include import get_file_signature
+from .mdx_include import get_local_content_list
+from .metrics import IncludeMetrics
+
+
+def read_local(filename, encoding):
+    """Read a local file for the prefetch scan, returns (content, status, signature)"""
+    signature = get_file_signature(filename)
+    textl, stat = get_local_content_list(filename, encoding)
+    return textl, stat, signature
+
+# python 3.7+
+get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class LoopState(object):
+    """The asyncio objects of the renders of a Markdown instance in one event loop"""
+
+    def __init__(self, per_host):
+        self.lock = asyncio.Lock() # held by the conversions and the scan steps of the prefetch
+        self.semaphores = {} # key = host, value = asyncio.Semaphore
+        self.inflight = {} # key = (url, encoding), value = download future shared by concurrent renders
+        self.per_host = per_host
+
+    def get_semaphore(self, host):
+        semaphore = self.semaphores.get(host)
+        if semaphore is None:
+            semaphore = self.semaphores[host] = asyncio.Semaphore(max(1, self.per_host))
+        return semaphore
+
+
+def get_state(pre):
+    """Return the LoopState of pre for the running event loop"""
+    loop = get_running_loop()
+    state = pre.async_states.get(loop)
+    if state is None:
+        for other in list(pre.async_states):
+            if other.is_closed():
+                del pre.async_states[other]
+        state = pre.async_states[loop] = LoopState(pre.remote_prefetch_per_host)
+    return state
+
+async def download(pre, url, encoding, metrics):
+    """Download url in the executor, limited by remote_prefetch_per_host.
+    Not a download of the conversion in progress: no deadline and its own metrics."""
+    async with get_state(pre).get_semaphore(urlparse(url).netloc):
+        return await get_running_loop().run_in_executor(None, pre.mdx_include_fetch, url, encoding, pre.remote_timeout, metrics)
+
+async def get_remote(pre, url, encoding, metrics):
+    """Return (content, status) for url, sharing in-flight downloads between renders.
+    The download is counted in the metrics of the render starting it."""
+    key = (url, encoding)
+    inflight = get_state(pre).inflight
+    future = inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(download(pre, url, encoding, metrics))
+        inflight[key] = future
+        future.add_done_callback(lambda f: inflight.pop(key, None))
+    # a cancelled render must not cancel the download for the others
+    return await asyncio.shield(future)
+
+async def get_local(pre, filename, encoding, content, local):
+    """Return the content of a local file for the prefetch scan (content if it is cached), new reads are kept in local"""
+    if content is not None:
+        return content
+    if not os.path.isfile(filename):
+        # left to the conversion to report
+        return []
+    textl, stat, signature = await get_running_loop().run_in_executor(None, read_local, filename, encoding)
+    if stat:
+        local[filename] = (textl, signature)
+    return textl
+
+def scan(pre, level, seen, prefetched):
+    """Return the remote includes to download and the recursive includes of a level of the prefetch scan.
+    Uses the caches of pre, must run with the lock held."""
+    downloads = []
+    recursive_remote = []
+    recursive_local = []
+    for textl, parent in level:
+        for kind, filename, encoding, file_lines, recursive in pre.mdx_include_iter_includes(textl, parent):
+            key = (kind, filename, encoding, file_lines)
+            if kind == 'remote':
+                if (filename, encoding) not in prefetched and (filename, encoding) not in downloads \
+                        and pre.mdx_include_get_cached_remote(filename) is None \
+                        and not pre.mdx_include_is_failed('remote', filename, encoding):
+                    downloads.append((filename, encoding))
+                if recursive and key not in seen:
+                    seen.add(key)
+                    recursive_remote.append(key)
+            elif recursive and pre.content_cache_local and key not in seen:
+                # local files may include remote files too
+                seen.add(key)
+                recursive_local.append(key + (pre.mdx_include_content_cache_local.get(filename),))
+    return downloads, recursive_remote, recursive_local
+
+async def prefetch(pre, lines, prefetched, local, metrics):
+    """Download the remote includes found in lines concurrently, following recursive
+    includes one level at a time like IncludePreprocessor.mdx_include_prefetch_remote()"""
+    lock = get_state(pre).lock
+    seen = set()
+    level = [(lines, '')]
+    while level:
+        async with lock:
+            downloads, recursive_remote, recursive_local = scan(pre, level, seen, prefetched)
+        results = await asyncio.gather(*[get_remote(pre, url, encoding, metrics) for url, encoding in downloads])
+        prefetched.update(zip(downloads, results))
+        contents = await asyncio.gather(*[get_local(pre, filename, encoding, content, local)
+                                          for kind, filename, encoding, file_lines, content in recursive_local])
+        next_level = []
+        async with lock:
+            for (kind, filename, encoding, file_lines, content), textl in zip(recursive_local, contents):
+                next_level.append((pre.mdx_include_prefetch_slice(textl, file_lines), filename))
+            for kind, filename, encoding, file_lines in recursive_remote:
+                content = pre.mdx_include_get_cached_remote(filename)
+                if content is None:
+                    content = prefetched.get((filename, encoding), ([], False))[0]
+                next_level.append((pre.mdx_include_prefetch_slice(content, file_lines), filename))
+        level = next_level
+
+def convert(pre, text, prefetched, local, metrics):
+    """Convert text with the content read by the prefetch scan"""
+    if pre.content_cache_local:
+        cache = pre.mdx_include_content_cache_local
+        for filename, (textl, signature) in local.items():
+            if filename not in cache:
+                cache.store(filename, textl, signature)
+                pre.mdx_include_content_cache_local_heads.pop(filename, None)
+    pre.remote_prefetched = prefetched
+    try:
+        html = pre.md.convert(text)
+    finally:
+        pre.remote_prefetched = {}
+    if metrics is not None and pre.metrics is not None:
+        # the downloads of the prefetch scan of this render
+        for name in ('downloads', 'bytes_downloaded', 'download_time'):
+            pre.metrics.count(name, getattr(metrics, name))
+    return html
+
+async def aconvert(pre, text):
+    """Convert text like pre.md.convert(text) without blocking the event loop"""
+    prefetched = {} # key = (url, encoding), value = (content, status)
+    local = {} # key = file path, value = (content, signature)
+    metrics = IncludeMetrics() if pre.metrics_enabled else None
+    if pre.allow_remote:
+        await prefetch(pre, text.split('\n'), prefetched, local, metrics)
+    async with get_state(pre).lock:
+        return await get_running_loop().run_in_executor(None, convert, pre, text, prefetched, local, metrics)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+'''
+Batch conversion for mdx_include
+===========================================
+
+Converts many documents with a pool of worker processes. Documents sharing
+includes are scheduled in the same chunk so that a worker reuses its caches,
+and the workers are seeded with a snapshot of the includes read once by the
+parent process.
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import time
+import logging
+from codecs import open
+from . import version
+
+LOGGER_NAME = 'mdx_include-' + version.__version__
+log = logging.getLogger(LOGGER_NAME)
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# state of a worker process, set by init_worker()
+worker = {}
+
+
+class BatchResult(object):
+    """Result of the conversion of one document of a batch"""
+
+    def __init__(self, index, path, html, seconds, error=None, dependencies=()):
+        self.index = index
+        self.path = path
+        self.html = html
+        self.seconds = seconds
+        self.error = error
+        self.dependencies = list(dependencies)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "BatchResult(index=%r, path=%r, seconds=%.6f, error=%r)" % (self.index, self.path, self.seconds, self.error)
+
+
+def get_preprocessor(md):
+    """Return the IncludePreprocessor registered in a Markdown instance"""
+    if hasattr(md.preprocessors, 'get_index_for_name'):
+        return md.preprocessors[md.preprocessors.get_index_for_name('mdx_include')]
+    return md.preprocessors['mdx_include']
+
+def make_markdown(configs, extensions=(), extension_configs=None):
+    """Return a Markdown instance with IncludeExtension(configs) and the other extensions"""
+    import markdown
+    from .mdx_include import IncludeExtension
+    return markdown.Markdown(extensions=[IncludeExtension(dict(configs))] + list(extensions),
+                             extension_configs=extension_configs or {})
+
+def read_document(path, encoding):
+    with open(path, 'r', encoding=encoding) as f:
+        return f.read()
+
+def group_documents(pre, texts, chunk_size):
+    """Split the document indexes in chunks of about chunk_size documents.
+
+    Documents including the same files/URLs (directly) are kept together, in input order.
+    """
+    parents = list(range(len(texts)))
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+    owners = {} # key = included file/URL, value = first document including it
+    for i, text in enumerate(texts):
+        for kind, filename, encoding, file_lines, recursive in pre.mdx_include_iter_includes(text.split('\n'), ''):
+            if filename in owners:
+                parents[find(i)] = find(owners[filename])
+            else:
+                owners[filename] = i
+    groups = {}
+    for i in range(len(texts)):
+        groups.setdefault(find(i), []).append(i)
+    chunks = []
+    chunk = []
+    for root in sorted(groups):
+        group = groups[root]
+        if chunk and len(chunk) + len(group) > chunk_size:
+            chunks.append(chunk)
+            chunk = []
+        while len(group) > chunk_size:
+            chunks.append(group[:chunk_size])
+            group = group[chunk_size:]
+        chunk.extend(group)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def init_worker(configs, extensions, extension_configs, snapshot):
+    """Create the Markdown instance of a worker process"""
+    configs = dict(configs)
+    if snapshot:
+        from .store import SnapshotStore
+        configs['content_store'] = SnapshotStore(snapshot)
+    worker['md'] = make_markdown(configs, extensions, extension_configs)
+
+def convert_document(md, index, path, text):
+    """Convert a document with md and return its BatchResult"""
+    if path is not None:
+        md.mdx_include_set_document(path)
+    start = timer()
+    try:
+        html = md.convert(text)
+        error = None
+    except Exception as err:
+        html = None
+        error = "%s: %s" % (err.__class__.__name__, err)
+        log.error("E: Failed to convert document %s: %s" % (path if path is not None else index, error))
+    seconds = timer() - start
+    dependencies = md.mdx_include_get_dependencies()
+    md.reset()
+    return BatchResult(index, path, html, seconds, error, dependencies)
+
+def convert_chunk(chunk):
+    """Convert a chunk of (index, path, text) in a worker process"""
+    md = worker['md']
+    return [convert_document(md, index, path, text) for index, path, text in chunk]
+
+def check_picklable(configs, extensions, extension_configs):
+    """Raise ValueError if the arguments passed to the worker processes can not be pickled"""
+    import pickle
+    for name, value in [('configs', configs), ('extensions', extensions), ('extension_configs', extension_configs)]:
+        items = value.items() if isinstance(value, dict) else enumerate(value or ())
+        for key, item in items:
+            try:
+                pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+            except Exception as err:
+                raise ValueError("%s[%r] is passed to the worker processes and can not be pickled (%s: %s), "
+                                 "use processes=0 or a picklable value" % (name, key, err.__class__.__name__, err))
+
+def convert_batch(items, configs={}, paths=False, processes=None, chunk_size=None,
+                  extensions=(), extension_configs=None, warm=True):
+    """Convert items and return the list of BatchResult in input order.
+
+    items are document texts, or file paths if paths is True (read with the configured
+    encoding and recorded as document names in the dependency graph).
+    processes is the number of worker processes (None for the number of CPUs, 0 or 1 to
+    convert in the current process). extensions must be given as names as they are
+    passed to the worker processes, configs and extension_configs too, they must be
+    picklable (ValueError otherwise, e.g. for a lambda metrics_callback). If warm is True and configs has no content_store,
+    the parent process reads all the includes once and the workers attach to a snapshot
+    of them (see mdx_include.store.SnapshotStore).
+    """
+    import multiprocessing
+    items = list(items)
+    encoding = configs.get('encoding', 'utf-8')
+    if paths:
+        docs = [(i, item, read_document(item, encoding)) for i, item in enumerate(items)]
+    else:
+        docs = [(i, None, item) for i, item in enumerate(items)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or len(docs) <= 1:
+        md = make_markdown(configs, extensions, extension_configs)
+        return [convert_document(md, index, path, text) for index, path, text in docs]
+
+    check_picklable(configs, extensions, extension_configs)
+    md = make_markdown(configs, extensions, extension_configs)
+    pre = get_preprocessor(md)
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(docs) // (processes * 4)))
+    chunks = [[docs[i] for i in chunk] for chunk in group_documents(pre, [text for index, path, text in docs], chunk_size)]
+    tmpdir = None
+    snapshot = None
+    if warm and configs.get('content_store') is None:
+        import tempfile
+        from .store import SnapshotStore, iter_cache_items
+        # all the documents at once, the downloads of a level are done in parallel
+        pre.mdx_include_warm_cache([line for index, path, text in docs for line in text.split('\n')])
+        tmpdir = tempfile.mkdtemp(prefix='mdx_include-')
+        snapshot = os.path.join(tmpdir, 'snapshot')
+        SnapshotStore.build(snapshot, iter_cache_items(pre.mdx_include_content_cache_local,
+                                                       pre.mdx_include_content_cache_remote)).close()
+    results = [None] * len(docs)
+    pool = multiprocessing.Pool(min(processes, len(chunks)), init_worker, (configs, extensions, extension_configs, snapshot))
+    try:
+        for chunk_results in pool.imap_unordered(convert_chunk, chunks):
+            for result in chunk_results:
+                results[result.index] = result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if tmpdir is not None:
+            import shutil
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
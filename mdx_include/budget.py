@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Resource budgets for mdx_include
+===========================================
+
+Limits on the include processing of one conversion: include depth, size
+of the included content, number of includes and wall clock time. Enabled
+when one of the max_depth, max_included_bytes, max_includes or deadline
+configs is set, the usage is available with md.mdx_include_get_budget()
+after md.convert().
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from .metrics import timer
+
+BUDGET_POLICIES = ('truncate', 'keep', 'raise')
+
+
+class IncludeBudgetExceeded(RuntimeError):
+    """An include exceeds a budget: budget is 'depth', 'bytes', 'includes' or 'deadline',
+    value is what the usage would be with the include (seconds for the deadline)."""
+
+    def __init__(self, budget, limit, value, path):
+        RuntimeError.__init__(self, "Include budget exceeded (%s: %s > %s) when including %s" % (budget, value, limit, path))
+        self.budget = budget
+        self.limit = limit
+        self.value = value
+        self.path = path
+
+
+class IncludeBudget(object):
+    """Limits and usage of one run of the include preprocessor, a limit of 0 means unlimited.
+
+    The includes of the document have depth 1, the includes of an included file have
+    the depth of that occurrence of the file + 1. A file included at several depths
+    counts each one, stack holds the depths of the files being processed. bytes is the
+    size (in characters) of the included contents, after slicing and before processing
+    their own includes.
+    """
+
+    def __init__(self, max_depth=0, max_bytes=0, max_includes=0, deadline=0):
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.max_includes = max_includes
+        self.deadline = deadline
+        self.start = timer()
+        self.end = None
+        self.stack = [] # depths of the files whose includes are being processed
+        self.depth = 0 # maximum depth reached
+        self.bytes = 0
+        self.includes = 0
+        self.exceeded = {} # key = budget, value = number of includes exceeding it
+
+    @property
+    def seconds(self):
+        return (self.end if self.end is not None else timer()) - self.start
+
+    def get_remaining(self):
+        """Return the seconds left before the deadline, None if there is no deadline or the run is over"""
+        if not self.deadline or self.end is not None:
+            return None
+        return self.start + self.deadline - timer()
+
+    def exceed(self, budget, limit, value, path):
+        self.exceeded[budget] = self.exceeded.get(budget, 0) + 1
+        raise IncludeBudgetExceeded(budget, limit, value, path)
+
+    def check_deadline(self, path):
+        if self.deadline and self.end is None:
+            seconds = timer() - self.start
+            if seconds > self.deadline:
+                self.exceed('deadline', self.deadline, seconds, path)
+
+    def enter(self, path):
+        """Count an include of path in the file being processed and return its depth"""
+        self.check_deadline(path)
+        if self.max_includes and self.includes >= self.max_includes:
+            self.exceed('includes', self.max_includes, self.includes + 1, path)
+        depth = (self.stack[-1] if self.stack else 0) + 1
+        if self.max_depth and depth > self.max_depth:
+            self.exceed('depth', self.max_depth, depth, path)
+        self.includes += 1
+        if depth > self.depth:
+            self.depth = depth
+        return depth
+
+    def add_bytes(self, size, path):
+        """Count size characters of included content of path"""
+        if self.max_bytes and self.bytes + size > self.max_bytes:
+            self.exceed('bytes', self.max_bytes, self.bytes + size, path)
+        self.bytes += size
+
+    def can_charge(self, includes, size, depth):
+        """Whether includes more includes, size more characters and the given depth fit in the budget"""
+        return not ((self.max_includes and self.includes + includes > self.max_includes)
+                    or (self.max_bytes and self.bytes + size > self.max_bytes)
+                    or (self.max_depth and depth > self.max_depth))
+
+    def charge(self, includes, size, depth):
+        """Count includes, size and depth of content processed in a previous run"""
+        self.includes += includes
+        self.bytes += size
+        if depth > self.depth:
+            self.depth = depth
+
+    def stop(self):
+        self.end = timer()
+
+    def to_dict(self):
+        return {
+            'max_depth': self.max_depth,
+            'max_bytes': self.max_bytes,
+            'max_includes': self.max_includes,
+            'deadline': self.deadline,
+            'depth': self.depth,
+            'bytes': self.bytes,
+            'includes': self.includes,
+            'seconds': self.seconds,
+            'exceeded': dict(self.exceeded),
+            }
+
+    def __repr__(self):
+        return "IncludeBudget(depth=%r, bytes=%r, includes=%r, seconds=%.6f, exceeded=%r)" % (self.depth, self.bytes, self.includes, self.seconds, self.exceeded)
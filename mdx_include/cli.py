@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+'''
+Command line include resolver for mdx_include
+===========================================
+
+Expands the includes of all the matching files of a directory tree into an
+output tree, without Markdown rendering. Run with: python -m mdx_include
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+import os
+import sys
+import json
+import fnmatch
+import hashlib
+import argparse
+from codecs import open
+from . import version
+from .batch import get_preprocessor, make_markdown, read_document, group_documents, timer
+
+MANIFEST_NAME = '.mdx_include-manifest.json'
+MANIFEST_VERSION = 1
+
+# state of a worker process, set by init_worker()
+worker = {}
+
+
+def parse_config(items):
+    """Return the config dict for a list of key=value strings, values are parsed as JSON if possible"""
+    configs = {}
+    for item in items:
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError("E: Invalid config (expected key=value): " + item)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        configs[key.strip()] = value
+    return configs
+
+def list_dir(directory, patterns, exclude):
+    """Return (subdirectories, matching files) of a directory"""
+    dirs = []
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            if os.path.abspath(path) not in exclude:
+                dirs.append(path)
+        elif any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            files.append(path)
+    return dirs, files
+
+def walk_files(root, patterns, exclude=(), workers=8):
+    """Return the sorted paths of the files under root matching any of the patterns.
+
+    Directories of the same depth are listed in parallel.
+    """
+    exclude = set(os.path.abspath(path) for path in exclude)
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        # python 2 without the futures backport
+        ThreadPoolExecutor = None
+    files = []
+    level = [root]
+    executor = ThreadPoolExecutor(max_workers=max(1, workers)) if ThreadPoolExecutor is not None else None
+    try:
+        while level:
+            if executor is not None:
+                listings = executor.map(lambda d: list_dir(d, patterns, exclude), level)
+            else:
+                listings = [list_dir(d, patterns, exclude) for d in level]
+            level = []
+            for dirs, dir_files in listings:
+                level.extend(dirs)
+                files.extend(dir_files)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return sorted(files)
+
+def get_file_hash(path):
+    """Return the sha1 hex digest of the content of a file (of the entry names of a
+    directory listed by a glob include) or None if it can not be read"""
+    try:
+        if os.path.isdir(path):
+            return hashlib.sha1('\n'.join(sorted(os.listdir(path))).encode('utf-8')).hexdigest()
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def load_manifest(path, configs):
+    """Return the file entries of the manifest, empty if it is missing or was made with another config"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('config') != configs:
+        return {}
+    return manifest.get('files', {})
+
+def save_manifest(path, configs, files):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'version': MANIFEST_VERSION, 'config': configs, 'files': files}, f, indent=1, sort_keys=True)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+def is_remote(path):
+    return '://' in path
+
+def is_unchanged(entry, source_hash, output, hashes, remote_unchanged):
+    """Return whether the output of a file with its manifest entry is up to date"""
+    if entry is None or entry.get('source') != source_hash or not os.path.exists(output):
+        return False
+    for dep, dep_hash in entry.get('deps', {}).items():
+        if is_remote(dep):
+            if not remote_unchanged:
+                return False
+        else:
+            if dep not in hashes:
+                hashes[dep] = get_file_hash(dep)
+            if hashes[dep] != dep_hash:
+                return False
+    return True
+
+def init_worker(configs):
+    worker['encoding'] = configs.get('encoding', 'utf-8')
+    worker['pre'] = get_preprocessor(make_markdown(configs))
+
+def expand_file(source, text, output):
+    """Expand the includes of text and write it to output.
+
+    Returns (source, dependencies, seconds, output size, error).
+    """
+    pre = worker['pre']
+    start = timer()
+    try:
+        pre.mdx_include_set_document(source)
+        content = '\n'.join(pre.run(text.split('\n')))
+        directory = os.path.dirname(output)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another worker
+                if not os.path.isdir(directory):
+                    raise
+        with open(output, 'w', encoding=worker['encoding']) as f:
+            f.write(content)
+        return source, pre.mdx_include_get_dependencies(), timer() - start, len(content), None
+    except Exception as err:
+        return source, [], timer() - start, 0, "%s: %s" % (err.__class__.__name__, err)
+
+def expand_chunk(chunk):
+    return [expand_file(source, text, output) for source, text, output in chunk]
+
+def expand_tree(source_dir, output_dir, configs={}, patterns=('*.md',), processes=None,
+                manifest=None, force=False, remote_unchanged=False):
+    """Expand the includes of the files of source_dir matching patterns into output_dir.
+
+    Files whose source and dependencies have the same hashes as recorded in the
+    manifest (output_dir/.mdx_include-manifest.json by default) and whose output
+    exists are skipped. Files with remote dependencies are always expanded unless
+    remote_unchanged is True. Returns a dict of statistics.
+    """
+    import multiprocessing
+    start = timer()
+    if manifest is None:
+        manifest = os.path.join(output_dir, MANIFEST_NAME)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    encoding = configs.get('encoding', 'utf-8')
+    sources = walk_files(source_dir, patterns, exclude=[output_dir], workers=processes)
+    entries = load_manifest(manifest, configs)
+    new_entries = {}
+    hashes = {} # key = dependency path, value = hash, shared by all files
+    tasks = []
+    texts = []
+    bytes_in = 0
+    for source in sources:
+        rel = os.path.relpath(source, source_dir)
+        output = os.path.join(output_dir, rel)
+        source_hash = get_file_hash(source)
+        entry = entries.get(rel)
+        if not force and is_unchanged(entry, source_hash, output, hashes, remote_unchanged):
+            new_entries[rel] = entry
+            continue
+        text = read_document(source, encoding)
+        bytes_in += len(text)
+        tasks.append((source, text, output))
+        texts.append(text)
+        new_entries[rel] = {'source': source_hash, 'deps': {}}
+
+    results = []
+    if tasks:
+        if processes <= 1 or len(tasks) <= 1:
+            init_worker(configs)
+            results = expand_chunk(tasks)
+        else:
+            chunk_size = max(1, -(-len(tasks) // (processes * 4)))
+            chunks = [[tasks[i] for i in chunk] for chunk in group_documents(get_preprocessor(make_markdown(configs)), texts, chunk_size)]
+            pool = multiprocessing.Pool(min(processes, len(chunks)), init_worker, (configs,))
+            try:
+                for chunk_results in pool.imap_unordered(expand_chunk, chunks):
+                    results.extend(chunk_results)
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+    failed = []
+    bytes_out = 0
+    for source, dependencies, seconds, size, error in results:
+        rel = os.path.relpath(source, source_dir)
+        if error is not None:
+            failed.append((rel, error))
+            # expand it again on the next run
+            del new_entries[rel]
+            continue
+        bytes_out += size
+        deps = {}
+        for dep in dependencies:
+            if is_remote(dep):
+                deps[dep] = None
+            else:
+                if dep not in hashes:
+                    hashes[dep] = get_file_hash(dep)
+                deps[dep] = hashes[dep]
+        new_entries[rel]['deps'] = deps
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    save_manifest(manifest, configs, new_entries)
+    elapsed = timer() - start
+    return {
+        'files': len(sources),
+        'expanded': len(results) - len(failed),
+        'skipped': len(sources) - len(tasks),
+        'failed': failed,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'seconds': elapsed,
+        'files_per_second': len(results) / elapsed if elapsed else 0.0,
+        'bytes_per_second': bytes_in / elapsed if elapsed else 0.0,
+    }
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='python -m mdx_include',
+                                     description='Expand the includes of the files of a directory tree into an output tree, without Markdown rendering.')
+    parser.add_argument('source', help='source directory')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('-p', '--pattern', action='append', default=[], help='file name pattern to expand, can be repeated (default: *.md)')
+    parser.add_argument('-c', '--config', action='append', default=[], metavar='KEY=VALUE', help='extension config, the value is parsed as JSON if possible, can be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-m', '--manifest', default=None, help='manifest file (default: OUTPUT/' + MANIFEST_NAME + ')')
+    parser.add_argument('-f', '--force', action='store_true', help='expand all the files, even if unchanged')
+    parser.add_argument('--remote-unchanged', action='store_true', help='assume remote dependencies are unchanged')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not print statistics')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + version.__version__)
+    return parser
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    configs = parse_config(args.config)
+    stats = expand_tree(args.source, args.output, configs, args.pattern or ['*.md'], args.jobs,
+                        args.manifest, args.force, args.remote_unchanged)
+    for rel, error in stats['failed']:
+        print("E: Failed to expand %s: %s" % (rel, error), file=sys.stderr)
+    if not args.quiet:
+        print("%(files)d files: %(expanded)d expanded, %(skipped)d skipped, %(nfailed)d failed in %(seconds).3fs"
+              " (%(files_per_second).1f files/s, %(mb_per_second).2f MB/s)"
+              % dict(stats, nfailed=len(stats['failed']), mb_per_second=stats['bytes_per_second'] / 1e6))
+    return 1 if stats['failed'] else 0
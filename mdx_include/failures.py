@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+Failure handling for mdx_include
+===========================================
+
+Negative caching of failed includes, single-flight coalescing of concurrent
+reads/downloads of the same content and optionally rate-limited failure logging.
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import time
+import logging
+import threading
+from collections import OrderedDict
+from . import version
+
+LOGGER_NAME = 'mdx_include-' + version.__version__
+log = logging.getLogger(LOGGER_NAME)
+
+
+class NegativeCache(object):
+    """Remembers failed includes.
+
+    With ttl > 0, a failure is remembered for ttl seconds, otherwise until
+    start_run() is called, i.e for the current conversion only.
+    """
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self.entries = {} # key = (kind, path, encoding), value = failure time
+        self.hits = 0
+
+    def add(self, key):
+        self.entries[key] = time.time()
+
+    def __contains__(self, key):
+        failed = self.entries.get(key)
+        if failed is None:
+            return False
+        if self.ttl > 0 and time.time() - failed >= self.ttl:
+            del self.entries[key]
+            return False
+        self.hits += 1
+        return True
+
+    def start_run(self):
+        """Forget the failures remembered for the previous conversion only"""
+        if self.ttl <= 0:
+            self.entries.clear()
+
+    def clear(self, kind=None):
+        """Forget the failures of a kind ('local' or 'remote') or all of them"""
+        if kind is None:
+            self.entries.clear()
+        else:
+            for key in [key for key in self.entries if key[0] == kind]:
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key: one thread runs the call
+    and the others wait for its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # key = call key, value = [event, result, exception]
+        self.shared = 0
+
+    def do(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None, None]
+            else:
+                self.shared += 1
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = func(*args)
+        except BaseException as err:
+            call[2] = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+        return call[1]
+
+
+class FailureLog(object):
+    """Logs a failure with its traceback the first time and at most once every
+    interval seconds after that, counting the suppressed messages. With
+    interval 0, every failure is logged."""
+
+    max_keys = 1024
+
+    def __init__(self, interval=0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key = message, value = [last log time, suppressed count]
+
+    def exception(self, message):
+        """Log message with the current exception unless it was logged recently"""
+        if self.interval <= 0:
+            log.exception(message)
+            return
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(message)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                return
+            suppressed = entry[1] if entry is not None else 0
+            self.entries.pop(message, None)
+            self.entries[message] = [now, 0]
+            while len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+        if suppressed:
+            message = "%s (%d similar messages suppressed)" % (message, suppressed)
+        log.exception(message)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+flights = SingleFlight() # shared by all the instances of the process
+failure_log = FailureLog() # shared by all the instances of the process, not rate-limited by default
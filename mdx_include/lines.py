@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+'''
+Compact line storage for mdx_include
+===========================================
+
+A LineBuffer keeps the lines of a content as one text and an array of line
+offsets instead of one string object per line. It is an immutable sequence
+of lines: lines are materialized when they are accessed, slices are
+materialized as lists (this is what RowSlice and the expansion loop use).
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import sys
+from array import array
+from bisect import bisect_right
+
+
+class LineBuffer(object):
+    """Immutable sequence of lines stored as '\\n'.join(lines) with the start
+    offset of each line (plus the end offset of the text + 1)."""
+
+    __slots__ = ('text', 'offsets')
+
+    # number of line strings materialized by all the buffers
+    copies = 0
+
+    def __init__(self, text, offsets):
+        self.text = text
+        self.offsets = offsets
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Return the LineBuffer of a list of lines (lines must not contain '\\n')"""
+        if isinstance(lines, cls):
+            return lines
+        text = '\n'.join(lines)
+        offsets = array(str('I') if len(text) < 0xffffffff else str('L'), [0])
+        offset = 0
+        append = offsets.append
+        for line in lines:
+            offset += len(line) + 1
+            append(offset)
+        return cls(text, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        offsets = self.offsets
+        if isinstance(index, slice):
+            indexes = range(*index.indices(len(offsets) - 1))
+            text = self.text
+            LineBuffer.copies += len(indexes)
+            return [text[offsets[i]:offsets[i + 1] - 1] for i in indexes]
+        n = len(offsets) - 1
+        if index < 0:
+            index += n
+        if index < 0 or index >= n:
+            raise IndexError("line index out of range")
+        LineBuffer.copies += 1
+        return self.text[offsets[index]:offsets[index + 1] - 1]
+
+    def __iter__(self):
+        offsets = self.offsets
+        text = self.text
+        LineBuffer.copies += len(offsets) - 1
+        for i in range(len(offsets) - 1):
+            yield text[offsets[i]:offsets[i + 1] - 1]
+
+    def __eq__(self, other):
+        if isinstance(other, LineBuffer):
+            return self.text == other.text and len(self) == len(other)
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "LineBuffer(%d lines, %d characters)" % (len(self), len(self.text))
+
+    def find_lines(self, s):
+        """Return the sorted indexes of the lines containing s (s must not contain '\\n')"""
+        text = self.text
+        offsets = self.offsets
+        indexes = []
+        pos = text.find(s)
+        while pos != -1:
+            i = bisect_right(offsets, pos) - 1
+            indexes.append(i)
+            # continue from the next line
+            pos = text.find(s, offsets[i + 1])
+        return indexes
+
+    def get_memory(self):
+        """Return the memory used by the buffer in bytes"""
+        return sys.getsizeof(self.text) + self.offsets.buffer_info()[1] * self.offsets.itemsize
+
+
+def get_lines_memory(textl):
+    """Return the memory used by a content (list of lines or LineBuffer) in bytes"""
+    if isinstance(textl, LineBuffer):
+        return textl.get_memory()
+    return sys.getsizeof(textl) + sum(sys.getsizeof(line) for line in textl)
+
+def get_lines_text(textl):
+    """Return '\\n'.join(textl) without materializing the lines of a LineBuffer"""
+    if isinstance(textl, LineBuffer):
+        return textl.text
+    return '\n'.join(textl)
@@ -17,55 +17,164 @@ from __future__ import unicode_literals
 import markdown
 import re
 import os
+import copy
+import codecs
+import time
 from codecs import open
-import pkgutil
-import encodings
 import logging
+from collections import OrderedDict
 try:
     # python 3
     from urllib.parse import urlparse
     from urllib.parse import urlunparse
-    from urllib.request import build_opener
-    from urllib.request import HTTPRedirectHandler
 except ImportError:
     # python 2
     from urlparse import urlparse
     from urlparse import urlunparse
-    from urllib2 import HTTPRedirectHandler
-    from urllib2 import build_opener
-from rcslice import RowSlice
-from cyclic import Cyclic
 from . import version
+from .failures import NegativeCache, flights, failure_log
+from .metrics import IncludeMetrics, timer
+from .lines import LineBuffer, get_lines_memory
+from .scanner import IncludeScanner
+from .budget import IncludeBudget, IncludeBudgetExceeded, BUDGET_POLICIES
 
 __version__ = version.__version__
 
 MARKDOWN_MAJOR = (markdown.__version_info__ if hasattr(markdown, "__version_info__") else markdown.version_info)[0]
 
-logging.basicConfig()
 LOGGER_NAME = 'mdx_include-' + __version__
 log = logging.getLogger(LOGGER_NAME)
 
+STREAM_CHUNK_SIZE = 65536
+
+RESOLVED_PATHS_MAX_ENTRIES = 10000
+
+class EncodingRegistry(object):
+    """Process-wide encoding resolver.
+
+    The ``encodings`` package is scanned only once (lazily, on the first lookup)
+    and every answer, positive or negative, is memoized. Names that are not
+    module names (e.g ``latin1``, ``utf8``) are resolved through ``codecs.lookup``.
+    """
+
+    false_positives = frozenset(["aliases"])
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget the module scan and all memoized answers"""
+        self._modules = None
+        self._known = {}
+
+    def get_modules(self):
+        """Return the set of codec module names found in the encodings package"""
+        if self._modules is None:
+            import pkgutil
+            import encodings
+            found = set(name for imp, name, ispkg in pkgutil.iter_modules(encodings.__path__) if not ispkg)
+            found.difference_update(self.false_positives)
+            self._modules = frozenset(found)
+        return self._modules
+
+    def exists(self, encoding):
+        """Check if an encoding is available in Python"""
+        if not encoding:
+            return False
+        try:
+            return self._known[encoding]
+        except KeyError:
+            pass
+        modules = self.get_modules()
+        stat = encoding in modules or encoding.replace('-', '_') in modules
+        if not stat:
+            try:
+                codecs.lookup(encoding)
+                stat = True
+            except LookupError:
+                pass
+        self._known[encoding] = stat
+        return stat
+
+    def info(self):
+        """Return a dict describing the current state of the registry"""
+        return {
+            'scanned': self._modules is not None,
+            'modules': len(self._modules) if self._modules is not None else 0,
+            'known': sorted(k for k, v in self._known.items() if v),
+            'unknown': sorted(k for k, v in self._known.items() if not v),
+        }
+
+
+encoding_registry = EncodingRegistry()
+
 def encoding_exists(encoding):
     """Check if an encoding is available in Python"""
-    false_positives = set(["aliases"])
-    found = set(name for imp, name, ispkg in pkgutil.iter_modules(encodings.__path__) if not ispkg)
-    found.difference_update(false_positives)
-    if encoding:
-        if encoding in found:
-            return True
-        elif encoding.replace('-', '_') in found:
-            return True
-    return False
-
-def get_remote_content_list(url, encoding='utf-8'):
-    """Follow redirect and return the content"""
-    try:
-        log.info("Downloading url: "+ url)
-        return ''.join([build_opener(HTTPRedirectHandler).open(url).read().decode(encoding), '\n']).splitlines(), True
-    except Exception as err:
-        # catching all exception, this will effectively return empty string
-        log.exception("E: Failed to download: " + url)
-        return [], False
+    return encoding_registry.exists(encoding)
+
+def get_remote_content_list(url, encoding='utf-8', timeout=None, disk_cache=None, ttl=0, offline=False, max_size=0, keep_alive=True,
+                            deadline=None):
+    """Follow redirect and return the content with status, see remote.get_remote_content_list()"""
+    from . import remote
+    return remote.get_remote_content_list(url, encoding, timeout, disk_cache, ttl, offline, max_size, keep_alive, deadline)
+
+def get_literal_prefix(pattern):
+    """Return the literal text that every match of the regex pattern starts with.
+
+    An empty string is returned when it can not be determined.
+
+    >>> get_literal_prefix(r'\\{!')
+    '{!'
+    >>> get_literal_prefix(r'ab?c')
+    'a'
+    >>> get_literal_prefix(r'a|b')
+    ''
+    """
+    i = 0
+    while i < len(pattern):
+        if pattern[i] == '\\':
+            i = i + 2
+        elif pattern[i] == '|':
+            # alternation, there's no common prefix
+            return ''
+        else:
+            i = i + 1
+    literal = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        step = 1
+        if ch == '\\':
+            if i + 1 >= len(pattern) or pattern[i+1].isalnum():
+                break
+            ch = pattern[i+1]
+            step = 2
+        elif ch in '.^$*+?{}[]()':
+            break
+        nxt = pattern[i+step:i+step+1]
+        if nxt and nxt in '*?{':
+            # this one is optional or repeated
+            break
+        if ch == '\n':
+            break
+        literal.append(ch)
+        if nxt == '+':
+            break
+        i = i + step
+    return ''.join(literal)
+
+def interleave_by_host(urls):
+    """Reorder urls so that consecutive urls point to different hosts where possible"""
+    hosts = OrderedDict()
+    for url in urls:
+        hosts.setdefault(urlparse(url).netloc, []).append(url)
+    queues = list(hosts.values())
+    ordered = []
+    while queues:
+        for q in queues:
+            ordered.append(q.pop(0))
+        queues = [q for q in queues if q]
+    return ordered
 
 def get_local_content_list(filename, encoding):
     """Return the file content with status"""
@@ -76,13 +185,324 @@ def get_local_content_list(filename, encoding):
             textl = ''.join([f.read(), '\n']).splitlines()
             stat = True
     except Exception as e:
-        log.exception('E: Could not find file: {}'.format(filename,))
+        failure_log.exception('E: Could not find file: {}'.format(filename,))
     return textl, stat
 
 
+def get_file_signature(filename):
+    """Return the (mtime_ns, size, inode) signature of a file or None if it can not be stat'ed"""
+    try:
+        st = os.stat(filename)
+    except (OSError, IOError):
+        return None
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        # python 2
+        mtime = int(st.st_mtime * 1000000000)
+    return (mtime, st.st_size, st.st_ino)
+
+def has_glob_magic(path):
+    """Check if a path contains glob wildcards"""
+    return '*' in path or '?' in path or '[' in path
+
+def get_dir_entries(dirname):
+    """Return the sorted entry names of a directory, names of sub directories end with '/',
+    or None if the directory can not be listed"""
+    try:
+        if hasattr(os, 'scandir'):
+            entries = [entry.name + '/' if entry.is_dir() else entry.name for entry in os.scandir(dirname)]
+        else:
+            # python 2
+            entries = [name + '/' if os.path.isdir(os.path.join(dirname, name)) else name for name in os.listdir(dirname)]
+    except (OSError, IOError):
+        return None
+    entries.sort()
+    return entries
+
+def get_content_size(textl):
+    """Return the approximate size (in characters) of a content line list"""
+    if isinstance(textl, LineBuffer):
+        return len(textl.text) + 1 if len(textl) else 0
+    return sum(len(line) for line in textl) + len(textl)
+
+
+class ContentCache(OrderedDict):
+    """LRU cache of content line lists keyed by file path.
+
+    Entries stored with a file signature (see get_file_signature()) are
+    checked against the current file metadata before they are reused and
+    dropped if the file has changed. Entries stored through the normal dict
+    interface (e.g by modifying the dict returned by
+    md.mdx_include_get_content_cache_local()) carry no signature and are
+    served as they are. Entries of a watched cache (see mdx_include.watch)
+    are not checked, the watcher evicts them when the file changes.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, validate=True):
+        OrderedDict.__init__(self)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.signatures = {}
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.watched = False
+        self.on_store = None # called with (key, signature) when a value is stored
+        self.on_remove = None # called with key when an entry is removed
+
+    def __setitem__(self, key, value):
+        self.store(key, value)
+
+    def __delitem__(self, key):
+        OrderedDict.__delitem__(self, key)
+        self.signatures.pop(key, None)
+        self.nbytes -= self.sizes.pop(key, 0)
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            value = OrderedDict.__getitem__(self, key)
+            del self[key]
+            return value
+        return OrderedDict.pop(self, key, *args)
+
+    def popitem(self, last=True):
+        key = next(reversed(self)) if last else next(iter(self))
+        return key, self.pop(key)
+
+    def clear(self):
+        if self.on_remove is not None:
+            for key in list(self):
+                self.on_remove(key)
+        OrderedDict.clear(self)
+        self.signatures.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+
+    def copy(self):
+        new = self.__class__(self.max_entries, self.max_bytes, self.validate)
+        for key, value in self.items():
+            new.store(key, value, self.signatures.get(key))
+        return new
+
+    def store(self, key, value, signature=None):
+        """Store value for key along with the file signature it was read with"""
+        if key in self:
+            del self[key]
+        OrderedDict.__setitem__(self, key, value)
+        self.signatures[key] = signature
+        size = get_content_size(value)
+        self.sizes[key] = size
+        self.nbytes += size
+        self.evict()
+        if self.on_store is not None:
+            self.on_store(key, signature)
+
+    def lookup(self, key):
+        """Return the cached value for key if it is still valid, otherwise None"""
+        if key not in self:
+            self.misses += 1
+            return None
+        value = OrderedDict.__getitem__(self, key)
+        signature = self.signatures.get(key)
+        if self.validate and not self.watched and signature is not None and get_file_signature(key) != signature:
+            del self[key]
+            self.invalidations += 1
+            self.misses += 1
+            return None
+        # mark as most recently used
+        OrderedDict.__delitem__(self, key)
+        OrderedDict.__setitem__(self, key, value)
+        self.hits += 1
+        return value
+
+    def evict(self):
+        """Drop least recently used entries until the size limits are satisfied"""
+        while self and ((self.max_entries and len(self) > self.max_entries)
+                        or (self.max_bytes and self.nbytes > self.max_bytes)):
+            del self[next(iter(self))]
+            self.evictions += 1
+
+    def stats(self):
+        """Return the cache counters as a dict"""
+        return {
+            'entries': len(self),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'memory': sum(get_lines_memory(value) for value in self.values()),
+        }
+
+def split_file_lines(f):
+    """Yield the lines of an open file lazily, split the same way as get_local_content_list()"""
+    carry = ''
+    while True:
+        chunk = f.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        parts = ''.join([carry, chunk]).splitlines(True)
+        # the last part may be incomplete (or a \r followed by \n in the next chunk)
+        carry = parts.pop()
+        for part in parts:
+            yield part.splitlines()[0]
+    for line in ''.join([carry, '\n']).splitlines():
+        yield line
+
+def iter_file_lines(f, filename):
+    """Yield the lines of an open file lazily, logging read errors and closing the file at the end"""
+    try:
+        for line in split_file_lines(f):
+            yield line
+    except Exception as e:
+        failure_log.exception('E: Could not read file: {}'.format(filename,))
+    finally:
+        f.close()
+
+def get_local_content_head(filename, encoding, count):
+    """Return (lines, complete, stat) where lines are at least the first count lines
+    of the file (all of them if the file is shorter, then complete is True).
+    """
+    textl = []
+    complete = False
+    stat = False
+    try:
+        with open(filename, 'r', encoding=encoding) as f:
+            lines = split_file_lines(f)
+            for line in lines:
+                textl.append(line)
+                if len(textl) >= count:
+                    break
+            if len(textl) < count:
+                complete = True
+            else:
+                # one more to know whether there's anything left
+                for line in lines:
+                    textl.append(line)
+                    break
+                else:
+                    complete = True
+            stat = True
+    except Exception as e:
+        failure_log.exception('E: Could not find file: {}'.format(filename,))
+        textl = []
+    return textl, complete, stat
+
+def get_slice_line_count(file_lines):
+    """Return the number of leading lines needed by a line slice or None if the whole
+    content is needed (i.e the slice refers to the end of the content).
+
+    >>> get_slice_line_count('1-20,4.3-2')
+    20
+    >>> get_slice_line_count('2-') is None
+    True
+    """
+    count = 0
+    for part in file_lines.split(','):
+        if not part:
+            continue
+        for side in part.split('-'):
+            row = side.split('.')[0]
+            try:
+                count = max(count, int(row))
+            except ValueError:
+                # e, missing or invalid row number, leave it to rcslice
+                return None
+    return count or None
+
+def get_local_content_iter(filename, encoding):
+    """Return a lazy iterator over the file lines with status"""
+    try:
+        f = open(filename, 'r', encoding=encoding)
+    except Exception as e:
+        failure_log.exception('E: Could not find file: {}'.format(filename,))
+        return [], False
+    return iter_file_lines(f, filename), True
+
+
+class DependencyGraph(object):
+    """Include dependencies of converted documents.
+
+    For each document it keeps the direct child parent relations found while
+    processing its includes ('' stands for the document itself), along with
+    a reverse index from included files/URLs to documents.
+    """
+
+    def __init__(self):
+        self.documents = {} # key = document, value = dict of child -> list of parents
+        self.dependents = {} # key = file_path_or_url, value = set of documents
+
+    def set(self, document, relations):
+        """Set the relations (dict of child -> iterable of parents) of a document"""
+        self.remove(document)
+        self.documents[document] = dict((child, sorted(parents)) for child, parents in relations.items())
+        for child in relations:
+            self.dependents.setdefault(child, set()).add(document)
+
+    def remove(self, document):
+        """Forget a document"""
+        relations = self.documents.pop(document, None)
+        if relations:
+            for child in relations:
+                docs = self.dependents.get(child)
+                if docs is not None:
+                    docs.discard(document)
+                    if not docs:
+                        del self.dependents[child]
+
+    def get_relations(self, document):
+        """Return the dict of child -> list of parents of a document"""
+        return self.documents.get(document, {})
+
+    def get_dependencies(self, document):
+        """Return the sorted list of files/URLs a document depends on (transitively)"""
+        return sorted(self.documents.get(document, {}))
+
+    def get_dependents(self, path):
+        """Return the sorted list of documents that depend on a file/URL"""
+        return sorted(self.dependents.get(path, ()))
+
+    def get_affected(self, paths):
+        """Return the sorted list of documents that depend on any of the paths"""
+        affected = set()
+        for path in paths:
+            affected.update(self.dependents.get(path, ()))
+        return sorted(affected)
+
+    def to_dict(self):
+        return {'documents': self.documents}
+
+    @classmethod
+    def from_dict(cls, d):
+        graph = cls()
+        for document, relations in d.get('documents', {}).items():
+            graph.set(document, relations)
+        return graph
+
+    def to_json(self, **kwargs):
+        """Serialize the graph to a JSON string"""
+        import json
+        return json.dumps(self.to_dict(), sort_keys=True, **kwargs)
+
+    @classmethod
+    def from_json(cls, text):
+        """Create a graph from a JSON string made by to_json()"""
+        import json
+        return cls.from_dict(json.loads(text))
+
+
 class IncludeExtension(markdown.Extension):
     """Include Extension class for markdown"""
 
+    # keys whose value is an arbitrary object, None by default
+    object_config_keys = ('content_store', 'metrics_callback')
+
     def __init__(self, configs={}):
         self.config = {
             'base_path': [ '.', 'Base path from where relative paths are calculated',],
@@ -100,11 +520,44 @@ class IncludeExtension(markdown.Extension):
             'syntax_apply_indent': ['>', 'Character to specify apply indentation'],
             'content_cache_local': [True, 'Whether to cache content for local files'],
             'content_cache_remote': [True, 'Whether to cache content for remote files'],
+            'content_cache_local_max_entries': [0, 'Maximum number of files kept in the local content cache, 0 means unlimited.'],
+            'content_cache_local_max_bytes': [0, 'Maximum size (in characters) of the text kept in the local content cache, 0 means unlimited.'],
+            'content_cache_local_validate': [True, 'Whether to check file metadata (mtime, size, inode) before reusing cached content for local files.'],
             'content_cache_clean_local': [False, 'Whether to clean content cache for local files after processing all the includes.'],
             'content_cache_clean_remote': [False, 'Whether to clean content cache for remote files after processing all the includes.'],
             'allow_circular_inclusion': [False, 'Whether to allow circular inclusion.'],
             'line_slice_separator': [['',''], 'A list of lines that will be used to separate parts specified by line slice syntax: 1-2,3-4,5 etc.'],
             'recursive_relative_path': [False, 'Whether include paths inside recursive files should be relative to the parent file path'],
+            'partial_read': [True, 'Whether to read only the needed leading lines of local files for line slices that do not depend on the end of the file.'],
+            'streaming': [False, 'Whether to read local files and process includes as lazy line iterators to bound memory usage by the size of the output.'],
+            'expanded_cache': [True, 'Whether to cache recursively processed content of included files.'],
+            'remote_timeout': [30.0, 'Timeout in seconds for connecting to and reading from remote hosts, 0 means no timeout.'],
+            'remote_cache_dir': ['', 'Directory of the persistent cache for remote content, empty string disables it.'],
+            'remote_cache_ttl': [0.0, 'Seconds during which a persistently cached remote content is used without revalidation.'],
+            'remote_offline': [False, 'Whether to serve remote includes only from the persistent cache, regardless of their age.'],
+            'remote_keep_alive': [True, 'Whether to reuse HTTP(S) connections to remote hosts across includes and conversions (connection pool shared by the process).'],
+            'remote_max_size': [0, 'Maximum size in bytes of a remote include after decompression, a larger one fails. 0 means unlimited.'],
+            'remote_prefetch': [False, 'Whether to download all remote includes in parallel before processing the includes.'],
+            'remote_prefetch_workers': [8, 'Maximum number of parallel downloads when prefetching remote includes.'],
+            'remote_prefetch_per_host': [4, 'Maximum number of parallel downloads per host when prefetching remote includes.'],
+            'negative_cache': [True, 'Whether to remember failed includes instead of retrying them at every occurrence.'],
+            'negative_cache_ttl': [0.0, 'Seconds during which a failed include is not retried, 0 means for the current conversion only.'],
+            'metrics': [False, 'Whether to collect metrics of each conversion, available with md.mdx_include_get_metrics().'],
+            'metrics_callback': [None, 'A function called with the span of each include when it is done, it enables metrics.'],
+            'compact_lines': [False, 'Whether to keep cached content as one text with line offsets (see mdx_include.lines.LineBuffer) instead of a list of lines.'],
+            'scanner': [True, 'Whether to find includes with the linear time scanner (see mdx_include.scanner) instead of the regex when the syntax configs are literals.'],
+            'allow_glob': [False, 'Allow including all the local files matching a path with wildcards (*, ?) or all the files of a directory (path ending with /).'],
+            'glob_separator': [[''], 'A list of lines that will be used to separate the contents of the files included by a glob or directory include.'],
+            'glob_workers': [8, 'Maximum number of parallel reads of the files included by a glob or directory include.'],
+            'max_depth': [0, 'Maximum include depth of a conversion (1 for the includes of the document), 0 means unlimited.'],
+            'max_included_bytes': [0, 'Maximum total size (in characters) of the content included by a conversion, 0 means unlimited.'],
+            'max_includes': [0, 'Maximum number of files/URLs included by a conversion, 0 means unlimited.'],
+            'deadline': [0.0, 'Maximum time in seconds of the include processing of a conversion, downloads included, 0 means no deadline.'],
+            'budget_policy': ['truncate', 'What to do with an include exceeding a budget: truncate (remove it), keep (leave the include markdown) or raise (IncludeBudgetExceeded).'],
+            'render_cache': [False, 'Whether to reuse the HTML of a document while its text, the configs and the included content are unchanged (see mdx_include.render).'],
+            'render_cache_max_entries': [1000, 'Maximum number of documents kept in memory by the render cache, 0 means unlimited.'],
+            'render_cache_dir': ['', 'Directory where the render cache keeps documents across processes, empty string keeps them in memory only.'],
+            'content_store': [None, 'A shared content store (see mdx_include.store) used as a second level cache for local and remote content, None disables it.'],
             }
         # ~ super(IncludeExtension, self).__init__(*args, **kwargs)
         # default setConfig does not preserve None when the default config value is a bool (a bug may be or design decision)
@@ -123,6 +576,11 @@ class IncludeExtension(markdown.Extension):
         else:
             if isinstance(value, type(self.config[key][0])):
                 pass
+            elif key in self.object_config_keys:
+                pass
+            elif isinstance(self.config[key][0], float) and isinstance(value, int):
+                # an int is a valid value where a float is expected
+                value = float(value)
             else:
                 raise TypeError("E: The type ({}) of the value ({}) does not match with the required type ({}) for the key {}.".format(type(value), value, type(self.config[key][0]), key))
         self.config[key][0] = value
@@ -145,10 +603,25 @@ class IncludePreprocessor(markdown.preprocessors.Preprocessor):
     def __init__(self, md, config, compiled_regex):
         md.mdx_include_content_cache_clean_local = self.mdx_include_content_cache_clean_local
         md.mdx_include_content_cache_clean_remote = self.mdx_include_content_cache_clean_remote
+        md.mdx_include_content_cache_evict_local = self.mdx_include_content_cache_evict_local
         md.mdx_include_get_content_cache_local = self.mdx_include_get_content_cache_local
         md.mdx_include_get_content_cache_remote = self.mdx_include_get_content_cache_remote
+        md.mdx_include_set_document = self.mdx_include_set_document
+        md.mdx_include_get_dependencies = self.mdx_include_get_dependencies
+        md.mdx_include_get_dependency_graph = self.mdx_include_get_dependency_graph
+        md.mdx_include_aconvert = self.mdx_include_aconvert
+        md.mdx_include_get_metrics = self.mdx_include_get_metrics
+        md.mdx_include_get_budget = self.mdx_include_get_budget
+        md.mdx_include_watch = self.mdx_include_watch
+        md.mdx_include_get_render_cache = self.mdx_include_get_render_cache
+        md.mdx_include_get_connection_pool = self.mdx_include_get_connection_pool
         super(IncludePreprocessor, self).__init__(md)
         self.compiled_re = compiled_regex
+        self.scanner = None
+        if config['scanner'][0]:
+            self.scanner = IncludeScanner.create(compiled_regex, config['syntax_left'][0], config['syntax_right'][0], config['syntax_delim'][0],
+                                                 config['syntax_recurs_on'][0], config['syntax_recurs_off'][0], config['syntax_apply_indent'][0])
+        self.include_finder = self.scanner if self.scanner is not None else compiled_regex # has finditer(line)
         self.base_path = config['base_path'][0]
         self.encoding = config['encoding'][0]
         self.allow_local = config['allow_local'][0]
@@ -159,26 +632,107 @@ class IncludePreprocessor(markdown.preprocessors.Preprocessor):
         self.syntax_recurs_on = config['syntax_recurs_on'][0]
         self.syntax_recurs_off = config['syntax_recurs_off'][0]
         self.syntax_apply_indent = config['syntax_apply_indent'][0]
-        self.mdx_include_content_cache_local = {} # key = file_path_or_url, value = content
+        self.mdx_include_content_cache_local = ContentCache(config['content_cache_local_max_entries'][0],
+                                                            config['content_cache_local_max_bytes'][0],
+                                                            config['content_cache_local_validate'][0]) # key = file_path, value = content
         self.mdx_include_content_cache_remote = {} # key = file_path_or_url, value = content
+        self.mdx_include_content_cache_local_heads = ContentCache(config['content_cache_local_max_entries'][0],
+                                                                  config['content_cache_local_max_bytes'][0],
+                                                                  config['content_cache_local_validate'][0]) # key = file_path, value = leading lines
+        self.mdx_include_listing_cache = ContentCache(config['content_cache_local_max_entries'][0], 0,
+                                                      config['content_cache_local_validate'][0]) # key = directory, value = entries
         self.content_cache_local = config['content_cache_local'][0]
         self.content_cache_remote = config['content_cache_remote'][0]
         self.content_cache_clean_local = config['content_cache_clean_local'][0]
         self.content_cache_clean_remote = config['content_cache_clean_remote'][0]
+        self.partial_read = config['partial_read'][0]
+        self.streaming = config['streaming'][0]
+        self.compact_lines = config['compact_lines'][0]
+        self.expanded_cache = config['expanded_cache'][0] and not self.streaming
+        self.mdx_include_expanded_cache = {} # key = (kind, path, slice, encoding, recursive_relative_path), value = (content, dependencies, relations)
+        self.expansion_frames = []
+        self.expanded_cache_validated = {} # key = (kind, path), value = raw content validated in the current run
+        self.relations = {} # key = child, value = set of direct parents, for the last run
+        self.document = None
+        self.dependency_graph = DependencyGraph()
         self.allow_circular_inclusion = config['allow_circular_inclusion'][0]
         self.line_slice_separator = config['line_slice_separator'][0]
         self.recursive_relative_path = config['recursive_relative_path'][0]
+        self.resolved_paths = {} # key = (path, parent directory), value = (kind, filename)
+        self.resolved_paths_config = None # the config the resolved paths were computed with
+        self.allow_glob = config['allow_glob'][0]
+        self.glob_separator = config['glob_separator'][0]
+        self.glob_workers = config['glob_workers'][0]
+        self.marker = get_literal_prefix(config['syntax_left'][0]) # every include contains this, '' if unknown
+        self.remote_timeout = config['remote_timeout'][0]
+        self.remote_disk_cache = None
+        if config['remote_cache_dir'][0]:
+            from .remote import RemoteDiskCache
+            self.remote_disk_cache = RemoteDiskCache(config['remote_cache_dir'][0])
+        self.remote_cache_ttl = config['remote_cache_ttl'][0]
+        self.remote_offline = config['remote_offline'][0]
+        self.remote_keep_alive = config['remote_keep_alive'][0]
+        self.remote_max_size = config['remote_max_size'][0]
+        self.remote_prefetch = config['remote_prefetch'][0]
+        self.remote_prefetch_workers = config['remote_prefetch_workers'][0]
+        self.remote_prefetch_per_host = config['remote_prefetch_per_host'][0]
+        self.remote_prefetched = {} # key = (url, encoding), value = (content, status), lives for one run
+        self.content_store = config['content_store'][0]
+        self.metrics_callback = config['metrics_callback'][0]
+        self.metrics_enabled = config['metrics'][0] or self.metrics_callback is not None
+        self.metrics = None # IncludeMetrics of the last run
+        self.max_depth = config['max_depth'][0]
+        self.max_included_bytes = config['max_included_bytes'][0]
+        self.max_includes = config['max_includes'][0]
+        self.deadline = config['deadline'][0]
+        self.budget_policy = config['budget_policy'][0]
+        if self.budget_policy not in BUDGET_POLICIES:
+            raise ValueError("E: Unknown budget_policy (%s), expected one of: %s" % (self.budget_policy, ', '.join(BUDGET_POLICIES)))
+        self.budget_enabled = bool(self.max_depth or self.max_included_bytes or self.max_includes or self.deadline)
+        self.budget = None # IncludeBudget of the last run
+        self.watcher = None # mdx_include.watch.IncludeWatcher, see mdx_include_watch()
+        self.render_cache = None
+        self.render_deps = None # key = (kind, path, encoding), value = raw content, for the render in progress
+        self.render_cacheable = True
+        self.render_fingerprints = {} # key = (kind, path, encoding, count), value = (content, fingerprint)
+        if config['render_cache'][0]:
+            from .render import RenderCache, get_value_repr
+            self.render_cache = RenderCache(config['render_cache_max_entries'][0], config['render_cache_dir'][0])
+            # the configs as they are used, they are not read again
+            self.render_configs = ['%s=%s' % (name, get_value_repr(config[name][0])) for name in sorted(config)]
+            self.md_convert = md.convert
+            md.convert = self.mdx_include_render
+        self.mdx_include_negative_cache = NegativeCache(config['negative_cache_ttl'][0]) if config['negative_cache'][0] else None
+        self.async_states = {} # key = event loop, value = aio.LoopState of mdx_include_aconvert() in that loop
 
-        self.row_slice = RowSlice(self.line_slice_separator)
+        self.row_slice = None # rcslice.RowSlice, created on first use
+        self.cyclic = None # cyclic.Cyclic of the current run, created on first use
 
 
     def mdx_include_content_cache_clean_local(self):
         """Clean the cache dict for local files """
-        self.mdx_include_content_cache_local = {}
+        self.mdx_include_content_cache_local.clear()
+        self.mdx_include_content_cache_local_heads.clear()
+        self.mdx_include_listing_cache.clear()
+        self.mdx_include_expanded_cache.clear()
+        self.render_fingerprints = {}
+        if self.mdx_include_negative_cache is not None:
+            self.mdx_include_negative_cache.clear('local')
+
+    def mdx_include_content_cache_evict_local(self, paths):
+        """Drop local files or directories from the content caches"""
+        for path in paths:
+            self.mdx_include_content_cache_local.pop(path, None)
+            self.mdx_include_content_cache_local_heads.pop(path, None)
+            self.mdx_include_listing_cache.pop(path, None)
 
     def mdx_include_content_cache_clean_remote(self):
         """Clean the cache dict for remote files """
         self.mdx_include_content_cache_remote = {}
+        self.mdx_include_expanded_cache.clear()
+        self.render_fingerprints = {}
+        if self.mdx_include_negative_cache is not None:
+            self.mdx_include_negative_cache.clear('remote')
 
     def mdx_include_get_content_cache_local(self):
         """Get the cache dict for local files """
@@ -188,6 +742,64 @@ class IncludePreprocessor(markdown.preprocessors.Preprocessor):
         """Get the cache dict for remote files """
         return self.mdx_include_content_cache_remote
 
+    def mdx_include_set_document(self, document):
+        """Set the name under which the dependencies of the next conversions are
+        recorded in the dependency graph, None stops recording."""
+        self.document = document
+
+    def mdx_include_get_dependencies(self):
+        """Get the sorted list of files/URLs the last converted document depends on"""
+        return sorted(self.relations)
+
+    def mdx_include_get_dependency_graph(self):
+        """Get the DependencyGraph of the documents converted with a document name"""
+        return self.dependency_graph
+
+    def mdx_include_get_metrics(self):
+        """Get the IncludeMetrics of the last conversion, None if metrics are not enabled"""
+        return self.metrics
+
+    def mdx_include_get_budget(self):
+        """Get the IncludeBudget (limits and usage) of the last conversion, None if no budget is set"""
+        return self.budget
+
+    def mdx_include_get_render_cache(self):
+        """Get the RenderCache, None if render_cache is False"""
+        return self.render_cache
+
+    def mdx_include_get_connection_pool(self):
+        """Get the ConnectionPool of remote includes, shared by the process"""
+        from .remote import connection_pool
+        return connection_pool
+
+    def mdx_include_count(self, name, value=1):
+        """Add value to a metrics counter if metrics are enabled"""
+        if self.metrics is not None:
+            self.metrics.count(name, value)
+
+    def mdx_include_timed(self, name, func, *args):
+        """Call func(*args), adding the time it takes to a metrics timer if metrics are enabled"""
+        if self.metrics is None:
+            return func(*args)
+        return self.metrics.timed(name, func, *args)
+
+    def mdx_include_watch(self, callback=None, interval=1.0, inotify=True):
+        """Start watching the local files and directories of the content caches and
+        return the IncludeWatcher. On change, their entries are evicted and
+        callback(paths, documents) is called with the changed paths and the sorted
+        documents (see mdx_include_set_document()) depending on them."""
+        from .watch import IncludeWatcher
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.watcher = IncludeWatcher(self, callback, interval, inotify)
+        return self.watcher.start()
+
+    def mdx_include_aconvert(self, text):
+        """Return a coroutine converting text like md.convert(text) without blocking
+        the event loop (python 3.5+)"""
+        from .aio import aconvert
+        return aconvert(self, text)
+
 
     def mdx_include_get_cyclic_safe_processed_line_list(self, textl, filename, parent):
         """Returns recursive text list if cyclic inclusion not detected,
@@ -195,7 +807,7 @@ class IncludePreprocessor(markdown.preprocessors.Preprocessor):
         otherwise throws exception.
 
         """
-        if not self.cyclic.is_cyclic(filename):
+        if not self.mdx_include_is_cyclic(filename):
             textl = self.mdx_include_get_processed_lines(textl, filename)
         else:
             if self.allow_circular_inclusion:
@@ -204,155 +816,1099 @@ class IncludePreprocessor(markdown.preprocessors.Preprocessor):
                 raise RuntimeError("Circular inclusion not allowed; detected in file: " + parent + " when including " + filename + " whose parents are: " + str(self.cyclic.root[filename]))
         return textl
 
+    def mdx_include_store_get(self, kind, filename, signature=None):
+        """Get content from the shared content store or None.
+
+        Local content stored with a signature is only served if it matches the
+        current signature of the file.
+        """
+        try:
+            from .store import get_key
+            entry = self.content_store.get(get_key(kind, filename))
+        except Exception:
+            log.exception("E: Failed to read the content store for: " + filename)
+            return None
+        if entry is None:
+            return None
+        textl, stored_signature = entry
+        if kind == 'local' and stored_signature is not None and stored_signature != signature:
+            return None
+        return textl
+
+    def mdx_include_store_set(self, kind, filename, textl, signature=None):
+        """Put content into the shared content store unless it is read-only"""
+        if self.content_store is None or self.content_store.readonly:
+            return
+        try:
+            from .store import get_key
+            self.content_store.set(get_key(kind, filename), textl, signature)
+        except Exception:
+            log.exception("E: Failed to write the content store for: " + filename)
+
+    def mdx_include_get_cached_remote(self, filename):
+        """Get remote content from the content cache or the content store, None if not cached"""
+        if not self.content_cache_remote:
+            return None
+        cache = self.mdx_include_content_cache_remote
+        if filename in cache:
+            return cache[filename]
+        if self.content_store is not None:
+            textl = self.mdx_include_store_get('remote', filename)
+            if textl is not None:
+                textl = self.mdx_include_compact(textl)
+                cache[filename] = textl
+                return textl
+        return None
+
+    def mdx_include_compact(self, textl):
+        """Return textl as a LineBuffer if compact_lines is enabled"""
+        if self.compact_lines:
+            return LineBuffer.from_lines(textl)
+        return textl
+
+    def mdx_include_is_failed(self, kind, filename, encoding):
+        """Return whether the include failed recently (see negative_cache_ttl)"""
+        return self.mdx_include_negative_cache is not None and (kind, filename, encoding) in self.mdx_include_negative_cache
+
+    def mdx_include_add_failure(self, kind, filename, encoding):
+        """Remember a failed include"""
+        if self.mdx_include_negative_cache is not None:
+            self.mdx_include_negative_cache.add((kind, filename, encoding))
+
     def get_remote_content_list(self, filename, encoding='utf-8'):
         """Get remote content list from cache or by download"""
-        if self.content_cache_remote and filename in self.mdx_include_content_cache_remote:
-            textl = self.mdx_include_content_cache_remote[filename]
+        textl = self.mdx_include_get_cached_remote(filename)
+        if textl is not None:
+            self.mdx_include_count('remote_cache_hits')
             stat = True
+        elif self.mdx_include_is_failed('remote', filename, encoding):
+            self.mdx_include_count('negative_cache_hits')
+            textl, stat = [], False
         else:
-            textl, stat = get_remote_content_list(filename, encoding)
+            if self.content_cache_remote:
+                self.mdx_include_count('remote_cache_misses')
+            if (filename, encoding) in self.remote_prefetched:
+                textl, stat = self.remote_prefetched[(filename, encoding)]
+            else:
+                textl, stat = self.mdx_include_download(filename, encoding)
             if stat and self.content_cache_remote:
+                textl = self.mdx_include_compact(textl)
                 self.mdx_include_content_cache_remote[filename] = textl
+                self.mdx_include_store_set('remote', filename, textl)
+            if not stat:
+                self.mdx_include_add_failure('remote', filename, encoding)
+        return textl, stat
+
+    def mdx_include_download(self, filename, encoding):
+        """Download remote content for the run in progress, within its deadline if any"""
+        timeout = self.remote_timeout
+        remaining = self.budget.get_remaining() if self.budget is not None else None
+        deadline = None
+        if remaining is not None:
+            # the download must end by the deadline
+            timeout = max(min(timeout, remaining) if timeout else remaining, 0.001)
+            deadline = time.time() + max(remaining, 0.001)
+        return self.mdx_include_fetch(filename, encoding, timeout, self.metrics, deadline)
+
+    def mdx_include_fetch(self, filename, encoding, timeout, metrics=None, deadline=None):
+        """Download remote content using the persistent cache, counted in metrics (IncludeMetrics or None),
+        by deadline (a time.time() value) if it is not None.
+        Concurrent downloads of the same URL with the same settings share one request."""
+        # deadline is left out of the key like the rest of the budget, timeout already tracks it
+        key = ('remote', filename, encoding, timeout, self.remote_disk_cache.directory if self.remote_disk_cache else None,
+               self.remote_cache_ttl, self.remote_offline, self.remote_max_size, self.remote_keep_alive)
+        args = (key, get_remote_content_list, filename, encoding, timeout, self.remote_disk_cache, self.remote_cache_ttl,
+                self.remote_offline, self.remote_max_size, self.remote_keep_alive, deadline)
+        if metrics is None:
+            return flights.do(*args)
+        textl, stat = metrics.timed('download_time', flights.do, *args)
+        metrics.count('downloads')
+        metrics.count('bytes_downloaded', get_content_size(textl))
         return textl, stat
 
     def get_local_content_list(self, filename, encoding):
         """Get local content list from cache or by reading the file"""
-        if self.content_cache_local and filename in self.mdx_include_content_cache_local:
-            textl = self.mdx_include_content_cache_local[filename]
-            stat = True
-        else:
-            textl, stat = get_local_content_list(filename, encoding)
-            if stat and self.content_cache_local:
-                self.mdx_include_content_cache_local[filename] = textl
+        cache = self.mdx_include_content_cache_local
+        if self.content_cache_local:
+            textl = cache.lookup(filename)
+            if textl is not None:
+                self.mdx_include_count('local_cache_hits')
+                return textl, True
+            self.mdx_include_count('local_cache_misses')
+            # stat before reading, a change in between will be detected on the next lookup
+            signature = get_file_signature(filename) if cache.validate or self.content_store is not None else None
+            textl = self.mdx_include_store_get('local', filename, signature) if self.content_store is not None else None
+            if textl is not None:
+                self.mdx_include_count('store_hits')
+                textl = self.mdx_include_compact(textl)
+                cache.store(filename, textl, signature)
+                self.mdx_include_content_cache_local_heads.pop(filename, None)
+                return textl, True
+        if self.mdx_include_is_failed('local', filename, encoding):
+            self.mdx_include_count('negative_cache_hits')
+            return [], False
+        textl, stat = self.mdx_include_timed('read_time', flights.do, ('local', filename, encoding), get_local_content_list, filename, encoding)
+        if self.metrics is not None:
+            self.metrics.count('reads')
+            self.metrics.count('bytes_read', get_content_size(textl))
+        if not stat:
+            self.mdx_include_add_failure('local', filename, encoding)
+        if stat and self.content_cache_local:
+            textl = self.mdx_include_compact(textl)
+            cache.store(filename, textl, signature)
+            self.mdx_include_content_cache_local_heads.pop(filename, None)
+            self.mdx_include_store_set('local', filename, textl, signature)
         return textl, stat
 
-    def get_recursive_content_list(self, textl, filename, parent, recursive, recurse_state):
+    def get_local_content_head(self, filename, encoding, count):
+        """Get at least the first count lines of a local file from cache or by reading
+        only the needed part of the file. Returns (content, status, whole) where whole
+        tells whether the content is the whole file (from the content cache).
+        """
+        cache = self.mdx_include_content_cache_local
+        heads = self.mdx_include_content_cache_local_heads
+        if self.content_cache_local:
+            textl = cache.lookup(filename)
+            if textl is not None:
+                self.mdx_include_count('local_cache_hits')
+                return textl, True, True
+            textl = heads.lookup(filename)
+            if textl is not None and len(textl) >= count:
+                self.mdx_include_count('local_cache_hits')
+                return textl, True, False
+            if textl is not None:
+                # grow the head geometrically, slices further down the file would read it again otherwise
+                count = max(count, 2 * len(textl))
+            self.mdx_include_count('local_cache_misses')
+            signature = get_file_signature(filename) if cache.validate or self.content_store is not None else None
+            textl = self.mdx_include_store_get('local', filename, signature) if self.content_store is not None else None
+            if textl is not None:
+                # the store only keeps whole files
+                self.mdx_include_count('store_hits')
+                textl = self.mdx_include_compact(textl)
+                cache.store(filename, textl, signature)
+                heads.pop(filename, None)
+                return textl, True, True
+        if self.mdx_include_is_failed('local', filename, encoding):
+            self.mdx_include_count('negative_cache_hits')
+            return [], False, True
+        textl, complete, stat = self.mdx_include_timed('read_time', get_local_content_head, filename, encoding, count)
+        if self.metrics is not None:
+            self.metrics.count('reads')
+            self.metrics.count('bytes_read', get_content_size(textl))
+        if not stat:
+            self.mdx_include_add_failure('local', filename, encoding)
+        if stat and self.content_cache_local:
+            textl = self.mdx_include_compact(textl)
+            if complete:
+                cache.store(filename, textl, signature)
+                heads.pop(filename, None)
+                self.mdx_include_store_set('local', filename, textl, signature)
+            else:
+                heads.store(filename, textl, signature)
+        return textl, stat, complete
+
+    def mdx_include_is_recursive(self, recursive, recurse_state):
+        """Return whether an include is to be processed recursively"""
         if recursive:
-            if recurse_state != self.syntax_recurs_off:
-                textl = self.mdx_include_get_cyclic_safe_processed_line_list(textl, filename, parent)
+            return recurse_state != self.syntax_recurs_off
         elif recursive is None:
             # it's in a neutral position, check recursive state
-            if recurse_state == self.syntax_recurs_on:
-                textl = self.mdx_include_get_cyclic_safe_processed_line_list(textl, filename, parent)
+            return recurse_state == self.syntax_recurs_on
+        return False
+
+    def get_recursive_content_list(self, textl, filename, parent, recursive, recurse_state):
+        if self.mdx_include_is_recursive(recursive, recurse_state):
+            textl = self.mdx_include_get_cyclic_safe_processed_line_list(textl, filename, parent)
+        return textl
+
+    def mdx_include_get_encoding(self, encoding, warn=True):
+        """Return the encoding if it exists, otherwise the default encoding"""
+        if not encoding_exists(encoding):
+            if encoding and warn:
+                log.warning("W: Encoding (%s) not recognized . Falling back to: %s" % (encoding, self.encoding,))
+            encoding = self.encoding
+        return encoding
+
+    def mdx_include_resolve_path(self, path, parent):
+        """Return (kind, filename) for an include path where kind is 'remote', 'local'
+        or None if including the path is not allowed.
+
+        Results are memoized by path and parent directory, the memo is dropped when
+        a setting used to resolve paths is changed.
+        """
+        config = (self.base_path, self.allow_local, self.allow_remote, self.recursive_relative_path)
+        if config != self.resolved_paths_config:
+            self.resolved_paths = {}
+            self.resolved_paths_config = config
+        key = (path, os.path.dirname(parent) if self.recursive_relative_path and parent else None)
+        try:
+            return self.resolved_paths[key]
+        except KeyError:
+            pass
+        if len(self.resolved_paths) >= RESOLVED_PATHS_MAX_ENTRIES:
+            self.resolved_paths.clear()
+        resolved = self.resolved_paths[key] = self.mdx_include_get_resolved_path(path, parent)
+        return resolved
+
+    def mdx_include_get_resolved_path(self, path, parent):
+        """Resolve an include path without memoization, see mdx_include_resolve_path()"""
+        filename = os.path.expanduser(path)
+        urlo = urlparse(filename)
+        if urlo.netloc:
+            # remote url
+            if self.allow_remote:
+                return 'remote', urlunparse(urlo).rstrip('/')
+        elif self.allow_local:
+            # local file
+            if not os.path.isabs(filename):
+                if self.recursive_relative_path and parent:
+                    filename = os.path.normpath(os.path.join(os.path.dirname(parent), filename))
+                else:
+                    filename = os.path.normpath(os.path.join(self.base_path, filename))
+            return 'local', filename
+        return None, filename
+
+    def mdx_include_get_glob_pattern(self, kind, path, filename):
+        """Return the glob pattern of an include path with wildcards or ending with a path
+        separator (all the files of the directory), None for other paths.
+
+        filename is the path as resolved by mdx_include_resolve_path().
+        """
+        if kind != 'local' or not self.allow_glob:
+            return None
+        if path.endswith('/') or path.endswith(os.sep):
+            return os.path.join(filename, '*')
+        if has_glob_magic(path):
+            return filename
+        return None
+
+    def mdx_include_list_dir(self, dirname):
+        """Return the entries of a directory (see get_dir_entries()) from the listing cache
+        or by listing it, recording them for the expanded cache"""
+        cache = self.mdx_include_listing_cache
+        signature = None
+        entries = None
+        if self.content_cache_local:
+            entries = cache.lookup(dirname)
+            if entries is None:
+                # stat before listing, a change in between will be detected on the next lookup
+                signature = get_file_signature(dirname) if cache.validate else None
+        if entries is None:
+            entries = get_dir_entries(dirname)
+            if entries is not None and self.content_cache_local:
+                cache.store(dirname, entries, signature)
+        if self.expansion_frames:
+            frame = self.expansion_frames[-1]
+            if entries is not None and self.content_cache_local:
+                self.mdx_include_add_dependencies(frame, {('listing', dirname, None): entries})
+            else:
+                frame['cacheable'] = False
+        if self.render_deps is not None:
+            if entries is not None:
+                self.render_deps[('listing', dirname, None)] = entries
+            else:
+                self.render_cacheable = False
+        return entries
+
+    def mdx_include_glob(self, pattern):
+        """Return (filenames, directories) where filenames are the files matching a glob
+        pattern, sorted by name, and directories are the directories listed to find them.
+
+        Wildcards can be used in any path component. Names starting with a dot are
+        matched only by a pattern component starting with a dot.
+        """
+        import fnmatch
+        drive, path = os.path.splitdrive(pattern)
+        parts = path.split(os.sep)
+        i = 0
+        while i < len(parts) and not has_glob_magic(parts[i]):
+            i = i + 1
+        base = os.sep.join(parts[:i])
+        if not base and path.startswith(os.sep):
+            base = os.sep
+        candidates = [drive + base]
+        directories = []
+        for j in range(i, len(parts)):
+            part = parts[j]
+            last = j == len(parts) - 1
+            matches = []
+            for dirname in candidates:
+                if not has_glob_magic(part):
+                    matches.append(os.path.join(dirname, part) if dirname else part)
+                    continue
+                listed = dirname or os.curdir
+                entries = self.mdx_include_list_dir(listed)
+                if entries is None:
+                    continue
+                directories.append(listed)
+                for entry in entries:
+                    isdir = entry.endswith('/')
+                    if isdir == last:
+                        # files for the last component, directories for the others
+                        continue
+                    name = entry[:-1] if isdir else entry
+                    if name.startswith('.') and not part.startswith('.'):
+                        continue
+                    if fnmatch.fnmatch(name, part):
+                        matches.append(os.path.join(dirname, name) if dirname else name)
+            candidates = matches
+        if not has_glob_magic(parts[-1]):
+            # the last component was not listed
+            candidates = [filename for filename in candidates if os.path.isfile(filename)]
+        return candidates, directories
+
+    def mdx_include_read_local_files(self, filenames, encoding):
+        """Read the files that are not in the local content cache in parallel (at most
+        glob_workers at a time) and store them in the content cache"""
+        cache = self.mdx_include_content_cache_local
+        if not self.content_cache_local:
+            return
+        filenames = [filename for filename in filenames if filename not in cache and not self.mdx_include_is_failed('local', filename, encoding)]
+        if len(filenames) < 2 or self.glob_workers < 2:
+            return
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            # python 2 without the futures backport, the files are read one by one
+            return
+        validate = cache.validate or self.content_store is not None
+        def read(filename):
+            signature = get_file_signature(filename) if validate else None
+            textl, stat = flights.do(('local', filename, encoding), get_local_content_list, filename, encoding)
+            return textl, stat, signature
+        def read_all():
+            with ThreadPoolExecutor(max_workers=min(len(filenames), self.glob_workers)) as executor:
+                return list(executor.map(read, filenames))
+        results = self.mdx_include_timed('read_time', read_all)
+        for filename, (textl, stat, signature) in zip(filenames, results):
+            if self.metrics is not None:
+                self.metrics.count('reads')
+                self.metrics.count('bytes_read', get_content_size(textl))
+            if not stat:
+                self.mdx_include_add_failure('local', filename, encoding)
+                continue
+            textl = self.mdx_include_compact(textl)
+            cache.store(filename, textl, signature)
+            self.mdx_include_content_cache_local_heads.pop(filename, None)
+            self.mdx_include_store_set('local', filename, textl, signature)
+
+    def mdx_include_get_glob_content(self, pattern, encoding, file_lines, parent, recurse_state):
+        """Return the contents of the files matching a glob pattern separated by glob_separator, with status.
+
+        Each file is included like a single file include (slicing, recursion and circular
+        inclusion check). The status is False if no file could be included.
+        """
+        filenames, directories = self.mdx_include_glob(pattern)
+        for directory in directories:
+            # a new file in the directory changes the output
+            self.mdx_include_cyclic_add(directory, parent)
+        if not filenames:
+            log.warning("W: No file matches: " + pattern)
+            return [], False
+        if not (self.streaming and not file_lines) and not (self.partial_read and file_lines and get_slice_line_count(file_lines) is not None):
+            # the rest is read in parallel, partial reads and streaming read the files as they go
+            self.mdx_include_read_local_files(filenames, encoding)
+        textl = []
+        stat = False
+        for filename in filenames:
+            self.mdx_include_cyclic_add(filename, parent)
+            span = self.metrics.start_span('local', filename, parent) if self.metrics is not None else None
+            file_stat = False
+            try:
+                content, file_stat = self.mdx_include_get_content('local', filename, encoding, file_lines, parent, recurse_state)
+            finally:
+                if span is not None:
+                    self.metrics.end_span(span, file_stat)
+            if not file_stat:
+                continue
+            if stat:
+                textl.extend(self.glob_separator)
+            textl.extend(content)
+            stat = True
+        return textl, stat
+
+    def mdx_include_iter_includes(self, lines, parent):
+        """Yield (kind, filename, encoding, file_lines, recursive) for each allowed include in lines"""
+        marker = self.marker
+        for line in lines:
+            if marker and marker not in line:
+                continue
+            for m in self.include_finder.finditer(line):
+                d = m.groupdict()
+                if d.get('escape'):
+                    continue
+                kind, filename = self.mdx_include_resolve_path(d.get('path'), parent)
+                if kind is None:
+                    continue
+                recursive = self.mdx_include_is_recursive(self.recursive_remote if kind == 'remote' else self.recursive_local, d.get('recursive'))
+                encoding = self.mdx_include_get_encoding(d.get('encoding'), warn=False)
+                pattern = self.mdx_include_get_glob_pattern(kind, d.get('path'), filename)
+                filenames = self.mdx_include_glob(pattern)[0] if pattern is not None else [filename]
+                for filename in filenames:
+                    yield kind, filename, encoding, d.get('lines'), recursive
+
+    def mdx_include_prefetch_slice(self, textl, file_lines):
+        """Slice the content for prefetch scanning, errors are left to the processing pass"""
+        if file_lines:
+            try:
+                textl = self.mdx_include_slice(textl, file_lines)
+            except ValueError:
+                textl = []
+        return textl
+
+    def mdx_include_prefetch_remote(self, lines):
+        """Download the remote includes found in lines in parallel.
+
+        Recursive includes are followed one level at a time. The results are kept
+        in self.remote_prefetched which is used by get_remote_content_list() in place
+        of downloading, thus the processing pass gives the same output as sequential mode.
+        """
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            # python 2 without the futures backport, fall back to sequential downloads
+            return
+        import threading
+        semaphores = {}
+        def download(url, encoding):
+            with semaphores[urlparse(url).netloc]:
+                return self.mdx_include_download(url, encoding)
+        seen = set()
+        level = [(lines, '')]
+        with ThreadPoolExecutor(max_workers=max(1, self.remote_prefetch_workers)) as executor:
+            while level:
+                downloads = OrderedDict() # key = url, value = list of encodings
+                recursive_remote = []
+                next_level = []
+                for textl, parent in level:
+                    for kind, filename, encoding, file_lines, recursive in self.mdx_include_iter_includes(textl, parent):
+                        key = (kind, filename, encoding, file_lines)
+                        if kind == 'remote':
+                            if (filename, encoding) not in self.remote_prefetched and self.mdx_include_get_cached_remote(filename) is None \
+                                    and not self.mdx_include_is_failed('remote', filename, encoding):
+                                encodings = downloads.setdefault(filename, [])
+                                if encoding not in encodings:
+                                    encodings.append(encoding)
+                            if recursive and key not in seen:
+                                seen.add(key)
+                                recursive_remote.append(key)
+                        elif recursive and self.content_cache_local and key not in seen:
+                            # local files may include remote files too
+                            seen.add(key)
+                            content, stat = self.get_local_content_list(filename, encoding)
+                            next_level.append((self.mdx_include_prefetch_slice(content, file_lines), filename))
+                futures = []
+                for url in interleave_by_host(downloads):
+                    host = urlparse(url).netloc
+                    if host not in semaphores:
+                        semaphores[host] = threading.BoundedSemaphore(max(1, self.remote_prefetch_per_host))
+                    for encoding in downloads[url]:
+                        futures.append(((url, encoding), executor.submit(download, url, encoding)))
+                for key, future in futures:
+                    self.remote_prefetched[key] = future.result()
+                for kind, filename, encoding, file_lines in recursive_remote:
+                    if self.content_cache_remote and filename in self.mdx_include_content_cache_remote:
+                        content = self.mdx_include_content_cache_remote[filename]
+                    else:
+                        content = self.remote_prefetched.get((filename, encoding), ([], False))[0]
+                    next_level.append((self.mdx_include_prefetch_slice(content, file_lines), filename))
+                level = next_level
+
+    def mdx_include_warm_cache(self, lines):
+        """Read the includes found in lines (recursively as configured) into the content caches
+        without processing them. Missing local files are skipped silently. Remote includes are
+        downloaded in parallel like with remote_prefetch.
+        """
+        if self.allow_remote:
+            self.mdx_include_prefetch_remote(lines)
+        try:
+            self.mdx_include_warm_cache_levels(lines)
+        finally:
+            self.remote_prefetched = {}
+
+    def mdx_include_warm_cache_levels(self, lines):
+        seen = set()
+        level = [(lines, '')]
+        while level:
+            next_level = []
+            for textl, parent in level:
+                for kind, filename, encoding, file_lines, recursive in self.mdx_include_iter_includes(textl, parent):
+                    key = (kind, filename, encoding, file_lines)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    if kind == 'remote':
+                        content, stat = self.get_remote_content_list(filename, encoding)
+                    elif os.path.isfile(filename):
+                        content, stat = self.get_local_content_list(filename, encoding)
+                    else:
+                        continue
+                    if stat and recursive:
+                        next_level.append((self.mdx_include_prefetch_slice(content, file_lines), filename))
+            level = next_level
+
+    def mdx_include_slice(self, textl, file_lines):
+        """Slice the content with the line slice syntax, rcslice is imported on first use"""
+        if self.row_slice is None:
+            from rcslice import RowSlice
+            self.row_slice = RowSlice(self.line_slice_separator)
+        return self.row_slice.slice(textl, file_lines)
+
+    def mdx_include_cyclic_add(self, child, parent):
+        """Push the child parent relation, recording it for the expanded cache"""
+        if self.cyclic is None:
+            # cyclic is imported on first use
+            from cyclic import Cyclic
+            self.cyclic = Cyclic()
+        self.cyclic.add(child, parent)
+        self.relations.setdefault(child, set()).add(parent)
+        if self.expansion_frames:
+            self.expansion_frames[-1]['ops'].append((child, parent))
+
+    def mdx_include_is_cyclic(self, filename):
+        """Check for cyclic inclusion, recording the answer for the expanded cache"""
+        cyclic = self.cyclic.is_cyclic(filename)
+        if self.expansion_frames:
+            self.expansion_frames[-1]['ops'].append((filename, cyclic))
+        return cyclic
+
+    def mdx_include_get_raw_content(self, kind, filename, encoding, file_lines=None):
+        """Get the raw content from cache, file or URL, recording it for the expanded cache"""
+        if self.streaming and kind == 'local' and not file_lines:
+            # slicing needs the whole content, otherwise the file is read lazily
+            self.render_cacheable = False
+            return get_local_content_iter(filename, encoding)
+        count = get_slice_line_count(file_lines) if self.partial_read and kind == 'local' and file_lines else None
+        if count is not None:
+            textl, stat, whole = self.get_local_content_head(filename, encoding, count)
+            if not whole:
+                kind = 'local_head'
+            cached = self.content_cache_local
+        elif kind == 'remote':
+            textl, stat = self.get_remote_content_list(filename, encoding)
+            cached = self.content_cache_remote
+        else:
+            textl, stat = self.get_local_content_list(filename, encoding)
+            cached = self.content_cache_local
+        if self.expansion_frames:
+            frame = self.expansion_frames[-1]
+            if stat and cached:
+                self.mdx_include_add_dependencies(frame, {(kind, filename, encoding): textl})
+            else:
+                # failures and uncached content can not be validated later
+                frame['cacheable'] = False
+        if self.render_deps is not None:
+            if stat:
+                self.render_deps[(kind, filename, encoding)] = textl
+            else:
+                # a missing file or URL may be there next time
+                self.render_cacheable = False
+        return textl, stat
+
+    def mdx_include_get_content(self, kind, filename, encoding, file_lines, parent, recurse_state):
+        """Return the content of an include with status, sliced and recursively processed as needed.
+
+        Recursively processed content is kept in the expanded cache keyed by
+        (kind, path, slice, encoding, recursive_relative_path). An entry is reused only
+        if the raw content of all of its dependencies is still the same (same object in
+        the content caches) and replaying its child parent relations in the current
+        context gives the same circular inclusion answers.
+
+        With a budget, raises IncludeBudgetExceeded if the include exceeds it.
+        """
+        recursive = self.mdx_include_is_recursive(self.recursive_remote if kind == 'remote' else self.recursive_local, recurse_state)
+        budget = self.budget
+        if budget is not None:
+            depth = budget.enter(filename)
+            if self.expansion_frames:
+                frame = self.expansion_frames[-1]
+                frame['depth'] = max(frame['depth'], depth)
+        key = None
+        if recursive and self.expanded_cache:
+            key = (kind, filename, file_lines, encoding, self.recursive_relative_path)
+            textl = self.mdx_include_expanded_cache_lookup(key, depth if budget is not None else 0)
+            if textl is not None:
+                if self.metrics is not None:
+                    self.metrics.count('expanded_cache_hits')
+                    if self.metrics.stack:
+                        self.metrics.stack[-1].cached = True
+                return textl, True
+            self.mdx_include_count('expanded_cache_misses')
+            frame = {'deps': {}, 'ops': [], 'cacheable': True}
+            if budget is not None:
+                # the usage of the processing is kept with the processed content
+                frame['start'] = (budget.includes, budget.bytes, depth)
+                frame['depth'] = depth
+            self.expansion_frames.append(frame)
+        try:
+            textl, stat = self.mdx_include_get_raw_content(kind, filename, encoding, file_lines)
+
+            # if slice sytax is found, slice the content, we must do it before going recursive because we don't
+            # want to be recursive on unnecessary parts of the file.
+            if file_lines:
+                textl = self.mdx_include_timed('slice_time', self.mdx_include_slice, textl, file_lines)
+
+            if budget is not None:
+                budget.check_deadline(filename)
+                if isinstance(textl, (list, LineBuffer)):
+                    budget.add_bytes(get_content_size(textl), filename)
+                else:
+                    textl = self.mdx_include_iter_budgeted_lines(textl, filename)
+        except IncludeBudgetExceeded:
+            if key is not None:
+                self.expansion_frames.pop()
+                if self.expansion_frames:
+                    self.expansion_frames[-1]['cacheable'] = False
+            raise
+
+        # Some files can be included in non-recursive mode, thus the raw content cache only keeps
+        # unprocessed content and the processed content is kept in the expanded cache.
+        if recursive:
+            if budget is not None:
+                # the includes of this occurrence are one level deeper
+                budget.stack.append(depth)
+            try:
+                textl = self.mdx_include_timed('recursion_time', self.mdx_include_get_cyclic_safe_processed_line_list, textl, filename, parent)
+            finally:
+                if budget is not None:
+                    budget.stack.pop()
+            if budget is not None and not isinstance(textl, (list, LineBuffer)):
+                # processed lazily in streaming mode
+                textl = self.mdx_include_iter_at_depth(textl, depth)
+
+        if key is not None:
+            frame = self.expansion_frames.pop()
+            usage = None # (includes, bytes, depth) relative to the include
+            if budget is not None:
+                includes, size, depth = frame['start']
+                usage = (budget.includes - includes, budget.bytes - size, frame['depth'] - depth)
+            if frame['cacheable']:
+                self.mdx_include_expanded_cache[key] = (textl, frame['deps'], frame['ops'], usage)
+            if self.expansion_frames:
+                outer = self.expansion_frames[-1]
+                self.mdx_include_add_dependencies(outer, frame['deps'])
+                outer['ops'].extend(frame['ops'])
+                outer['cacheable'] = outer['cacheable'] and frame['cacheable']
+                if budget is not None:
+                    outer['depth'] = max(outer['depth'], frame['depth'])
+        return textl, stat
+
+    def mdx_include_iter_at_depth(self, lines, depth):
+        """Yield the lines of a lazily processed content with depth as the depth of the file being processed"""
+        stack = self.budget.stack
+        lines = iter(lines)
+        while True:
+            stack.append(depth)
+            try:
+                line = next(lines)
+            except StopIteration:
+                return
+            finally:
+                stack.pop()
+            yield line
+
+    def mdx_include_iter_budgeted_lines(self, lines, filename):
+        """Yield the lines of a lazily read content while they fit in the bytes budget.
+        The content is cut at the line exceeding it, unless budget_policy is 'raise'."""
+        budget = self.budget
+        for line in lines:
+            try:
+                budget.add_bytes(len(line) + 1, filename)
+            except IncludeBudgetExceeded as err:
+                if self.budget_policy == 'raise':
+                    raise
+                log.warning("W: " + str(err) + ", the rest of the file is truncated")
+                return
+            yield line
+
+    def mdx_include_add_dependencies(self, frame, deps):
+        """Merge deps (key = (kind, path, encoding), value = raw content) into an expanded cache frame"""
+        frame_deps = frame['deps']
+        for key, token in deps.items():
+            current = frame_deps.setdefault(key, token)
+            if current is not token:
+                # the content has changed during processing
+                frame['cacheable'] = False
+
+    def mdx_include_expanded_cache_lookup(self, key, depth=0):
+        """Return the processed content for key (an include at depth) from the expanded cache or None if it can not be reused"""
+        entry = self.mdx_include_expanded_cache.get(key)
+        if entry is None:
+            return None
+        textl, deps, ops, usage = entry
+        validated = self.expanded_cache_validated
+        for dep, token in deps.items():
+            if dep in validated and validated[dep] is token:
+                continue
+            kind, filename, encoding = dep
+            if kind == 'remote':
+                current = self.mdx_include_content_cache_remote.get(filename)
+            elif kind == 'listing':
+                current = self.mdx_include_listing_cache.lookup(filename)
+            elif kind == 'local_head':
+                current = self.mdx_include_content_cache_local_heads.lookup(filename)
+            else:
+                current = self.mdx_include_content_cache_local.lookup(filename)
+            if current is not token:
+                # a dependency has changed
+                del self.mdx_include_expanded_cache[key]
+                return None
+            # no need to check it again in this run
+            validated[dep] = token
+        budget = self.budget
+        if budget is not None:
+            depth = depth + (usage[2] if usage is not None else 0)
+            if usage is None or not budget.can_charge(usage[0], usage[1], depth):
+                # processed again, what exceeds the budget is handled include by include
+                return None
+        # replay the child parent relations without touching the real graph
+        root = self.cyclic.root
+        overlay = {}
+        for child, value in ops:
+            if isinstance(value, bool):
+                parents = overlay[child] if child in overlay else root.get(child)
+                cyclic = False
+                if parents is not None:
+                    if child in parents:
+                        cyclic = True
+                    else:
+                        for parent in parents:
+                            grand = overlay[parent] if parent in overlay else root.get(parent)
+                            if grand is not None and child in grand:
+                                cyclic = True
+                                break
+                if cyclic != value:
+                    # circular inclusion check differs in this context
+                    return None
+            else:
+                parent = value
+                parents = set([parent]) if parent else set()
+                current = overlay[child] if child in overlay else root.get(child)
+                if current is not None:
+                    parents.update(current)
+                grand = overlay[parent] if parent in overlay else root.get(parent)
+                if grand is not None:
+                    parents.update(grand)
+                overlay[child] = parents
+        root.update(overlay)
+        for child, value in ops:
+            if not isinstance(value, bool):
+                self.relations.setdefault(child, set()).add(value)
+        if budget is not None:
+            budget.charge(usage[0], usage[1], depth)
+        if self.render_deps is not None:
+            self.render_deps.update(deps)
+        if self.expansion_frames:
+            frame = self.expansion_frames[-1]
+            self.mdx_include_add_dependencies(frame, deps)
+            frame['ops'].extend(ops)
+            if budget is not None:
+                frame['depth'] = max(frame['depth'], depth)
+        return textl
+
+    def mdx_include_get_match_content(self, m, parent):
+        """Return the content to replace an include match with.
+
+        The content is a list of lines, or a lazy iterator of lines in streaming mode.
+        """
+        textl = []
+        stat = True
+        total_match = m.group(0)
+        d = m.groupdict()
+        escape = d.get('escape')
+        if not escape:
+            encoding = self.mdx_include_get_encoding(d.get('encoding'))
+            recurse_state = d.get('recursive')
+            file_lines = d.get('lines')
+            kind, filename = self.mdx_include_resolve_path(d.get('path'), parent)
+            pattern = self.mdx_include_get_glob_pattern(kind, d.get('path'), filename)
+
+            try:
+                if pattern is not None:
+                    # all the matching files, each one processed like a single file include
+                    textl, stat = self.mdx_include_get_glob_content(pattern, encoding, file_lines, parent, recurse_state)
+                elif kind is not None:
+                    # push the child parent relation
+                    self.mdx_include_cyclic_add(filename, parent)
+
+                    # get the content sliced and recursively processed as needed
+                    span = self.metrics.start_span(kind, filename, parent) if self.metrics is not None else None
+                    stat = False
+                    try:
+                        textl, stat = self.mdx_include_get_content(kind, filename, encoding, file_lines, parent, recurse_state)
+                    finally:
+                        if span is not None:
+                            self.metrics.end_span(span, stat)
+                else:
+                    # If allow_remote and allow_local both is false, then status is false
+                    # so that user still have the option to truncate or not, textl is empty now.
+                    stat = False
+            except IncludeBudgetExceeded as err:
+                if self.budget_policy == 'raise':
+                    raise
+                log.warning("W: " + str(err))
+                if self.expansion_frames:
+                    # the output depends on the usage of the run
+                    self.expansion_frames[-1]['cacheable'] = False
+                textl = [total_match] if self.budget_policy == 'keep' else []
+                stat = True
+        else:
+            # this one is escaped, gobble up the escape backslash
+            textl = [total_match[1:]]
+
+        if not stat and not self.truncate_on_failure:
+            # get content failed and user wants to retain the include markdown
+            textl = [total_match]
         return textl
 
     def mdx_include_get_processed_lines(self, lines, parent):
         """Process each line and return the processed lines"""
+        if self.streaming:
+            return self.mdx_include_iter_processed_lines(lines, parent)
+        marker = self.marker
+        if isinstance(lines, LineBuffer) and marker:
+            # only the lines containing the marker are materialized for processing
+            if marker not in lines.text:
+                return lines
+            new_lines = []
+            start = 0
+            for i in lines.find_lines(marker):
+                new_lines.extend(lines[start:i])
+                new_lines.extend(self.mdx_include_get_processed_line(lines[i], parent))
+                start = i + 1
+            new_lines.extend(lines[start:])
+            return new_lines
+        if marker and marker not in '\n'.join(lines):
+            # nothing to include
+            return list(lines)
         new_lines = []
         for line in lines:
-            resll = []
-            c = 0 # current offset
-            ms = self.compiled_re.finditer(line)
-            for m in ms:
-                textl = []
-                stat = True
-                total_match = m.group(0)
-                d = m.groupdict()
-                escape = d.get('escape')
-                apply_indent = d.get('apply_indent')
-                if not escape:
-                    filename = d.get('path')
-                    filename = os.path.expanduser(filename)
-                    encoding = d.get('encoding')
-                    recurse_state = d.get('recursive')
-                    file_lines = d.get('lines')
-                    if not encoding_exists(encoding):
-                        if encoding:
-                            log.warning("W: Encoding (%s) not recognized . Falling back to: %s" % (encoding, self.encoding,))
-                        encoding = self.encoding
-
-                    urlo = urlparse(filename)
-
-                    if urlo.netloc:
-                        # remote url
-                        if self.allow_remote:
-                            filename = urlunparse(urlo).rstrip('/')
-
-                            # push the child parent relation
-                            self.cyclic.add(filename, parent)
-
-                            #get the content split in lines handling cache
-                            textl, stat = self.get_remote_content_list(filename, encoding)
-
-                            # if slice sytax is found, slice the content, we must do it before going recursive because we don't
-                            # want to be recursive on unnecessary parts of the file.
-                            if file_lines:
-                                textl = self.row_slice.slice(textl, file_lines)
-
-                            # We can not cache the whole parsed content after doing all recursive includes
-                            # because some files can be included in non-recursive mode. If we just put the recursive
-                            # content from cache it won't work.
-                            # This if statement must be outside the cache management if statement.
-                            textl = self.get_recursive_content_list(textl, filename, parent, self.recursive_remote, recurse_state)
-                        else:
-                            # If allow_remote and allow_local both is false, then status is false
-                            # so that user still have the option to truncate or not, textl is empty now.
-                            stat = False
-                    elif self.allow_local:
-                        # local file
-                        if not os.path.isabs(filename):
-                            if self.recursive_relative_path and parent:
-                                filename = os.path.normpath(os.path.join(os.path.dirname(parent), filename))
-                            else:
-                                filename = os.path.normpath(os.path.join(self.base_path, filename))
-
-
-                        #push the child parent relation
-                        self.cyclic.add(filename, parent)
-
-                        #get the content split in lines handling cache
-                        textl, stat = self.get_local_content_list(filename, encoding)
-
-                        # if slice sytax is found, slice the content, we must do it before going recursive because we don't
-                        # want to be recursive on unnecessary parts of the file.
-                        if file_lines:
-                            textl = self.row_slice.slice(textl, file_lines)
-
-                        # We can not cache the whole parsed content after doing all recursive includes
-                        # because some files can be included in non-recursive mode. If we just put the recrsive
-                        # content from cache it won't work.
-                        # This if statement must be outside the cache management if statement.
-                        textl = self.get_recursive_content_list(textl, filename, parent, self.recursive_local, recurse_state)
-                    else:
-                        # If allow_remote and allow_local both is false, then status is false
-                        # so that user still have the option to truncate or not, textl is empty now.
-                        stat = False
+            if marker and marker not in line:
+                new_lines.append(line)
+                continue
+            new_lines.extend(self.mdx_include_get_processed_line(line, parent))
+        return new_lines
+
+    def mdx_include_get_processed_line(self, line, parent):
+        """Process the includes of a line and return the resulting lines"""
+        resll = []
+        c = 0 # current offset
+        if self.metrics is None:
+            ms = self.include_finder.finditer(line)
+        else:
+            ms = self.metrics.timed('scan_time', list, self.include_finder.finditer(line))
+        for m in ms:
+            apply_indent = m.group('apply_indent')
+            textl = self.mdx_include_get_match_content(m, parent)
+            s, e = m.span()
+            if textl:
+                #textl has at least one element
+                if resll:
+                    resll[-1] = ''.join([resll[-1], line[c:s], textl[0] ])
+                    resll.extend(textl[1:])
                 else:
-                    # this one is escaped, gobble up the escape backslash
-                    textl = [total_match[1:]]
+                    if apply_indent != '':
+                        resll = [''.join([line[c:s], element]) for element in textl]
+                    else:
+                        resll.append(''.join([line[c:s], textl[0]]))
+                        resll.extend(textl[1:])
+            else:
+                resll.append(line[c:s])
+            # set the current offset to the end offset of this match
+            c = e
+        # All replacements are done, copy the rest of the string
+        if resll:
+            resll[-1] = ''.join([resll[-1], line[c:]])
+        else:
+            resll.append(line[c:])
+        return resll
+
+    def mdx_include_iter_processed_lines(self, lines, parent):
+        """Process each line and yield the processed lines lazily.
 
-                if not stat and not self.truncate_on_failure:
-                    # get content failed and user wants to retain the include markdown
-                    textl = [total_match]
+        This is the streaming counterpart of mdx_include_get_processed_lines(),
+        included content is consumed as it is produced.
+        """
+        marker = self.marker
+        for line in lines:
+            if marker and marker not in line:
+                yield line
+                continue
+            pending = None # the last processed line, text following the include will be appended to it
+            c = 0 # current offset
+            for m in self.include_finder.finditer(line):
+                apply_indent = m.group('apply_indent')
+                textl = iter(self.mdx_include_get_match_content(m, parent))
                 s, e = m.span()
-                if textl:
-                    #textl has at least one element
-                    if resll:
-                        resll[-1] = ''.join([resll[-1], line[c:s], textl[0] ])
-                        resll.extend(textl[1:])
+                first = next(textl, None)
+                if first is not None:
+                    prefix = None
+                    if pending is not None:
+                        pending = ''.join([pending, line[c:s], first])
+                    elif apply_indent != '':
+                        prefix = line[c:s]
+                        pending = ''.join([prefix, first])
                     else:
-                        if apply_indent != '':
-                            resll = [''.join([line[c:s], element]) for element in textl]
-                        else:
-                            resll.append(''.join([line[c:s], textl[0]]))
-                            resll.extend(textl[1:])
+                        pending = ''.join([line[c:s], first])
+                    for element in textl:
+                        yield pending
+                        pending = element if prefix is None else ''.join([prefix, element])
                 else:
-                    resll.append(line[c:s])
+                    if pending is not None:
+                        yield pending
+                    pending = line[c:s]
                 # set the current offset to the end offset of this match
                 c = e
             # All replacements are done, copy the rest of the string
-            if resll:
-                resll[-1] = ''.join([resll[-1], line[c:]])
+            if pending is not None:
+                yield ''.join([pending, line[c:]])
             else:
-                resll.append(line[c:])
-            new_lines.extend(resll)
-        return new_lines
+                yield line[c:]
+
+
+    def mdx_include_render(self, text):
+        """Convert text like md.convert(text), reusing the HTML of a previous conversion
+        of the same text with the same configs while the included content is unchanged"""
+        watcher = self.watcher
+        if watcher is not None:
+            with watcher.lock:
+                return self.mdx_include_render_cached(text)
+        return self.mdx_include_render_cached(text)
 
+    def mdx_include_render_cached(self, text):
+        from .render import get_fingerprint, get_markdown_state
+        cache = self.render_cache
+        key = get_fingerprint(text, self.mdx_include_get_config_fingerprint())
+        entry = cache.get(key)
+        # the reads and downloads validating the entry belong to this conversion
+        self.metrics = IncludeMetrics(self.metrics_callback) if self.metrics_enabled else None
+        self.budget = IncludeBudget(self.max_depth, self.max_included_bytes, self.max_includes, self.deadline) if self.budget_enabled else None
+        try:
+            # entries without the state of the markdown instance are from an older version
+            if entry is not None and 'state' in entry and self.mdx_include_render_is_valid(entry):
+                cache.hits += 1
+                self.relations = dict((child, set(parents)) for child, parents in entry['relations'].items())
+                if self.document is not None:
+                    self.dependency_graph.set(self.document, self.relations)
+                if self.budget is not None:
+                    self.budget.stop()
+                # a copy, the caller may modify md.Meta etc.
+                for name, value in copy.deepcopy(entry['state']).items():
+                    setattr(self.md, name, value)
+                return entry['html']
+            cache.misses += 1
+            html = self.md_convert(text)
+            deps = self.render_deps
+            state = get_markdown_state(self.md)
+            if deps is not None and state is not None and self.render_cacheable and not (self.budget is not None and self.budget.exceeded):
+                cache.set(key, {
+                    'html': html,
+                    'deps': [self.mdx_include_get_render_dependency(dep, textl) for dep, textl in sorted(deps.items(), key=lambda item: item[0][:2])],
+                    'relations': dict((child, sorted(parents)) for child, parents in self.relations.items()),
+                    'state': state,
+                    })
+        finally:
+            self.render_deps = None
+            # set by mdx_include_aconvert() for this conversion only
+            self.remote_prefetched = {}
+        return html
+
+    def mdx_include_get_config_fingerprint(self):
+        """Return the fingerprint of the output format and the extensions with their configs"""
+        from .render import get_fingerprint, get_value_repr
+        md = self.md
+        parts = [getattr(md, 'output_format', ''), str(getattr(md, 'tab_length', ''))] + self.render_configs
+        for ext in md.registeredExtensions:
+            parts.append(ext.__class__.__module__ + '.' + ext.__class__.__name__)
+            configs = ext.getConfigs() if hasattr(ext, 'getConfigs') else {}
+            # objects without a stable repr only match in the same process
+            parts.extend('%s=%s' % (name, get_value_repr(configs[name])) for name in sorted(configs))
+        return get_fingerprint(*parts)
+
+    def mdx_include_get_render_fingerprint(self, kind, path, encoding, textl, count=None):
+        """Return the fingerprint of an included content, memoized for the cached content objects"""
+        from .render import get_content_fingerprint
+        key = (kind, path, encoding, count)
+        memo = self.render_fingerprints.get(key)
+        if memo is not None and memo[0] is textl:
+            return memo[1]
+        fingerprint = get_content_fingerprint(textl, count)
+        if len(self.render_fingerprints) >= RESOLVED_PATHS_MAX_ENTRIES:
+            self.render_fingerprints = {}
+        self.render_fingerprints[key] = (textl, fingerprint)
+        return fingerprint
+
+    def mdx_include_get_render_dependency(self, dep, textl):
+        """Return the render cache dependency (see mdx_include.render.RenderCache) for raw content"""
+        kind, path, encoding = dep
+        count = len(textl) if kind == 'local_head' else None
+        signature = None
+        if kind != 'remote':
+            cache = {'local': self.mdx_include_content_cache_local, 'local_head': self.mdx_include_content_cache_local_heads,
+                     'listing': self.mdx_include_listing_cache}[kind]
+            if OrderedDict.get(cache, path) is textl:
+                # the metadata of the file when the content was read
+                signature = cache.signatures.get(path)
+        return [kind, path, encoding, list(signature) if signature is not None else None, count,
+                self.mdx_include_get_render_fingerprint(kind, path, encoding, textl, count)]
+
+    def mdx_include_render_is_valid(self, entry):
+        """Return whether the dependencies of a render cache entry are unchanged"""
+        for kind, path, encoding, signature, count, fingerprint in entry['deps']:
+            if signature is not None and get_file_signature(path) == tuple(signature):
+                continue
+            if kind == 'remote':
+                textl, stat = self.get_remote_content_list(path, encoding)
+            elif kind == 'listing':
+                textl = self.mdx_include_list_dir(path)
+                stat = textl is not None
+            elif kind == 'local_head':
+                textl, stat, whole = self.get_local_content_head(path, encoding, count)
+            else:
+                textl, stat = self.get_local_content_list(path, encoding)
+            if not stat or self.mdx_include_get_render_fingerprint(kind, path, encoding, textl, count) != fingerprint:
+                return False
+        return True
 
     def run(self, lines):
         """Process the list of lines provided and return a modified list"""
-        self.cyclic = Cyclic()
-        new_lines = self.mdx_include_get_processed_lines(lines, '')
+        watcher = self.watcher
+        if watcher is not None:
+            # not while the watcher evicts changed files
+            with watcher.lock:
+                return self.mdx_include_run(lines)
+        return self.mdx_include_run(lines)
+
+    def mdx_include_run(self, lines):
+        self.cyclic = None
+        if self.render_cache is not None:
+            self.render_deps = {}
+            self.render_cacheable = True
+        self.expansion_frames = []
+        self.expanded_cache_validated = {}
+        self.relations = {}
+        self.metrics = IncludeMetrics(self.metrics_callback) if self.metrics_enabled else None
+        self.budget = IncludeBudget(self.max_depth, self.max_included_bytes, self.max_includes, self.deadline) if self.budget_enabled else None
+        start = timer()
+        if self.mdx_include_negative_cache is not None:
+            self.mdx_include_negative_cache.start_run()
+        try:
+            if self.remote_prefetch and self.allow_remote:
+                self.mdx_include_prefetch_remote(lines)
+            new_lines = self.mdx_include_get_processed_lines(lines, '')
+            if self.streaming:
+                # Python-Markdown needs a list
+                new_lines = list(new_lines)
+        finally:
+            self.remote_prefetched = {}
+            self.expansion_frames = []
+            if self.budget is not None:
+                self.budget.stop()
+        if self.metrics is not None:
+            self.metrics.total_time = timer() - start
+        if self.document is not None:
+            self.dependency_graph.set(self.document, self.relations)
         if self.content_cache_clean_local:
             self.mdx_include_content_cache_clean_local()
         if self.content_cache_clean_remote:
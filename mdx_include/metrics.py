@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+Include processing metrics for mdx_include
+===========================================
+
+Collected for each conversion when the `metrics` config is True and
+available with md.mdx_include_get_metrics() after md.convert().
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import time
+import threading
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class IncludeSpan(object):
+    """One include: its path, the span of the enclosing include (None at the top
+    level) and the file including it, as recorded in the circular inclusion graph."""
+
+    def __init__(self, id, parent_id, kind, path, parent, depth, start):
+        self.id = id
+        self.parent_id = parent_id
+        self.kind = kind
+        self.path = path
+        self.parent = parent
+        self.depth = depth
+        self.start = start
+        self.end = None
+        self.status = None
+        self.cached = False # served from the expanded cache
+
+    @property
+    def duration(self):
+        return self.end - self.start if self.end is not None else None
+
+    def to_dict(self):
+        d = dict(self.__dict__)
+        d['duration'] = self.duration
+        return d
+
+    def __repr__(self):
+        return "IncludeSpan(id=%r, parent_id=%r, kind=%r, path=%r)" % (self.id, self.parent_id, self.kind, self.path)
+
+
+class IncludeMetrics(object):
+    """Metrics of one run of the include preprocessor.
+
+    Times are in seconds. Downloads done by prefetch threads add up their own
+    time, so download_time can exceed the wall time of the run.
+    """
+
+    counters = ('includes', 'local_includes', 'remote_includes', 'failed_includes',
+                'local_cache_hits', 'local_cache_misses', 'remote_cache_hits', 'remote_cache_misses',
+                'store_hits', 'expanded_cache_hits', 'expanded_cache_misses', 'negative_cache_hits',
+                'reads', 'downloads', 'bytes_read', 'bytes_downloaded', 'max_depth')
+    timers = ('read_time', 'download_time', 'slice_time', 'scan_time', 'recursion_time', 'total_time')
+
+    def __init__(self, callback=None):
+        for name in self.counters:
+            setattr(self, name, 0)
+        for name in self.timers:
+            setattr(self, name, 0.0)
+        self.spans = []
+        self.callback = callback
+        self.stack = [] # open spans
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def timed(self, name, func, *args):
+        """Call func(*args) adding the time it takes to the timer name"""
+        start = timer()
+        try:
+            return func(*args)
+        finally:
+            self.count(name, timer() - start)
+
+    def start_span(self, kind, path, parent):
+        parent_id = self.stack[-1].id if self.stack else None
+        span = IncludeSpan(len(self.spans), parent_id, kind, path, parent, len(self.stack) + 1, timer())
+        self.spans.append(span)
+        self.stack.append(span)
+        self.includes += 1
+        if kind == 'remote':
+            self.remote_includes += 1
+        else:
+            self.local_includes += 1
+        self.max_depth = max(self.max_depth, span.depth)
+        return span
+
+    def end_span(self, span, status):
+        span.end = timer()
+        span.status = status
+        if not status:
+            self.failed_includes += 1
+        self.stack.pop()
+        if self.callback is not None:
+            self.callback(span)
+
+    def get_hit_rate(self, hits, misses):
+        total = hits + misses
+        return float(hits) / total if total else None
+
+    @property
+    def local_cache_hit_rate(self):
+        return self.get_hit_rate(self.local_cache_hits, self.local_cache_misses)
+
+    @property
+    def remote_cache_hit_rate(self):
+        return self.get_hit_rate(self.remote_cache_hits, self.remote_cache_misses)
+
+    @property
+    def expanded_cache_hit_rate(self):
+        return self.get_hit_rate(self.expanded_cache_hits, self.expanded_cache_misses)
+
+    def to_dict(self):
+        d = dict((name, getattr(self, name)) for name in self.counters + self.timers)
+        d['local_cache_hit_rate'] = self.local_cache_hit_rate
+        d['remote_cache_hit_rate'] = self.remote_cache_hit_rate
+        d['expanded_cache_hit_rate'] = self.expanded_cache_hit_rate
+        d['spans'] = [span.to_dict() for span in self.spans]
+        return d
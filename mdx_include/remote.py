@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+'''
+Remote content fetching for mdx_include
+===========================================
+
+Downloads remote includes following redirects, with timeouts, conditional
+requests (ETag/Last-Modified) and an optional persistent on-disk cache.
+HTTP(S) connections are kept alive in a connection pool shared by the
+process and responses are requested gzip compressed.
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import json
+import time
+import zlib
+import errno
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+try:
+    # python 3
+    from urllib.request import build_opener
+    from urllib.request import HTTPRedirectHandler
+    from urllib.request import Request
+    from urllib.request import getproxies
+    from urllib.request import proxy_bypass
+    from urllib.error import HTTPError
+    from urllib.parse import urlparse
+    from urllib.parse import urljoin
+    import http.client as http_client
+except ImportError:
+    # python 2
+    from urllib2 import HTTPRedirectHandler
+    from urllib2 import build_opener
+    from urllib2 import Request
+    from urllib2 import HTTPError
+    from urllib import getproxies
+    from urllib import proxy_bypass
+    from urlparse import urlparse
+    from urlparse import urljoin
+    import httplib as http_client
+from . import version
+from .failures import failure_log
+
+LOGGER_NAME = 'mdx_include-' + version.__version__
+log = logging.getLogger(LOGGER_NAME)
+
+USER_AGENT = 'mdx_include/' + version.__version__
+MAX_REDIRECTS = 10
+READ_CHUNK_SIZE = 65536
+# idle connections are closed after this many seconds, servers close them anyway
+POOL_IDLE_TIMEOUT = 30.0
+POOL_MAX_IDLE_PER_HOST = 8
+# errors of a request sent on a connection the server has closed
+STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+class ResponseTooLarge(IOError):
+    """The response exceeds the maximum size (see the remote_max_size config)"""
+
+
+def get_timeout(timeout, deadline):
+    """Return timeout shortened to end by deadline (a time.time() value, None for no deadline),
+    raise socket.timeout if the deadline has passed"""
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout("The download deadline has passed")
+    return min(timeout, remaining) if timeout else remaining
+
+def is_stale_connection_error(err):
+    """Return whether a request failed because the server had closed the connection, never for a timeout"""
+    if isinstance(err, socket.timeout):
+        return False
+    if isinstance(err, http_client.BadStatusLine):
+        # including RemoteDisconnected, nothing was received
+        return True
+    return getattr(err, 'errno', None) in STALE_CONNECTION_ERRNOS
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections by (scheme, host, port).
+
+    A connection is used by one request at a time and put back in the pool
+    after the response is read unless the server closes it. A request failing
+    on a reused connection (closed by the server meanwhile) is retried once on
+    a new connection.
+    """
+
+    def __init__(self, max_idle_per_host=POOL_MAX_IDLE_PER_HOST, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {} # key = (scheme, host, port), value = list of (connection, idle since)
+        self.connections = 0 # connections opened
+        self.reused = 0 # requests sent on a reused connection
+        self.requests = 0
+        self.retries = 0
+        self.gzip_responses = 0
+        self.bytes_received = 0 # as transferred
+        self.bytes_decoded = 0 # after decompression
+
+    def acquire(self, key, timeout):
+        """Return (connection, reused) for key"""
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, since = idle.pop()
+                if now - since < self.idle_timeout:
+                    self.reused += 1
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+            self.connections += 1
+        scheme, host, port = key
+        cls = http_client.HTTPSConnection if scheme == 'https' else http_client.HTTPConnection
+        return cls(host, port, timeout=timeout), False
+
+    def release(self, key, conn):
+        """Put a connection back in the pool"""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def count(self, name, value=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def request(self, url, headers, timeout=None, max_size=0, deadline=None):
+        """GET url (http or https) and return (status, headers, body) with the body decompressed.
+
+        timeout applies to each socket operation, the whole request (retry included)
+        must end by deadline (a time.time() value) if it is not None.
+        """
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = path + '?' + parsed.query
+        headers = dict(headers)
+        headers.setdefault('Accept-Encoding', 'gzip')
+        headers.setdefault('User-Agent', USER_AGENT)
+        self.count('requests')
+        while True:
+            conn, reused = self.acquire(key, get_timeout(timeout, deadline))
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except (http_client.HTTPException, socket.error) as err:
+                conn.close()
+                if reused and is_stale_connection_error(err):
+                    # closed by the server while idle
+                    self.count('retries')
+                    continue
+                raise
+            try:
+                body = self.read(response, max_size, conn, timeout, deadline)
+            except BaseException:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self.release(key, conn)
+            return response.status, response.getheader, body
+
+    def read(self, response, max_size=0, conn=None, timeout=None, deadline=None):
+        """Read and decompress a response body, raise ResponseTooLarge if it exceeds max_size bytes.
+        With a deadline, the timeout of each read of conn is shortened to end by it."""
+        length = response.getheader('Content-Length')
+        if max_size and length and length.isdigit() and int(length) > max_size:
+            raise ResponseTooLarge("Response of %s bytes exceeds the maximum size (%s)" % (length, max_size))
+        encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+        decompressor = None
+        if encoding in ('gzip', 'x-gzip'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.count('gzip_responses')
+        elif encoding == 'deflate':
+            decompressor = zlib.decompressobj()
+        chunks = []
+        size = 0
+        received = 0
+        read = response.read
+        if deadline is not None:
+            # read() waits for a full chunk, read1() (python 3) returns what has arrived
+            # so that a body trickling in is checked against the deadline as it goes
+            read = getattr(response, 'read1', response.read)
+        while True:
+            if deadline is not None:
+                conn.sock.settimeout(get_timeout(timeout, deadline))
+            data = read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            received += len(data)
+            if decompressor is not None:
+                # bounded, a small compressed body can expand to a huge one
+                data = decompressor.decompress(data, max_size - size + 1) if max_size else decompressor.decompress(data)
+            size += len(data)
+            if max_size and size > max_size:
+                raise ResponseTooLarge("Response exceeds the maximum size (%s)" % max_size)
+            chunks.append(data)
+        if decompressor is not None:
+            data = decompressor.flush()
+            size += len(data)
+            if max_size and size > max_size:
+                raise ResponseTooLarge("Response exceeds the maximum size (%s)" % max_size)
+            chunks.append(data)
+        self.count('bytes_received', received)
+        self.count('bytes_decoded', size)
+        return b''.join(chunks)
+
+    def close(self):
+        """Close the idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn, since in connections:
+                conn.close()
+
+    def stats(self):
+        """Return the pool counters as a dict"""
+        with self.lock:
+            idle = sum(len(connections) for connections in self.idle.values())
+            return {
+                'connections': self.connections,
+                'reused': self.reused,
+                'requests': self.requests,
+                'retries': self.retries,
+                'idle': idle,
+                'gzip_responses': self.gzip_responses,
+                'bytes_received': self.bytes_received,
+                'bytes_decoded': self.bytes_decoded,
+            }
+
+
+connection_pool = ConnectionPool() # shared by all the instances of the process
+
+
+class RemoteDiskCache(object):
+    """Persistent cache of downloaded content.
+
+    Each URL is stored as two files in the cache directory: the raw body
+    and a JSON metadata file with the ETag, Last-Modified and fetch time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def get_paths(self, url):
+        key = self.get_key(url)
+        return os.path.join(self.directory, key + '.json'), os.path.join(self.directory, key + '.body')
+
+    def get(self, url):
+        """Return the cache entry dict for url or None"""
+        meta_path, body_path = self.get_paths(url)
+        try:
+            with open(meta_path, 'rb') as f:
+                entry = json.loads(f.read().decode('utf-8'))
+            with open(body_path, 'rb') as f:
+                entry['body'] = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def write(self, path, data):
+        """Write data to path atomically"""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            if hasattr(os, 'replace'):
+                os.replace(tmp, path)
+            else:
+                # python 2
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def put(self, url, body, etag=None, last_modified=None, fetched=None):
+        """Store the body of url with its validators"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        meta_path, body_path = self.get_paths(url)
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched': time.time() if fetched is None else fetched,
+        }
+        self.write(body_path, body)
+        self.write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def touch(self, entry):
+        """Mark an entry as freshly validated"""
+        self.put(entry['url'], entry['body'], entry.get('etag'), entry.get('last_modified'))
+
+    def clear(self):
+        """Remove all entries"""
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json') or name.endswith('.body'):
+                    os.remove(os.path.join(self.directory, name))
+
+
+def get_content_lines(body, encoding):
+    """Decode the body and split it in lines the same way local files are split"""
+    return ''.join([body.decode(encoding), '\n']).splitlines()
+
+def uses_proxy(url):
+    """Return whether url is to be fetched through a proxy configured in the environment"""
+    parsed = urlparse(url)
+    return parsed.scheme in getproxies() and not proxy_bypass(parsed.hostname or '')
+
+def fetch(url, timeout=None, etag=None, last_modified=None, max_size=0, keep_alive=True, deadline=None):
+    """Follow redirect and return (status_code, body, etag, last_modified).
+
+    status_code is 304 when the validators match the remote content, body is None then.
+    HTTP(S) URLs not going through a proxy are fetched with the connection pool if
+    keep_alive is True, they must be downloaded by deadline (a time.time() value) if it
+    is not None. Otherwise the timeout of urllib is shortened to the deadline.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    if keep_alive and urlparse(url).scheme in ('http', 'https') and not uses_proxy(url):
+        return fetch_pooled(url, headers, timeout, max_size, deadline)
+    return fetch_urllib(url, headers, get_timeout(timeout, deadline), max_size)
+
+def fetch_pooled(url, headers, timeout=None, max_size=0, deadline=None):
+    """fetch() with the connection pool"""
+    for i in range(MAX_REDIRECTS + 1):
+        status, getheader, body = connection_pool.request(url, headers, timeout or None, max_size, deadline)
+        location = getheader('Location')
+        if status in (301, 302, 303, 307, 308) and location:
+            url = urljoin(url, location)
+            if urlparse(url).scheme not in ('http', 'https') or uses_proxy(url):
+                return fetch_urllib(url, headers, get_timeout(timeout, deadline), max_size)
+            continue
+        if status == 304:
+            return 304, None, headers.get('If-None-Match'), headers.get('If-Modified-Since')
+        if not 200 <= status < 300:
+            raise IOError("HTTP Error %s for %s" % (status, url))
+        return 200, body, getheader('ETag'), getheader('Last-Modified')
+    raise IOError("Too many redirects for " + url)
+
+def fetch_urllib(url, headers, timeout=None, max_size=0):
+    """fetch() with urllib, a new connection for each request"""
+    etag = headers.get('If-None-Match')
+    last_modified = headers.get('If-Modified-Since')
+    request = Request(url, headers=headers)
+    opener = build_opener(HTTPRedirectHandler)
+    try:
+        if timeout:
+            response = opener.open(request, timeout=timeout)
+        else:
+            response = opener.open(request)
+    except HTTPError as err:
+        if err.code == 304:
+            return 304, None, etag, last_modified
+        raise
+    try:
+        body = response.read(max_size + 1) if max_size else response.read()
+        if max_size and len(body) > max_size:
+            raise ResponseTooLarge("Response exceeds the maximum size (%s)" % max_size)
+        info = response.info()
+        return 200, body, info.get('ETag'), info.get('Last-Modified')
+    finally:
+        response.close()
+
+def get_remote_content_list(url, encoding='utf-8', timeout=None, disk_cache=None, ttl=0, offline=False, max_size=0, keep_alive=True,
+                            deadline=None):
+    """Follow redirect and return the content with status.
+
+    Responses larger than max_size bytes (0 for unlimited) fail, see fetch() for keep_alive and deadline.
+
+    With a disk_cache (RemoteDiskCache), entries younger than ttl seconds are
+    served without network access and older ones are revalidated with a
+    conditional request. In offline mode, cached entries are served regardless
+    of their age. A stale entry is also served if the download fails.
+    """
+    entry = disk_cache.get(url) if disk_cache is not None else None
+    if entry is not None and (offline or time.time() - entry.get('fetched', 0) < ttl):
+        try:
+            return get_content_lines(entry['body'], encoding), True
+        except Exception:
+            failure_log.exception("E: Failed to decode cached content for: " + url)
+            return [], False
+    if offline:
+        log.error("E: Offline mode and no cached content for: " + url)
+        return [], False
+    try:
+        log.info("Downloading url: "+ url)
+        if entry is not None:
+            code, body, etag, last_modified = fetch(url, timeout, entry.get('etag'), entry.get('last_modified'), max_size, keep_alive, deadline)
+        else:
+            code, body, etag, last_modified = fetch(url, timeout, max_size=max_size, keep_alive=keep_alive, deadline=deadline)
+        if code == 304:
+            body = entry['body']
+        textl = get_content_lines(body, encoding)
+    except Exception as err:
+        if entry is not None:
+            log.warning("W: Failed to download: " + url + " (" + str(err) + "). Using cached content.")
+            try:
+                return get_content_lines(entry['body'], encoding), True
+            except Exception:
+                pass
+        # catching all exception, this will effectively return empty string
+        failure_log.exception("E: Failed to download: " + url)
+        return [], False
+    if disk_cache is not None:
+        try:
+            if code == 304:
+                disk_cache.touch(entry)
+            else:
+                disk_cache.put(url, body, etag, last_modified)
+        except (IOError, OSError):
+            log.exception("E: Failed to write remote cache for: " + url)
+    return textl, True
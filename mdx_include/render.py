@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''
+Render cache for mdx_include
+===========================================
+
+Keeps the HTML of converted documents, keyed by a fingerprint of the text
+and of the configuration of the Markdown instance, along with the files,
+directories and URLs included while converting it. A document is served
+from the cache while the included content is unchanged: local files are
+checked by their metadata first and by the fingerprint of their content
+if it changed. Entries are kept in memory (LRU) and optionally in a
+directory as JSON files.
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import json
+import hashlib
+import tempfile
+from collections import OrderedDict
+from .lines import get_lines_text
+
+FINGERPRINT_SIZE = 16
+
+# attributes set on the Markdown instance by extensions during a conversion (meta, toc),
+# kept with the rendered document and restored when it is served from the cache
+MARKDOWN_STATE = ('Meta', 'toc', 'toc_tokens')
+
+if hasattr(hashlib, 'blake2b'):
+    def new_hash():
+        return hashlib.blake2b(digest_size=FINGERPRINT_SIZE)
+else:
+    # python 2
+    def new_hash():
+        return hashlib.sha256()
+
+
+def get_fingerprint(*parts):
+    """Return the hex fingerprint of text parts"""
+    h = new_hash()
+    for part in parts:
+        data = part.encode('utf-8')
+        # length prefixed, ('ab', 'c') and ('a', 'bc') differ
+        h.update(('%d:' % len(data)).encode('ascii'))
+        h.update(data)
+    return h.hexdigest()[:2 * FINGERPRINT_SIZE]
+
+def get_value_repr(value):
+    """Return a repr of a config value that is stable across processes for functions and classes"""
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(get_value_repr(item) for item in value)
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%r: %s' % (key, get_value_repr(value[key])) for key in sorted(value, key=repr))
+    name = getattr(value, '__qualname__', None) or getattr(value, '__name__', None)
+    if name is not None and getattr(value, '__module__', None) is not None and callable(value):
+        return '%s.%s' % (value.__module__, name)
+    return repr(value)
+
+def get_markdown_state(md):
+    """Return the MARKDOWN_STATE attributes of md as a dict, None if they can not be stored as JSON"""
+    state = dict((name, getattr(md, name)) for name in MARKDOWN_STATE if hasattr(md, name))
+    try:
+        return json.loads(json.dumps(state))
+    except (TypeError, ValueError):
+        return None
+
+def get_content_fingerprint(textl, count=None):
+    """Return the fingerprint of a content line list, or of its first count lines"""
+    if count is not None and count < len(textl):
+        textl = textl[:count]
+    return get_fingerprint(get_lines_text(textl))
+
+
+class RenderCache(object):
+    """Rendered documents: key = fingerprint of the text and the configuration,
+    value = dict with the html, the dependencies, the child parent relations and
+    the state of the markdown instance (see MARKDOWN_STATE).
+
+    A dependency is a list [kind, path, encoding, signature, count, fingerprint]
+    where kind is 'local', 'local_head' (the first count lines of a file),
+    'listing' (a directory) or 'remote'.
+    """
+
+    def __init__(self, max_entries=1000, directory=''):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Return the entry for key or None"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            # mark as most recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry
+        if not self.directory:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                entry = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        self.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        """Keep entry in memory"""
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while self.max_entries and len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def set(self, key, entry):
+        """Store entry for key in memory and in the directory"""
+        self.put(key, entry)
+        self.stores += 1
+        if self.directory:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(json.dumps(entry).encode('utf-8'))
+                if hasattr(os, 'replace'):
+                    os.replace(tmp, self.get_path(key))
+                else:
+                    # python 2
+                    if os.path.exists(self.get_path(key)):
+                        os.remove(self.get_path(key))
+                    os.rename(tmp, self.get_path(key))
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+    def delete(self, key):
+        """Remove the entry for key"""
+        self.entries.pop(key, None)
+        if self.directory and os.path.exists(self.get_path(key)):
+            os.remove(self.get_path(key))
+
+    def clear(self):
+        """Remove all the entries"""
+        self.entries.clear()
+        if self.directory and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        """Return the cache counters as a dict"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'hit_rate': float(self.hits) / total if total else None,
+        }
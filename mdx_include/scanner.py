@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+'''
+Include scanner for mdx_include
+===========================================
+
+Finds the include syntax in a line in linear time. The include regex
+(IncludeExtension.compiled_re) has lazy path and encoding groups surrounded
+by optional whitespace and optional groups, it backtracks heavily on long
+lines with many left boundaries and no right boundary. The scanner gives the
+same matches as the regex (same spans and groups) when the syntax configs
+are literals, see IncludeScanner.create(), the regex is used otherwise.
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import re
+
+# same flags as the include regex, thus the same whitespace and digits
+WHITESPACE_RE = re.compile(r'\s*')
+SPACE_RE = re.compile(r'\s')
+SLICE_RE = re.compile(r'\[ln:(?P<lines>[\d.,-]+)\]')
+# characters not allowed in a path
+PATH_STOP_RE = re.compile(r'[]|[]')
+REGEX_SPECIAL_CHARS = '.^$*+?{}[]()|\\'
+
+def get_literal(pattern):
+    """Return the text matched by a regex pattern made of literal characters only
+    or None if the pattern has anything else.
+
+    >>> get_literal(r'\\{!')
+    '{!'
+    >>> get_literal(r'a+') is None
+    True
+    """
+    literal = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\':
+            if i + 1 >= len(pattern) or pattern[i+1].isalnum():
+                return None
+            literal.append(pattern[i+1])
+            i = i + 2
+        elif ch in REGEX_SPECIAL_CHARS:
+            return None
+        else:
+            literal.append(ch)
+            i = i + 1
+    return ''.join(literal)
+
+
+class IncludeMatch(object):
+    """A match of the include syntax, with the part of the regex match API used by mdx_include"""
+
+    __slots__ = ('string', 'pos', 'endpos', 'groups_')
+
+    def __init__(self, string, pos, endpos, groups):
+        self.string = string
+        self.pos = pos
+        self.endpos = endpos
+        self.groups_ = groups
+
+    def group(self, *names):
+        values = tuple(self.string[self.pos:self.endpos] if name == 0 else self.groups_[name] for name in names or (0,))
+        return values[0] if len(values) == 1 else values
+
+    def __getitem__(self, name):
+        return self.group(name)
+
+    def groupdict(self, default=None):
+        return dict((name, default if value is None else value) for name, value in self.groups_.items())
+
+    def start(self):
+        return self.pos
+
+    def end(self):
+        return self.endpos
+
+    def span(self):
+        return self.pos, self.endpos
+
+    def __repr__(self):
+        return "<IncludeMatch span=%r, match=%r>" % (self.span(), self.group(0))
+
+
+class NextFinder(object):
+    """Finds the next occurrence of a string in a line, remembering the last answer
+    so that queries in (mostly) increasing order scan the line about once"""
+
+    __slots__ = ('line', 'sub', 'start', 'found')
+
+    def __init__(self, line, sub):
+        self.line = line
+        self.sub = sub
+        self.start = 0
+        self.found = None
+
+    def find(self, pos):
+        """Return the position of the first occurrence at or after pos, -1 if none"""
+        found = self.found
+        if found is not None and self.start <= pos and (pos <= found or found < 0):
+            # there's no occurrence in [start, found)
+            return found
+        self.start = pos
+        self.found = found = self.line.find(self.sub, pos)
+        return found
+
+
+class NextSearcher(NextFinder):
+    """NextFinder for a compiled regex"""
+
+    __slots__ = ()
+
+    def find(self, pos):
+        found = self.found
+        if found is not None and self.start <= pos and (pos <= found or found < 0):
+            return found
+        m = self.sub.search(self.line, pos)
+        self.start = pos
+        self.found = found = m.start() if m else -1
+        return found
+
+
+class LineScan(object):
+    """The state of the scan of one line, every partial answer is memoized by position"""
+
+    def __init__(self, scanner, line):
+        self.scanner = scanner
+        self.line = line
+        self.right = NextFinder(line, scanner.right)
+        self.delim = NextFinder(line, scanner.delim)
+        self.stops = NextSearcher(line, PATH_STOP_RE)
+        self.whitespace_ends = {}
+        self.rests = {}
+        self.tails = {}
+        self.paths = {}
+
+    def skip_whitespace(self, pos):
+        end = self.whitespace_ends.get(pos)
+        if end is None:
+            end = self.whitespace_ends[pos] = WHITESPACE_RE.match(self.line, pos).end()
+        return end
+
+    def strip_whitespace(self, start, end):
+        """Return the end of line[start:end] without trailing whitespace (at least start)"""
+        line = self.line
+        while end > start and line[end-1].isspace() and SPACE_RE.match(line, end - 1):
+            end = end - 1
+        return end
+
+    def get_stop(self, pos):
+        """Return the position of the first character not allowed in a path at or after pos"""
+        stop = self.stops.find(pos)
+        return stop if stop >= 0 else len(self.line)
+
+    def get_tail(self, pos):
+        """Match whitespace, the optional delimiter with the encoding and the right
+        boundary at pos. Returns (encoding, end) or None."""
+        if pos in self.tails:
+            return self.tails[pos]
+        scanner = self.scanner
+        line = self.line
+        tail = None
+        w = self.skip_whitespace(pos)
+        if line.startswith(scanner.delim, w):
+            u = w + len(scanner.delim)
+            v = self.skip_whitespace(u)
+            # the encoding is the shortest text (of one character at least) followed by
+            # whitespace and the right boundary, after as much whitespace as possible
+            r = self.right.find(v + 1)
+            if r >= 0:
+                tail = (line[v:self.strip_whitespace(v + 1, r)], r + len(scanner.right))
+            elif v > u and line.startswith(scanner.right, v):
+                # the encoding is the last whitespace character
+                tail = (line[v-1:v], v + len(scanner.right))
+        if tail is None and line.startswith(scanner.right, w):
+            tail = (None, w + len(scanner.right))
+        self.tails[pos] = tail
+        return tail
+
+    def get_rest(self, pos):
+        """Match the optional slice and the tail at pos, where pos is the first
+        character after the path and the whitespace following it.
+        Returns (lines, encoding, end) or None."""
+        if pos in self.rests:
+            return self.rests[pos]
+        rest = None
+        if self.line.startswith('[ln:', pos):
+            m = SLICE_RE.match(self.line, pos)
+            if m:
+                tail = self.get_tail(m.end())
+                if tail is not None:
+                    rest = (m.group('lines'),) + tail
+        if rest is None:
+            tail = self.get_tail(pos)
+            if tail is not None:
+                rest = (None,) + tail
+        self.rests[pos] = rest
+        return rest
+
+    def get_path(self, start):
+        """Match the shortest path starting at start followed by a rest.
+        Returns (path end, (lines, encoding, end)) or None."""
+        if start in self.paths:
+            return self.paths[start]
+        line = self.line
+        found = None
+        stop = self.get_stop(start)
+        pos = start + 1
+        while pos <= stop:
+            # the rest can only start where the delimiter, the right boundary or a slice starts
+            r = self.right.find(pos)
+            if r < 0:
+                break
+            d = self.delim.find(pos)
+            c = min(r, d) if d >= 0 else r
+            if stop < len(line) and line[stop] == '[':
+                c = min(c, stop)
+            if c > stop:
+                break
+            rest = self.get_rest(c)
+            if rest is not None:
+                found = (self.strip_whitespace(start + 1, c), rest)
+                break
+            pos = c + 1
+        self.paths[start] = found
+        return found
+
+    def match_at(self, pos, start):
+        """Match the syntax after the left boundary found at pos, start is where
+        the search started. Returns an IncludeMatch or None."""
+        scanner = self.scanner
+        line = self.line
+        a = pos + len(scanner.left)
+        recursives = [None]
+        if a < len(line) and line[a] in scanner.recurs_chars:
+            recursives.insert(0, line[a])
+        for recursive in recursives:
+            b = a + 1 if recursive else a
+            indents = ['']
+            if line.startswith(scanner.apply_indent, b):
+                indents.insert(0, scanner.apply_indent)
+            for apply_indent in indents:
+                c = b + len(apply_indent)
+                w = self.skip_whitespace(c)
+                # the path takes the whitespace back only if that helps, one character is enough
+                for path_start in ((w, w - 1) if w > c else (w,)):
+                    found = self.get_path(path_start)
+                    if found is None:
+                        continue
+                    path_end, (lines, encoding, end) = found
+                    escape = '\\' if pos > start and line[pos-1] == '\\' else None
+                    return IncludeMatch(line, pos - 1 if escape else pos, end, {
+                        'escape': escape,
+                        'recursive': recursive,
+                        'apply_indent': apply_indent,
+                        'path': line[path_start:path_end],
+                        'lines': lines,
+                        'encoding': encoding,
+                    })
+        return None
+
+
+class IncludeScanner(object):
+    """Linear time scanner for the include syntax, a replacement for the
+    finditer() method of the include regex. Use IncludeScanner.create()."""
+
+    def __init__(self, regex, left, right, delim, recurs_chars, apply_indent):
+        self.regex = regex
+        self.left = left
+        self.right = right
+        self.delim = delim
+        self.recurs_chars = recurs_chars
+        self.apply_indent = apply_indent
+
+    @classmethod
+    def create(cls, regex, syntax_left, syntax_right, syntax_delim, syntax_recurs_on, syntax_recurs_off, syntax_apply_indent):
+        """Return a scanner for the syntax configs or None if the syntax is not made
+        of literals that the scanner can match exactly like the regex"""
+        left = get_literal(syntax_left)
+        right = get_literal(syntax_right)
+        delim = get_literal(syntax_delim)
+        if not left or not right or not delim or left.startswith('\\'):
+            return None
+        if SPACE_RE.match(right) or SPACE_RE.match(delim):
+            return None
+        recurs_chars = syntax_recurs_on + syntax_recurs_off
+        if len(syntax_recurs_on) != 1 or len(syntax_recurs_off) != 1 or any(ch in '^[]\\' for ch in recurs_chars):
+            return None
+        if len(syntax_apply_indent) != 1 or syntax_apply_indent in REGEX_SPECIAL_CHARS:
+            return None
+        return cls(regex, left, right, delim, recurs_chars, syntax_apply_indent)
+
+    def match_first(self, line, pos, start, finders):
+        """Match the syntax after the left boundary found at pos when the first choice of
+        the regex succeeds at each step (the recursive and indentation characters and all
+        the whitespace are taken, the path ends at the first place where the rest can
+        start, and the rest matches there). Returns an IncludeMatch or None otherwise.
+
+        This is the common case, it is checked with a few string searches before
+        resorting to LineScan. finders are the NextFinder of the right boundary and the
+        delimiter and the NextSearcher of the characters not allowed in a path.
+        """
+        right = self.right
+        delim = self.delim
+        a = pos + len(self.left)
+        recursive = line[a] if a < len(line) and line[a] in self.recurs_chars else None
+        b = a + 1 if recursive else a
+        apply_indent = self.apply_indent if line.startswith(self.apply_indent, b) else ''
+        w = b + len(apply_indent)
+        # str.isspace() is checked first as the regex is slower, it does not change the result
+        if w < len(line) and line[w].isspace():
+            w = WHITESPACE_RE.match(line, w).end()
+        right_finder, delim_finder, stop_finder = finders
+        c = right_finder.find(w + 1)
+        if c < 0:
+            return None
+        stop = stop_finder.find(w)
+        if stop < 0:
+            stop = len(line)
+        d = delim_finder.find(w + 1)
+        if 0 <= d < c:
+            c = d
+        if stop < c:
+            if stop == w or line[stop] != '[':
+                # the path is empty or it can not reach the rest
+                return None
+            c = stop
+        lines = None
+        x = c
+        if line[c] == '[':
+            m = SLICE_RE.match(line, c)
+            if not m:
+                return None
+            lines = m.group('lines')
+            x = m.end()
+        if x < len(line) and line[x].isspace():
+            x = WHITESPACE_RE.match(line, x).end()
+        encoding = None
+        end = None
+        if line.startswith(delim, x):
+            u = x + len(delim)
+            v = WHITESPACE_RE.match(line, u).end()
+            r = line.find(right, v + 1)
+            if r >= 0:
+                e = r
+                while e > v + 1 and line[e-1].isspace() and SPACE_RE.match(line, e - 1):
+                    e = e - 1
+                encoding = line[v:e]
+                end = r + len(right)
+            elif v > u and line.startswith(right, v):
+                encoding = line[v-1:v]
+                end = v + len(right)
+        if end is None:
+            if not line.startswith(right, x):
+                return None
+            end = x + len(right)
+        e = c
+        while e > w + 1 and line[e-1].isspace() and SPACE_RE.match(line, e - 1):
+            e = e - 1
+        escape = '\\' if pos > start and line[pos-1] == '\\' else None
+        return IncludeMatch(line, pos - 1 if escape else pos, end, {
+            'escape': escape,
+            'recursive': recursive,
+            'apply_indent': apply_indent,
+            'path': line[w:e],
+            'lines': lines,
+            'encoding': encoding,
+        })
+
+    def finditer(self, line):
+        """Yield the matches of the include syntax in line like regex.finditer(line)"""
+        if '\n' in line:
+            # the encoding can not span lines, leave it to the regex
+            for m in self.regex.finditer(line):
+                yield m
+            return
+        left = self.left
+        pos = line.find(left)
+        if pos < 0:
+            return
+        finders = (NextFinder(line, self.right), NextFinder(line, self.delim), NextSearcher(line, PATH_STOP_RE))
+        scan = None
+        start = 0
+        while pos >= 0:
+            m = None
+            if scan is None:
+                m = self.match_first(line, pos, start, finders)
+                if m is None:
+                    # the rest of the line is scanned with backtracking
+                    scan = LineScan(self, line)
+            if scan is not None:
+                if scan.right.find(pos + len(left)) < 0:
+                    # nothing can match without a right boundary
+                    return
+                m = scan.match_at(pos, start)
+            if m is None:
+                pos = line.find(left, pos + 1)
+            else:
+                yield m
+                start = m.end()
+                pos = line.find(left, start)
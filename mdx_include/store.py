@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+'''
+Shared content stores for mdx_include
+===========================================
+
+A content store is a second level cache shared by several IncludePreprocessor
+instances, in the same process or across processes. It is set with the
+`content_store` config parameter.
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import json
+import mmap
+import struct
+import threading
+from .lines import get_lines_text
+
+
+def get_key(kind, path):
+    """Return the store key for a local file path or remote URL"""
+    return ''.join([kind, ':', path])
+
+def iter_cache_items(local_cache, remote_cache):
+    """Yield (key, lines, signature) for the entries of the content caches of a preprocessor"""
+    for path, lines in local_cache.items():
+        signatures = getattr(local_cache, 'signatures', {})
+        yield get_key('local', path), lines, signatures.get(path)
+    for url, lines in remote_cache.items():
+        yield get_key('remote', url), lines, None
+
+
+class ContentStore(object):
+    """Interface of a content store.
+
+    Values are lists of lines along with a signature which is either None or
+    the (mtime_ns, size, inode) tuple of the local file the lines were read from.
+    """
+
+    readonly = False
+
+    def get(self, key):
+        """Return (lines, signature) for key or None"""
+        raise NotImplementedError
+
+    def set(self, key, lines, signature=None):
+        """Store lines with their signature for key"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove key if it exists"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all entries"""
+        raise NotImplementedError
+
+
+class DictStore(ContentStore):
+    """In-process store, share one instance among Markdown instances"""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, lines, signature=None):
+        with self.lock:
+            self.data[key] = (lines, signature)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SQLiteStore(ContentStore):
+    """Store kept in a SQLite database file, shared by all processes using the same path.
+
+    A connection is opened lazily for each process, thus an instance can be
+    created before forking worker processes.
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pid = None
+        self.conn = None
+
+    def get_connection(self):
+        if self.conn is None or self.pid != os.getpid():
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS content (key TEXT PRIMARY KEY, signature TEXT, text TEXT)')
+            self.conn = conn
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, key):
+        with self.lock:
+            row = self.get_connection().execute('SELECT signature, text FROM content WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        signature = json.loads(row[0])
+        return row[1].split('\n'), tuple(signature) if signature is not None else None
+
+    def set(self, key, lines, signature=None):
+        with self.lock:
+            self.get_connection().execute('INSERT OR REPLACE INTO content (key, signature, text) VALUES (?, ?, ?)',
+                                          (key, json.dumps(signature), get_lines_text(lines)))
+
+    def delete(self, key):
+        with self.lock:
+            self.get_connection().execute('DELETE FROM content WHERE key = ?', (key,))
+
+    def clear(self):
+        with self.lock:
+            self.get_connection().execute('DELETE FROM content')
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None and self.pid == os.getpid():
+                self.conn.close()
+            self.conn = None
+
+    def __len__(self):
+        with self.lock:
+            return self.get_connection().execute('SELECT COUNT(*) FROM content').fetchone()[0]
+
+
+class SnapshotStore(ContentStore):
+    """Read-only store memory-mapped from a snapshot file.
+
+    A parent process builds the snapshot once with SnapshotStore.build() and
+    workers attach to it by creating a SnapshotStore with the same path. The
+    file is mapped, not read, so all workers share the same pages.
+
+    File format: magic, 8 byte index length, JSON index (key -> [offset, length, signature])
+    and the UTF-8 encoded texts.
+    """
+
+    readonly = True
+    magic = b'MDXSNAP1'
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(self.magic)] != self.magic:
+            self.mm.close()
+            raise ValueError("E: Not a snapshot file: " + path)
+        start = len(self.magic) + 8
+        size = struct.unpack('>Q', self.mm[len(self.magic):start])[0]
+        self.index = json.loads(self.mm[start:start + size].decode('utf-8'))
+        self.data_offset = start + size
+
+    @classmethod
+    def build(cls, path, items):
+        """Write a snapshot of items (iterable of (key, lines, signature)) to path
+        and return the store attached to it."""
+        index = {}
+        chunks = []
+        offset = 0
+        for key, lines, signature in items:
+            data = get_lines_text(lines).encode('utf-8')
+            index[key] = [offset, len(data), signature]
+            chunks.append(data)
+            offset += len(data)
+        index_data = json.dumps(index).encode('utf-8')
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(cls.magic)
+            f.write(struct.pack('>Q', len(index_data)))
+            f.write(index_data)
+            for data in chunks:
+                f.write(data)
+        if hasattr(os, 'replace'):
+            os.replace(tmp, path)
+        else:
+            # python 2
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+        return cls(path)
+
+    def get(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        offset, length, signature = entry
+        start = self.data_offset + offset
+        lines = self.mm[start:start + length].decode('utf-8').split('\n')
+        return lines, tuple(signature) if signature is not None else None
+
+    def set(self, key, lines, signature=None):
+        raise TypeError("E: SnapshotStore is read-only")
+
+    def delete(self, key):
+        raise TypeError("E: SnapshotStore is read-only")
+
+    def clear(self):
+        raise TypeError("E: SnapshotStore is read-only")
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for include processing.
+
+Run with: python -m mdx_include.test.bench
+
+All the scenarios run offline on synthetic corpora, remote includes are served
+by a local HTTP stub with injected latency. For each scenario the run time of
+IncludePreprocessor.run is measured (percentiles and throughput in output lines
+per second) along with its peak memory. Results can be saved as a JSON baseline
+and compared with a previous one:
+
+    python -m mdx_include.test.bench --save baseline.json
+    python -m mdx_include.test.bench --compare baseline.json --threshold 0.2
+
+The adversarial scenario has long lines with many {! and no !}, the regex
+would take minutes on them, it is compared with the include scanner on a
+shorter line.
+
+The startup scenario measures the import of the extension and the conversion of
+an include-free document in a fresh interpreter.
+
+The comparison fails (exit status 1) if the median time or the peak memory of a
+scenario exceeds the baseline by more than the threshold.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import shutil
+import timeit
+import argparse
+import tempfile
+import subprocess
+from codecs import open
+import markdown
+from mdx_include.mdx_include import IncludeExtension
+from mdx_include.metrics import timer
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+
+def get_preprocessor(configs={}):
+    md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+    if hasattr(md.preprocessors, 'get_index_for_name'):
+        return md.preprocessors[md.preprocessors.get_index_for_name('mdx_include')]
+    return md.preprocessors['mdx_include']
+
+
+def make_include_free_lines(n):
+    return ['Line %d of a large document without includes, {just} some text!' % i for i in range(n)]
+
+
+def bench_include_free(n=200000, repeat=5):
+    """Compare the marker fast path with scanning every line with the regex"""
+    lines = make_include_free_lines(n)
+    pre = get_preprocessor()
+    fast = min(timeit.repeat(lambda: pre.run(lines), number=1, repeat=repeat))
+    marker = pre.marker
+    pre.marker = ''
+    try:
+        slow = min(timeit.repeat(lambda: pre.run(lines), number=1, repeat=repeat))
+    finally:
+        pre.marker = marker
+    return {'lines': n, 'fast': fast, 'regex': slow, 'speedup': slow / fast}
+
+
+STARTUP_SCRIPT = '''
+import sys, time, markdown
+timer = getattr(time, 'perf_counter', time.time)
+start = timer()
+from mdx_include.mdx_include import IncludeExtension
+md = markdown.Markdown(extensions=[IncludeExtension()])
+md.convert('a document without includes')
+print(timer() - start)
+print(' '.join(sorted(sys.modules)))
+'''
+
+def get_startup(repeat=5):
+    """Import the extension and convert an include-free document in fresh
+    interpreters (markdown is already imported), return (seconds, modules)
+    with the best time and the modules loaded at the end"""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    best = None
+    modules = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT], env=env)
+        seconds, modules = output.decode('utf-8').split('\n')[:2]
+        best = float(seconds) if best is None else min(best, float(seconds))
+    return best, modules.split()
+
+def measure_startup(repeat):
+    seconds, modules = get_startup(repeat)
+    # in the same format as measure() so that it can be compared with a baseline
+    return {
+        'runs': repeat,
+        'output_lines': 0,
+        'min': seconds,
+        'mean': seconds,
+        'p50': seconds,
+        'p90': seconds,
+        'p99': seconds,
+        'lines_per_second': 0.0,
+        'peak_memory': None,
+        'modules': len(modules),
+    }
+
+
+def make_adversarial_line(n):
+    # many left boundaries and delimiters without a right boundary
+    return '{! a | b ' * n
+
+def bench_adversarial(n=300, repeat=3):
+    """Compare the include scanner with the regex on a line without any include"""
+    line = make_adversarial_line(n)
+    pre = get_preprocessor()
+    scanner = min(timeit.repeat(lambda: list(pre.scanner.finditer(line)), number=1, repeat=repeat))
+    regex = min(timeit.repeat(lambda: list(pre.compiled_re.finditer(line)), number=1, repeat=repeat))
+    return {'length': len(line), 'scanner': scanner, 'regex': regex, 'speedup': regex / scanner}
+
+
+def write_file(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+class Scenario(object):
+    """A synthetic corpus: the document lines, the extension configs and whether
+    the content caches are cleaned before each run (cold) or kept (warm)."""
+
+    def __init__(self, name, lines, configs, cold=True):
+        self.name = name
+        self.lines = lines
+        self.configs = configs
+        self.cold = cold
+
+
+def make_adversarial(tmpdir, scale):
+    write_file(os.path.join(tmpdir, 'adv.md'), 'included')
+    lines = []
+    for i in range(200 // scale):
+        lines.append(make_adversarial_line(500))
+        lines.append('{! adv.md !} ' + '{!' * 500)
+    return Scenario('adversarial', lines, {'base_path': tmpdir}, cold=False)
+
+def make_include_free(tmpdir, scale):
+    return Scenario('include_free', make_include_free_lines(200000 // scale), {'base_path': tmpdir}, cold=False)
+
+def make_deep_chain(tmpdir, scale):
+    depth = 100 // scale
+    for i in range(depth):
+        text = 'level %d\n{!+ chain%d.md !}' % (i, i + 1) if i + 1 < depth else 'bottom'
+        write_file(os.path.join(tmpdir, 'chain%d.md' % i), text)
+    return Scenario('deep_chain', ['{!+ chain0.md !}'], {'base_path': tmpdir})
+
+def make_fan_out(tmpdir, scale):
+    width = 1000 // scale
+    for i in range(width):
+        write_file(os.path.join(tmpdir, 'fan%d.md' % i), 'fan out file %d\nwith two lines' % i)
+    return Scenario('fan_out', ['item {! fan%d.md !}' % i for i in range(width)], {'base_path': tmpdir})
+
+def make_huge_slices(tmpdir, scale):
+    n = 200000 // scale
+    write_file(os.path.join(tmpdir, 'huge.md'), '\n'.join('huge line %d' % i for i in range(1, n + 1)))
+    step = n // 50
+    lines = ['{! huge.md [ln:%d-%d] !}' % (i * step + 1, i * step + 10) for i in range(50)]
+    lines.append('{! huge.md [ln:-10] !}')
+    return Scenario('huge_slices', lines, {'base_path': tmpdir})
+
+def make_duplicates(tmpdir, scale):
+    write_file(os.path.join(tmpdir, 'dup.md'), 'the same content\n{! dup_child.md !}')
+    write_file(os.path.join(tmpdir, 'dup_child.md'), 'child')
+    return Scenario('duplicates', ['{!+ dup.md !} %d' % i for i in range(5000 // scale)], {'base_path': tmpdir})
+
+def make_remote(server, prefetch, scale):
+    urls = ['remote%d.md' % i for i in range(20 // scale)]
+    for url in urls:
+        server.files[url] = 'remote content of %s' % url
+    name = 'remote_prefetch' if prefetch else 'remote_sequential'
+    return Scenario(name, ['{! %s !}' % server.url(url) for url in urls], {'remote_prefetch': prefetch})
+
+SCENARIOS = ['startup', 'include_free', 'adversarial', 'deep_chain', 'fan_out', 'huge_slices', 'duplicates', 'remote_sequential', 'remote_prefetch']
+
+
+def get_percentile(sorted_values, percent):
+    """Nearest rank percentile"""
+    index = max(0, int(-(-len(sorted_values) * percent // 100)) - 1)
+    return sorted_values[index]
+
+def measure(scenario, repeat):
+    """Run a scenario repeat times and return its results dict"""
+    pre = get_preprocessor(scenario.configs)
+    times = []
+    output = []
+    for i in range(repeat + 1):
+        if scenario.cold:
+            pre.mdx_include_content_cache_clean_local()
+            pre.mdx_include_content_cache_clean_remote()
+        start = timer()
+        output = pre.run(scenario.lines)
+        if i:
+            # the first run is a warm up
+            times.append(timer() - start)
+    peak = None
+    if tracemalloc is not None:
+        if scenario.cold:
+            pre.mdx_include_content_cache_clean_local()
+            pre.mdx_include_content_cache_clean_remote()
+        tracemalloc.start()
+        try:
+            pre.run(scenario.lines)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    times.sort()
+    p50 = get_percentile(times, 50)
+    return {
+        'runs': repeat,
+        'output_lines': len(output),
+        'min': times[0],
+        'mean': sum(times) / len(times),
+        'p50': p50,
+        'p90': get_percentile(times, 90),
+        'p99': get_percentile(times, 99),
+        'lines_per_second': len(output) / p50 if p50 else 0.0,
+        'peak_memory': peak,
+    }
+
+def run_scenarios(names=SCENARIOS, repeat=10, scale=1, latency=0.02):
+    """Build the corpora of the named scenarios and return {name: results}"""
+    tmpdir = tempfile.mkdtemp(prefix='mdx_include-bench-')
+    server = None
+    results = {}
+    try:
+        builders = {
+            'include_free': make_include_free,
+            'adversarial': make_adversarial,
+            'deep_chain': make_deep_chain,
+            'fan_out': make_fan_out,
+            'huge_slices': make_huge_slices,
+            'duplicates': make_duplicates,
+        }
+        for name in names:
+            if name == 'startup':
+                results[name] = measure_startup(min(repeat, 5))
+                continue
+            if name in builders:
+                scenario = builders[name](tmpdir, scale)
+            elif name in ('remote_sequential', 'remote_prefetch'):
+                if server is None:
+                    from mdx_include.test.server import RemoteServer
+                    server = RemoteServer({}, delay=latency)
+                scenario = make_remote(server, name == 'remote_prefetch', scale)
+            else:
+                raise ValueError("E: Unknown scenario: " + name)
+            results[name] = measure(scenario, repeat)
+    finally:
+        if server is not None:
+            server.close()
+        shutil.rmtree(tmpdir)
+    return results
+
+def compare(results, baseline, threshold=0.2):
+    """Return the list of regressions of results against baseline"""
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ('p50', 'peak_memory'):
+            if result.get(key) is None or not base.get(key):
+                continue
+            ratio = float(result[key]) / base[key]
+            if ratio > 1 + threshold:
+                regressions.append("%s: %s %.6g is %.0f%% above the baseline %.6g" % (name, key, result[key], (ratio - 1) * 100, base[key]))
+    return regressions
+
+def format_results(results):
+    lines = ["%-18s %10s %10s %10s %14s %12s" % ('scenario', 'p50 ms', 'p90 ms', 'p99 ms', 'lines/s', 'peak KiB')]
+    for name, r in sorted(results.items()):
+        peak = "%.1f" % (r['peak_memory'] / 1024.0) if r['peak_memory'] is not None else '-'
+        lines.append("%-18s %10.3f %10.3f %10.3f %14.0f %12s" % (name, r['p50'] * 1000, r['p90'] * 1000, r['p99'] * 1000, r['lines_per_second'], peak))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m mdx_include.test.bench', description='Benchmarks for include processing.')
+    parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS, help='scenario to run, can be repeated (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='number of measured runs per scenario')
+    parser.add_argument('--scale', type=int, default=1, help='divide the corpus sizes by this factor')
+    parser.add_argument('--latency', type=float, default=0.02, help='latency in seconds of the HTTP stub')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    if not args.scenario or 'include_free' in args.scenario:
+        res = bench_include_free(200000 // args.scale)
+        print("include free document, %(lines)d lines: fast path %(fast).4fs, regex scan %(regex).4fs, speedup %(speedup).1fx" % res)
+    if not args.scenario or 'adversarial' in args.scenario:
+        res = bench_adversarial()
+        print("adversarial line, %(length)d characters: scanner %(scanner).6fs, regex %(regex).4fs, speedup %(speedup).0fx" % res)
+    results = run_scenarios(args.scenario or SCENARIOS, args.repeat, args.scale, args.latency)
+    print(format_results(results))
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
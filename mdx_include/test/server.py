@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""A local HTTP server standing in for remote hosts, used by the tests and the benchmark"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import gzip
+import hashlib
+import io
+import threading
+import time
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+class RemoteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            body = server.files.get(self.path.lstrip('/'))
+            if body is None:
+                self.send_error(404)
+                return
+            body = body.replace('{url}', server.url('')).encode('utf-8')
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                server.not_modified += 1
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(server.status)
+            self.send_header('ETag', etag)
+            if server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                buf = io.BytesIO()
+                with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                    f.write(body)
+                body = buf.getvalue()
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if server.trickle:
+                # a slow body: one byte at a time
+                for i in range(len(body)):
+                    self.wfile.write(body[i:i + 1])
+                    self.wfile.flush()
+                    time.sleep(server.trickle)
+            else:
+                self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveHandler(RemoteHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        RemoteHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+
+class RemoteServer(ThreadingMixIn, HTTPServer):
+    """A local stand-in for remote hosts serving the files dict"""
+    daemon_threads = True
+
+    def __init__(self, files, delay=0, handler=RemoteHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.files = files
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.not_modified = 0
+        self.connections = 0
+        self.gzip = False
+        self.status = 200
+        self.trickle = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.server_port, path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
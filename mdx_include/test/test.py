@@ -5,9 +5,37 @@ from __future__ import unicode_literals
 # from codecs import open
 # import sys
 import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import markdown
 import unittest
+try:
+    import asyncio
+except ImportError:
+    # python 2
+    asyncio = None
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
 from mdx_include.mdx_include import IncludeExtension
+from mdx_include.mdx_include import EncodingRegistry
+from mdx_include.mdx_include import get_literal_prefix
+from mdx_include.mdx_include import DependencyGraph
+from mdx_include import convert_batch
+from mdx_include.cli import expand_tree
+from mdx_include import version
+from mdx_include.failures import SingleFlight, FailureLog
+from mdx_include.lines import LineBuffer
+from mdx_include.store import DictStore, SQLiteStore, SnapshotStore, iter_cache_items
+from mdx_include.budget import IncludeBudgetExceeded
+from mdx_include.test.server import RemoteServer, KeepAliveHandler
 
 LOGGER_NAME = 'mdx_include_test'
 log = logging.getLogger(LOGGER_NAME)
@@ -303,6 +331,900 @@ This is a test with relative include
         # ~ print(html)
         self.assertEqual(html, output.strip())
 
+    def test_encoding_registry(self):
+        registry = EncodingRegistry()
+        self.assertFalse(registry.info()['scanned'])
+        self.assertTrue(registry.exists('utf-8'))
+        self.assertTrue(registry.exists('utf_8'))
+        self.assertTrue(registry.exists('latin1'))
+        self.assertTrue(registry.exists('utf8'))
+        self.assertFalse(registry.exists('Invalid'))
+        self.assertFalse(registry.exists(None))
+        info = registry.info()
+        self.assertTrue(info['scanned'])
+        self.assertIn('latin1', info['known'])
+        self.assertEqual(info['unknown'], ['Invalid'])
+        registry.reset()
+        self.assertEqual(registry.info(), {'scanned': False, 'modules': 0, 'known': [], 'unknown': []})
+
+    def test_cache_validation(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'a.md')
+            with open(path, 'w') as f:
+                f.write('first')
+            md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir})])
+            self.assertEqual(md.convert('{! a.md !}'), '<p>first</p>')
+            self.assertEqual(md.convert('{! a.md !}'), '<p>first</p>')
+            with open(path, 'w') as f:
+                f.write('second version')
+            self.assertEqual(md.convert('{! a.md !}'), '<p>second version</p>')
+            stats = md.mdx_include_get_content_cache_local().stats()
+            self.assertEqual(stats['hits'], 1)
+            self.assertEqual(stats['invalidations'], 1)
+            # manually stored entries are served as they are
+            md.mdx_include_get_content_cache_local()[path] = ['modified']
+            self.assertEqual(md.convert('{! a.md !}'), '<p>modified</p>')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_cache_lru(self):
+        configs = {
+            'base_path': 'mdx_include/test/',
+            'content_cache_local_max_entries': 2,
+        }
+        md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+        md.convert('{! test1.md !} {! test2.md !}')
+        md.convert('{! test1.md !} {!- d.md !}')
+        cache = md.mdx_include_get_content_cache_local()
+        self.assertEqual(list(cache.keys()), ['mdx_include/test/test1.md', 'mdx_include/test/d.md'])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        md = markdown.Markdown(extensions=[IncludeExtension({'base_path': 'mdx_include/test/', 'content_cache_local_max_bytes': 1})])
+        md.convert('{! test1.md !}')
+        self.assertEqual(md.mdx_include_get_content_cache_local(), {})
+
+    def test_remote_prefetch(self):
+        files = {
+            'a.md': 'A {! {url}b.md !}',
+            'b.md': 'B',
+            'c.md': 'C',
+            'd.md': 'D',
+        }
+        server = RemoteServer(files, delay=0.2)
+        try:
+            text = ' '.join('{! %s !}' % server.url(x) for x in ['a.md', 'c.md', 'd.md', 'missing.md', 'c.md'])
+            md = markdown.Markdown(extensions=[IncludeExtension({'recurs_remote': True})])
+            sequential = md.convert(text)
+            self.assertEqual(server.max_active, 1)
+            del server.requests[:]
+            md = markdown.Markdown(extensions=[IncludeExtension({'recurs_remote': True, 'remote_prefetch': True})])
+            self.assertEqual(md.convert(text), sequential)
+            self.assertEqual(sequential, '<p>A B C D\n  C</p>')
+            self.assertEqual(sorted(server.requests), ['/a.md', '/b.md', '/c.md', '/d.md', '/missing.md'])
+            self.assertEqual(server.requests[-1], '/b.md')
+            self.assertTrue(server.max_active > 1)
+            server.max_active = 0
+            md = markdown.Markdown(extensions=[IncludeExtension({'remote_prefetch': True, 'remote_prefetch_per_host': 1})])
+            md.convert(text)
+            self.assertEqual(server.max_active, 1)
+        finally:
+            server.close()
+
+    def test_remote_disk_cache(self):
+        server = RemoteServer({'a.md': 'A', 'slow.md': 'S'})
+        tmpdir = tempfile.mkdtemp()
+        try:
+            text = '{! %s !}' % server.url('a.md')
+            configs = {'remote_cache_dir': tmpdir, 'remote_timeout': 5}
+            md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+            self.assertEqual(md.convert(text), '<p>A</p>')
+            # a new instance revalidates the persistent entry
+            md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+            self.assertEqual(md.convert(text), '<p>A</p>')
+            self.assertEqual(server.requests, ['/a.md', '/a.md'])
+            self.assertEqual(server.not_modified, 1)
+            # fresh entries are used without network access
+            md = markdown.Markdown(extensions=[IncludeExtension(dict(configs, remote_cache_ttl=60))])
+            self.assertEqual(md.convert(text), '<p>A</p>')
+            self.assertEqual(len(server.requests), 2)
+            # a timeout does not hang the build
+            server.delay = 2
+            md = markdown.Markdown(extensions=[IncludeExtension({'remote_timeout': 0.2})])
+            start = time.time()
+            self.assertEqual(md.convert('{! %s !}' % server.url('slow.md')), '')
+            self.assertTrue(time.time() - start < 1.5)
+        finally:
+            server.close()
+        md = markdown.Markdown(extensions=[IncludeExtension(dict(configs, remote_offline=True))])
+        try:
+            self.assertEqual(md.convert(text), '<p>A</p>')
+            self.assertEqual(md.convert('{! %s !}' % server.url('b.md')), '')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_literal_prefix(self):
+        self.assertEqual(get_literal_prefix(r'\{!'), '{!')
+        self.assertEqual(get_literal_prefix(r'<<<?\s*'), '<<')
+        self.assertEqual(get_literal_prefix(r'\{!|\{\{'), '')
+        self.assertEqual(get_literal_prefix(r'[{]!'), '')
+        md = markdown.Markdown(extensions=[IncludeExtension({'base_path': 'mdx_include/test/', 'syntax_left': r'<<<?'})])
+        self.assertEqual(md.convert('a <<test1.md!} b <<<test1.md!}'), '<p>a <strong>This is test1.md</strong> b <strong>This is test1.md</strong></p>')
+        self.assertEqual(md.convert('no include here'), '<p>no include here</p>')
+
+    def test_expanded_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            files = {
+                'header.md': 'H {! part.md !}',
+                'part.md': 'P',
+                'c.md': 'C {! x.md !}',
+                'x.md': 'X {! c.md !}',
+            }
+            for name, content in files.items():
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(content)
+            configs = {'base_path': tmpdir, 'allow_circular_inclusion': True}
+            md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+            text = '\n\n'.join(['{! header.md !}'] * 3)
+            self.assertEqual(md.convert(text), '<p>H P</p>\n<p>H P</p>\n<p>H P</p>')
+            cache = md.preprocessors['mdx_include'].mdx_include_expanded_cache
+            self.assertIn(('local', os.path.join(tmpdir, 'header.md'), None, 'utf-8', False), cache)
+            # a change in a transitive dependency invalidates the entry
+            with open(os.path.join(tmpdir, 'part.md'), 'w') as f:
+                f.write('Changed')
+            self.assertEqual(md.convert('{! header.md !}'), '<p>H Changed</p>')
+            # the same file expands differently depending on its ancestors
+            text = '{! c.md !}\n\n{! x.md !}\n\n{! c.md !}'
+            uncached = markdown.Markdown(extensions=[IncludeExtension(dict(configs, expanded_cache=False))])
+            self.assertEqual(md.convert(text), uncached.convert(text))
+            self.assertEqual(md.convert(text), uncached.convert(text))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_dependency_graph(self):
+        md = markdown.Markdown(extensions=[IncludeExtension({'base_path': 'mdx_include/test/'})])
+        header = os.path.normpath('mdx_include/test/header.md')
+        part = os.path.normpath('mdx_include/test/test1.md')
+        d = os.path.normpath('mdx_include/test/d.md')
+        a = os.path.normpath('mdx_include/test/md/a.md')
+        md.convert('{! test1.md !}')
+        self.assertEqual(md.mdx_include_get_dependencies(), [part])
+        self.assertEqual(md.mdx_include_get_dependency_graph().documents, {})
+        for i in range(2):
+            # the second time the expanded cache is used
+            md.mdx_include_set_document('page1.md')
+            md.convert('{! d.md !} {! header.md !}')
+            md.mdx_include_set_document('page2.md')
+            md.convert('{! test1.md !}')
+        graph = md.mdx_include_get_dependency_graph()
+        self.assertEqual(graph.get_dependencies('page1.md'), sorted([d, a, header]))
+        self.assertEqual(graph.get_relations('page1.md')[a], [d])
+        self.assertEqual(graph.get_dependents(part), ['page2.md'])
+        self.assertEqual(graph.get_affected([a, part]), ['page1.md', 'page2.md'])
+        graph = DependencyGraph.from_json(graph.to_json())
+        self.assertEqual(graph.get_dependencies('page1.md'), sorted([d, a, header]))
+        self.assertEqual(graph.get_affected([header]), ['page1.md'])
+        graph.remove('page1.md')
+        self.assertEqual(graph.get_affected([header]), [])
+
+    def test_streaming(self):
+        texts = [
+            '{! testfls.md [ln:4.6-4.3] !}\n\n{! testfls.md [ln:1.2-2.13,6.4-2.3] !}',
+            '{! testcya.md !}',
+            '{! c.md !}\n\n{! md/b.md !} and {!> test1.md !}',
+            '\\{! test1.md !} {! missing.md !} {! test2.md !}',
+        ]
+        configs = {'base_path': 'mdx_include/test/', 'allow_circular_inclusion': True}
+        for text in texts:
+            md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+            streaming = markdown.Markdown(extensions=[IncludeExtension(dict(configs, streaming=True))])
+            self.assertEqual(streaming.convert(text), md.convert(text))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'big.md'), 'w') as f:
+                for i in range(20000):
+                    f.write('A generated line with some data: %d\r\n' % i)
+            peaks = [0, 0]
+            for streaming in (False, True):
+                md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'streaming': streaming})])
+                pre = md.preprocessors['mdx_include']
+                if tracemalloc:
+                    tracemalloc.start()
+                try:
+                    lines = pre.run(['start', 'x {! big.md !} y'])
+                    if tracemalloc:
+                        peaks[streaming] = tracemalloc.get_traced_memory()[1]
+                finally:
+                    if tracemalloc:
+                        tracemalloc.stop()
+                self.assertEqual(len(lines), 20002)
+                self.assertEqual(lines[1], 'x A generated line with some data: 0')
+                self.assertEqual(lines[-1], ' y')
+            if tracemalloc:
+                self.assertTrue(peaks[1] < peaks[0], peaks)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_partial_read(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'big.md')
+            with open(path, 'w') as f:
+                for i in range(1, 10001):
+                    f.write('line %d\n' % i)
+            md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir})])
+            full = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'partial_read': False})])
+            pre = md.preprocessors['mdx_include']
+            for text in ['{! big.md [ln:1-3] !}', '{! big.md [ln:2.3-20,5-4] !}', '{! big.md [ln:.2-.3] !}']:
+                self.assertEqual(md.convert(text), full.convert(text))
+            self.assertEqual(md.convert('{! big.md [ln:2-3] !}'), '<p>line 2\nline 3</p>')
+            self.assertEqual(pre.mdx_include_content_cache_local_heads, {})
+            md.mdx_include_content_cache_clean_local()
+            md.convert('{! big.md [ln:1-3] !}')
+            self.assertEqual(md.mdx_include_get_content_cache_local(), {})
+            self.assertEqual(len(pre.mdx_include_content_cache_local_heads[path]), 4)
+            # a head too short is read again at least twice as long
+            md.convert('{! big.md [ln:5] !}')
+            self.assertEqual(len(pre.mdx_include_content_cache_local_heads[path]), 9)
+            # a slice depending on the end of the file needs the whole file
+            self.assertEqual(md.convert('{! big.md [ln:-9999] !}'), '<p>line 10000\nline 9999</p>')
+            self.assertEqual(pre.mdx_include_content_cache_local_heads, {})
+            self.assertEqual(len(md.mdx_include_get_content_cache_local()[path]), 10001)
+            # a short file read completely goes to the content cache
+            md.mdx_include_content_cache_clean_local()
+            self.assertEqual(md.convert('{! test1.md [ln:1-5] !}'.replace('test1.md', os.path.abspath('mdx_include/test/test1.md'))), '<p><strong>This is test1.md</strong></p>')
+            self.assertEqual(list(md.mdx_include_get_content_cache_local().keys()), [os.path.abspath('mdx_include/test/test1.md')])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_content_store(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'a.md')
+            with open(path, 'w') as f:
+                f.write('first')
+            stores = [DictStore(), SQLiteStore(os.path.join(tmpdir, 'store.db'))]
+            for store in stores:
+                md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'content_store': store})])
+                self.assertEqual(md.convert('{! a.md !}'), '<p>first</p>')
+                lines, signature = store.get('local:' + path)
+                self.assertEqual(lines, ['first'])
+                # another instance is served from the store
+                md2 = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'content_store': store})])
+                store.set('local:' + path, ['from store'], signature)
+                self.assertEqual(md2.convert('{! a.md !}'), '<p>from store</p>')
+                # a stale entry is not used
+                store.set('local:' + path, ['stale'], (0, 0, 0))
+                md3 = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'content_store': store})])
+                self.assertEqual(md3.convert('{! a.md !}'), '<p>first</p>')
+            # the SQLite store is shared through the file
+            self.assertEqual(SQLiteStore(stores[1].path).get('local:' + path)[0], ['first'])
+            stores[1].close()
+
+            md.mdx_include_get_content_cache_remote()['https://example.com/b.md'] = ['remote content']
+            snapshot = SnapshotStore.build(os.path.join(tmpdir, 'snapshot'), iter_cache_items(md.mdx_include_get_content_cache_local(), md.mdx_include_get_content_cache_remote()))
+            self.assertEqual(len(snapshot), 2)
+            self.assertRaises(TypeError, snapshot.set, 'local:x', ['x'])
+            attached = SnapshotStore(snapshot.path)
+            md4 = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'content_store': attached})])
+            self.assertEqual(md4.convert('{! a.md !} {! https://example.com/b.md !}'), '<p>first remote content</p>')
+            snapshot.close()
+            attached.close()
+            self.assertRaises(TypeError, IncludeExtension, {'partial_read': DictStore()})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_convert_batch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name, text in [('a.md', 'A'), ('b.md', 'B {! a.md !}'), ('c.md', 'C')]:
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(text)
+            texts = ['{! a.md !} %d' % i for i in range(5)] + ['{!+ b.md !}', '{! c.md !} {! missing.md !}', '{! c.md !}', 'plain']
+            configs = {'base_path': tmpdir}
+            serial = convert_batch(texts, configs, processes=0)
+            parallel = convert_batch(texts, configs, processes=2, chunk_size=2)
+            self.assertEqual([r.html for r in parallel], [r.html for r in serial])
+            self.assertEqual([r.index for r in parallel], list(range(len(texts))))
+            self.assertEqual(parallel[0].html, '<p>A 0</p>')
+            self.assertEqual(parallel[5].html, '<p>B A</p>')
+            self.assertEqual(parallel[5].dependencies, [os.path.join(tmpdir, 'a.md'), os.path.join(tmpdir, 'b.md')])
+            self.assertTrue(all(r.ok and r.seconds >= 0 for r in parallel))
+            # errors are reported per document
+            results = convert_batch(['{! a.md !}', '{! x.md !}'], {'base_path': tmpdir, 'truncate_on_failure': False}, processes=0)
+            self.assertEqual(results[1].html, '<p>{! x.md !}</p>')
+            paths = []
+            for name in ['x.md', 'y.md']:
+                paths.append(os.path.join(tmpdir, name))
+                with open(paths[-1], 'w') as f:
+                    f.write('{! a.md !} {! x.md !}')
+            results = convert_batch(paths, {'base_path': tmpdir, 'recurs_local': True}, paths=True, processes=2)
+            self.assertFalse(results[0].ok)
+            self.assertTrue(results[0].error.startswith('RuntimeError'))
+            self.assertEqual(results[1].path, paths[1])
+            # the configs are pickled for the worker processes
+            self.assertRaises(ValueError, convert_batch, texts, dict(configs, metrics_callback=lambda span: None), processes=2)
+        finally:
+            shutil.rmtree(tmpdir)
+        # the parent downloads the remote includes of all the documents in parallel
+        server = RemoteServer(dict(('r%d.md' % i, 'R%d' % i) for i in range(4)), delay=0.2)
+        try:
+            texts = ['{! %s !}' % server.url('r%d.md' % i) for i in range(4)]
+            results = convert_batch(texts, processes=2)
+            self.assertEqual([r.html for r in results], ['<p>R%d</p>' % i for i in range(4)])
+            self.assertEqual(len(server.requests), 4)
+            self.assertTrue(server.max_active > 1)
+        finally:
+            server.close()
+
+    def test_cli_expand_tree(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src')
+            out = os.path.join(tmpdir, 'out')
+            os.makedirs(os.path.join(src, 'sub'))
+            header = os.path.join(tmpdir, 'header.md')
+            files = [(header, 'HEAD'), (os.path.join(src, 'a.md'), '{! header.md !} a'),
+                     (os.path.join(src, 'sub', 'b.md'), '{! header.md !} b\n\\{! x !}'), (os.path.join(src, 'c.txt'), 'c')]
+            for path, text in files:
+                with open(path, 'w') as f:
+                    f.write(text)
+            configs = {'base_path': tmpdir}
+            stats = expand_tree(src, out, configs, processes=2)
+            self.assertEqual((stats['files'], stats['expanded'], stats['skipped'], stats['failed']), (2, 2, 0, []))
+            with open(os.path.join(out, 'sub', 'b.md')) as f:
+                self.assertEqual(f.read(), 'HEAD b\n{! x !}')
+            self.assertFalse(os.path.exists(os.path.join(out, 'c.txt')))
+            stats = expand_tree(src, out, configs, processes=2)
+            self.assertEqual((stats['expanded'], stats['skipped']), (0, 2))
+            # a changed dependency expands its dependents again
+            with open(header, 'w') as f:
+                f.write('NEW')
+            stats = expand_tree(src, out, configs, processes=1)
+            self.assertEqual((stats['expanded'], stats['skipped']), (2, 0))
+            with open(os.path.join(out, 'a.md')) as f:
+                self.assertEqual(f.read(), 'NEW a')
+            # a changed config expands everything
+            stats = expand_tree(src, out, dict(configs, truncate_on_failure=False), processes=1)
+            self.assertEqual(stats['expanded'], 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(asyncio is None or not hasattr(asyncio, 'ensure_future'), 'asyncio is not available')
+    def test_aconvert(self):
+        files = {
+            'a.md': 'A {! {url}b.md !}',
+            'b.md': 'B',
+            'c.md': 'C',
+        }
+        server = RemoteServer(files, delay=0.3)
+        try:
+            text = ' '.join('{! %s !}' % server.url(x) for x in ['a.md', 'c.md', 'missing.md']) + ' {! mdx_include/test/test1.md !}'
+            expected = markdown.Markdown(extensions=[IncludeExtension({'recurs_remote': True})]).convert(text)
+            del server.requests[:]
+            server.max_active = 0
+            md = markdown.Markdown(extensions=[IncludeExtension({'recurs_remote': True})])
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                start = time.time()
+                ticks = []
+                loop.call_later(0.05, lambda: ticks.append(time.time() - start))
+                results = loop.run_until_complete(asyncio.gather(md.mdx_include_aconvert(text), md.mdx_include_aconvert(text)))
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+            self.assertEqual(results, [expected, expected])
+            # concurrent renders share the downloads, which do not block the loop
+            self.assertEqual(sorted(server.requests), ['/a.md', '/b.md', '/c.md', '/missing.md'])
+            self.assertTrue(server.max_active > 1)
+            self.assertTrue(ticks and ticks[0] < 0.25)
+            self.assertEqual([state.inflight for state in md.preprocessors['mdx_include'].async_states.values()], [{}])
+            # the prefetch downloads are counted in the metrics of the render
+            md = markdown.Markdown(extensions=[IncludeExtension({'recurs_remote': True, 'metrics': True, 'deadline': 60})])
+            loop = asyncio.new_event_loop()
+            try:
+                self.assertEqual(loop.run_until_complete(md.mdx_include_aconvert(text)), expected)
+            finally:
+                loop.close()
+            self.assertEqual(md.mdx_include_get_metrics().downloads, 4)
+            if hasattr(asyncio, 'run'):
+                # each event loop gets its own lock, semaphores and shared downloads
+                for i in range(2):
+                    self.assertEqual(asyncio.run(md.mdx_include_aconvert(text)), expected)
+                self.assertEqual(len(md.preprocessors['mdx_include'].async_states), 1)
+        finally:
+            server.close()
+
+    def test_negative_cache(self):
+        import mdx_include.mdx_include as mod
+        calls = []
+        get_local_content_list = mod.get_local_content_list
+        def counting(filename, encoding):
+            calls.append(filename)
+            return get_local_content_list(filename, encoding)
+        mod.get_local_content_list = counting
+        server = RemoteServer({})
+        try:
+            text = '{! missing.md !} {! missing.md [ln:1] !} {! missing.md !} {! %s !} {! %s !}' % (server.url('dead.md'), server.url('dead.md'))
+            md = markdown.Markdown(extensions=[IncludeExtension({'truncate_on_failure': False})])
+            self.assertEqual(md.convert(text), '<p>%s</p>' % text)
+            self.assertEqual((len(calls), len(server.requests)), (1, 1))
+            # failures are retried in the next conversion by default
+            md.convert(text)
+            self.assertEqual((len(calls), len(server.requests)), (2, 2))
+            md = markdown.Markdown(extensions=[IncludeExtension({'negative_cache_ttl': 60})])
+            md.convert(text)
+            md.convert(text)
+            self.assertEqual((len(calls), len(server.requests)), (3, 3))
+            md.mdx_include_content_cache_clean_remote()
+            md.convert(text)
+            self.assertEqual((len(calls), len(server.requests)), (3, 4))
+            md = markdown.Markdown(extensions=[IncludeExtension({'negative_cache': False})])
+            md.convert(text)
+            self.assertEqual((len(calls), len(server.requests)), (5, 6))
+        finally:
+            mod.get_local_content_list = get_local_content_list
+            server.close()
+
+    def test_single_flight(self):
+        flight = SingleFlight()
+        calls = []
+        def fetch(x):
+            calls.append(x)
+            time.sleep(0.2)
+            return [x]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', fetch, 'a'))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(results, [['a']] * 5)
+        self.assertEqual(flight.shared, 4)
+        self.assertEqual(flight.do('key', fetch, 'b'), ['b'])
+
+    def test_failure_log(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('mdx_include-' + version.__version__)
+        logger.addHandler(handler)
+        try:
+            failures = FailureLog(interval=60)
+            for i in range(3):
+                try:
+                    raise IOError('failed')
+                except IOError:
+                    failures.exception('E: Could not find file: x')
+            self.assertEqual(len(records), 1)
+            self.assertTrue(records[0].exc_info)
+            failures.entries['E: Could not find file: x'][0] -= 60
+            try:
+                raise IOError('failed')
+            except IOError:
+                failures.exception('E: Could not find file: x')
+            self.assertEqual(records[1].getMessage(), 'E: Could not find file: x (2 similar messages suppressed)')
+            # not rate-limited by default
+            failures = FailureLog()
+            for i in range(2):
+                try:
+                    raise IOError('failed')
+                except IOError:
+                    failures.exception('E: Could not find file: x')
+            self.assertEqual(len(records), 4)
+        finally:
+            logger.removeHandler(handler)
+
+    def test_metrics(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name, text in [('a.md', 'A {! b.md !}\n{! c.md [ln:1] !}'), ('b.md', 'B'), ('c.md', 'C1\nC2')]:
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(text)
+            spans = []
+            md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'recursive_relative_path': True,
+                                                                 'metrics_callback': spans.append})])
+            self.assertEqual(md.convert('{! a.md !} {! missing.md !}'), '<p>A B\nC1</p>')
+            metrics = md.mdx_include_get_metrics()
+            self.assertEqual((metrics.includes, metrics.local_includes, metrics.remote_includes, metrics.failed_includes), (4, 4, 0, 1))
+            self.assertEqual((metrics.reads, metrics.local_cache_misses, metrics.max_depth), (4, 4, 2))
+            # the partial read of c.md reads one line after the slice
+            self.assertEqual(metrics.bytes_read, len('A {! b.md !}\n{! c.md [ln:1] !}\n') + len('B\n') + len('C1\nC2\n'))
+            self.assertTrue(metrics.total_time >= metrics.recursion_time > 0 and metrics.slice_time > 0 and metrics.scan_time > 0)
+            a = os.path.join(tmpdir, 'a.md')
+            self.assertEqual([(span.path, span.depth, span.status) for span in metrics.spans],
+                             [(a, 1, True), (os.path.join(tmpdir, 'b.md'), 2, True), (os.path.join(tmpdir, 'c.md'), 2, True), (os.path.join(tmpdir, 'missing.md'), 1, False)])
+            self.assertEqual([(span.parent_id, span.parent) for span in metrics.spans], [(None, ''), (0, a), (0, a), (None, '')])
+            # spans are passed to the callback when they end
+            self.assertEqual([span.id for span in spans], [1, 2, 0, 3])
+            md.convert('{! a.md !}')
+            metrics = md.mdx_include_get_metrics()
+            self.assertEqual((metrics.includes, metrics.expanded_cache_hits, metrics.reads), (1, 1, 0))
+            self.assertTrue(metrics.spans[0].cached)
+            self.assertEqual(metrics.to_dict()['expanded_cache_hit_rate'], 1.0)
+            self.assertEqual(markdown.Markdown(extensions=[IncludeExtension()]).mdx_include_get_metrics(), None)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_bench(self):
+        from mdx_include.test import bench
+        results = bench.run_scenarios(['deep_chain', 'huge_slices', 'remote_prefetch'], repeat=2, scale=50, latency=0)
+        self.assertEqual(sorted(results), ['deep_chain', 'huge_slices', 'remote_prefetch'])
+        self.assertEqual(results['deep_chain']['output_lines'], 2)
+        self.assertTrue(results['huge_slices']['p99'] >= results['huge_slices']['p50'] > 0)
+        baseline = {'deep_chain': dict(results['deep_chain'], p50=results['deep_chain']['p50'] / 2)}
+        regressions = bench.compare(results, baseline, 0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('deep_chain: p50'))
+        self.assertEqual(bench.compare(results, results), [])
+        self.assertEqual(bench.get_percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(bench.get_percentile([1, 2, 3, 4], 99), 4)
+
+    def test_lazy_import(self):
+        from mdx_include.test import bench
+        seconds, modules = bench.get_startup(1)
+        self.assertTrue(seconds > 0)
+        self.assertTrue('mdx_include.mdx_include' in modules)
+        for name in ('mdx_include.remote', 'mdx_include.store', 'rcslice', 'cyclic', 'json'):
+            self.assertFalse(name in modules, name)
+        if sys.version_info[0] >= 3:
+            self.assertFalse('urllib.request' in modules)
+
+    def test_compact_lines(self):
+        lines = ['first', '', 'third {! x !}', 'last']
+        buf = LineBuffer.from_lines(lines)
+        self.assertEqual(len(buf), 4)
+        self.assertEqual(list(buf), lines)
+        self.assertEqual((buf[0], buf[-1], buf[1:3], buf[::-2]), ('first', 'last', ['', 'third {! x !}'], ['last', '']))
+        self.assertEqual(buf.find_lines('{!'), [2])
+        self.assertEqual(LineBuffer.from_lines([]), [])
+        self.assertRaises(IndexError, lambda: buf[4])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'big.md')
+            with open(path, 'w') as f:
+                for i in range(1, 20001):
+                    f.write('line %d\n' % i)
+            with open(os.path.join(tmpdir, 'a.md'), 'w') as f:
+                f.write('A {! big.md [ln:2-3] !}\nno include\n{! big.md [ln:1.2-1.3] !}')
+            text = '{! a.md !} {! big.md [ln:19999-20000] !} {! big.md [ln:-19999] !}'
+            md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'compact_lines': True})])
+            lists = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir})])
+            copies = LineBuffer.copies
+            self.assertEqual(md.convert(text), lists.convert(text))
+            # only the included lines and the lines to process are materialized
+            self.assertTrue(LineBuffer.copies - copies < 20)
+            self.assertTrue(isinstance(md.mdx_include_get_content_cache_local()[path], LineBuffer))
+            compact = md.mdx_include_get_content_cache_local().stats()
+            default = lists.mdx_include_get_content_cache_local().stats()
+            self.assertEqual(compact['bytes'], default['bytes'])
+            self.assertTrue(compact['memory'] * 4 < default['memory'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_glob(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            changes = os.path.join(tmpdir, 'changes')
+            os.makedirs(os.path.join(changes, 'sub'))
+            for name, text in [('b.md', 'B1\nB2'), ('a.md', 'A {!+ ../c.md !}'), ('.hidden.md', 'H'),
+                               ('notes.txt', 'T'), ('sub/d.md', 'D'), ('../c.md', 'C')]:
+                with open(os.path.join(changes, name), 'w') as f:
+                    f.write(text)
+            configs = {'base_path': tmpdir, 'recursive_relative_path': True, 'metrics': True, 'allow_glob': True}
+            md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+            self.assertEqual(md.convert('{! changes/*.md !}'), '<p>A C</p>\n<p>B1\nB2</p>')
+            self.assertEqual(md.mdx_include_get_metrics().reads, 3)
+            self.assertEqual(md.mdx_include_get_dependencies(), [os.path.join(tmpdir, n) for n in ['c.md', 'changes', 'changes/a.md', 'changes/b.md']])
+            self.assertEqual(md.convert('{! changes/ [ln:1] !}'), '<p>A C</p>\n<p>B1</p>\n<p>T</p>')
+            self.assertEqual(md.convert('{! */*/?.md !}'), '<p>D</p>')
+            self.assertEqual(md.convert('{! changes/.*.md !}'), '<p>H</p>')
+            self.assertEqual(md.convert('x {! changes/*.rst !}'), '<p>x </p>')
+            # new files are seen, the listing is validated like file content
+            with open(os.path.join(changes, 'c.md'), 'w') as f:
+                f.write('new')
+            os.utime(changes, (time.time() + 10, time.time() + 10))
+            sep = markdown.Markdown(extensions=[IncludeExtension(dict(configs, glob_separator=['|'], glob_workers=1))])
+            self.assertEqual(sep.convert('{! changes/*.md !}'), '<p>A C\n|\nB1\nB2\n|\nnew</p>')
+            self.assertEqual(md.convert('{! changes/*.md !}'), '<p>A C</p>\n<p>B1\nB2</p>\n<p>new</p>')
+            # each file is checked for circular inclusion
+            with open(os.path.join(changes, 'c.md'), 'w') as f:
+                f.write('{!+ *.md !}')
+            self.assertRaises(RuntimeError, md.convert, '{!+ changes/c.md !}')
+            # disabled by default, the path is a file path
+            off = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'truncate_on_failure': False})])
+            self.assertEqual(off.convert('{! changes/*.md !}'), '<p>{! changes/*.md !}</p>')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_resolve_path_memo(self):
+        md = markdown.Markdown(extensions=[IncludeExtension({'base_path': 'docs', 'recursive_relative_path': True})])
+        pre = md.preprocessors['mdx_include']
+        resolved = pre.mdx_include_resolve_path('a.md', '')
+        self.assertEqual(resolved, ('local', os.path.join('docs', 'a.md')))
+        self.assertTrue(pre.mdx_include_resolve_path('a.md', '') is resolved)
+        self.assertEqual(pre.mdx_include_resolve_path('a.md', os.path.join('x', 'b.md')), ('local', os.path.join('x', 'a.md')))
+        self.assertEqual(pre.mdx_include_resolve_path('https://example.com/a.md/', ''), ('remote', 'https://example.com/a.md'))
+        self.assertEqual(len(pre.resolved_paths), 3)
+        # changing a setting drops the memo
+        pre.base_path = 'other'
+        self.assertEqual(pre.mdx_include_resolve_path('a.md', ''), ('local', os.path.join('other', 'a.md')))
+        pre.allow_local = False
+        self.assertEqual(pre.mdx_include_resolve_path('a.md', ''), (None, 'a.md'))
+        self.assertEqual(len(pre.resolved_paths), 1)
+
+    def test_scanner(self):
+        rng = random.Random(21)
+        tokens = ['{!', '!}', '{', '}', '!', '|', '[', ']', '[ln:', '1-2', '.', ',', '+', '-', '>', ' ', '\t',
+                  '\\', 'a.md', '\u3000', '<<', '>>', ';', '@']
+        for configs in [{}, {'syntax_left': '<<', 'syntax_right': '>>', 'syntax_delim': ';', 'syntax_apply_indent': '@'}]:
+            md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+            pre = md.preprocessors['mdx_include']
+            self.assertTrue(pre.include_finder is pre.scanner)
+            for i in range(5000):
+                line = ''.join(rng.choice(tokens) for j in range(rng.randint(0, 20)))
+                expected = [(m.span(), m.group(0), m.groupdict()) for m in pre.compiled_re.finditer(line)]
+                self.assertEqual([(m.span(), m.group(0), m.groupdict()) for m in pre.scanner.finditer(line)], expected, line)
+        # the regex is used for syntax configs that are not literals
+        md = markdown.Markdown(extensions=[IncludeExtension({'syntax_left': r'\{+!'})])
+        self.assertTrue(md.preprocessors['mdx_include'].scanner is None)
+        md = markdown.Markdown(extensions=[IncludeExtension({'scanner': False})])
+        self.assertTrue(md.preprocessors['mdx_include'].include_finder is md.preprocessors['mdx_include'].compiled_re)
+        # linear time where the regex takes seconds
+        from mdx_include.test import bench
+        line = bench.make_adversarial_line(20000) + '{! mdx_include/test/test1.md | utf-8 !}'
+        scanner = markdown.Markdown(extensions=[IncludeExtension()]).preprocessors['mdx_include'].scanner
+        start = time.time()
+        matches = list(scanner.finditer(line))
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual([m.group('path') for m in matches], ['a'])
+
+
+    def test_budget(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name, text in [('a.md', 'A1\n{! b.md !}'), ('b.md', 'B1\n{! c.md !}'), ('c.md', 'C1')]:
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(text)
+            text = '{! a.md !}\n\n{! c.md !}'
+            md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir})])
+            self.assertEqual(md.convert(text), '<p>A1\nB1\nC1</p>\n<p>C1</p>')
+            self.assertTrue(md.mdx_include_get_budget() is None)
+            for configs, html, usage, exceeded in [
+                    ({'max_includes': 10}, '<p>A1\nB1\nC1</p>\n<p>C1</p>', (3, 34, 4), {}),
+                    ({'max_depth': 2}, '<p>A1\nB1</p>\n<p>C1</p>', (2, 31, 3), {'depth': 1}),
+                    ({'max_depth': 2, 'budget_policy': 'keep'}, '<p>A1\nB1\n{! c.md !}</p>\n<p>C1</p>', (2, 31, 3), {'depth': 1}),
+                    ({'max_includes': 2}, '<p>A1\nB1</p>', (2, 28, 2), {'includes': 2}),
+                    ({'max_included_bytes': 12}, '<p>C1</p>', (1, 3, 2), {'bytes': 1}),
+                    ]:
+                md = markdown.Markdown(extensions=[IncludeExtension(dict(configs, base_path=tmpdir))])
+                for i in range(2):
+                    # the second conversion is served from the expanded cache when possible
+                    self.assertEqual(md.convert(text), html)
+                    budget = md.mdx_include_get_budget()
+                    self.assertEqual((budget.depth, budget.bytes, budget.includes), usage)
+                    self.assertEqual(budget.exceeded, exceeded)
+            md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'max_depth': 1, 'budget_policy': 'raise'})])
+            self.assertRaises(IncludeBudgetExceeded, md.convert, text)
+            self.assertRaises(ValueError, markdown.Markdown, extensions=[IncludeExtension({'budget_policy': 'ignore'})])
+            # the depth of an include comes from its own occurrence of the including file
+            for name, text in [('x.md', 'X\n{! y.md !}\n{! z.md !}'), ('y.md', '{! x.md !}'), ('z.md', 'Z')]:
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(text)
+            for streaming in (False, True):
+                md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'max_depth': 3, 'budget_policy': 'raise',
+                                                                     'allow_circular_inclusion': True, 'streaming': streaming})])
+                self.assertEqual(md.convert('{! x.md !}'), '<p>X\nX\n{! y.md !}\n{! z.md !}\nZ</p>')
+                self.assertEqual(md.mdx_include_get_budget().depth, 3)
+        finally:
+            shutil.rmtree(tmpdir)
+        # the deadline shortens the download timeout
+        server = RemoteServer({'slow.md': 'S'}, delay=2)
+        try:
+            md = markdown.Markdown(extensions=[IncludeExtension({'deadline': 0.3})])
+            start = time.time()
+            self.assertEqual(md.convert('x {! %s !} {! %s !}' % (server.url('slow.md'), server.url('slow.md'))), '<p>x </p>')
+            self.assertTrue(time.time() - start < 1.5)
+            self.assertEqual(md.mdx_include_get_budget().exceeded, {'deadline': 2})
+        finally:
+            server.close()
+
+
+    def test_watch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            a = os.path.join(tmpdir, 'a.md')
+            for name, text in [('a.md', 'A'), ('b.md', 'B {! a.md !}'), ('d/x.md', 'X')]:
+                if not os.path.isdir(os.path.dirname(os.path.join(tmpdir, name))):
+                    os.makedirs(os.path.dirname(os.path.join(tmpdir, name)))
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(text)
+            for inotify in [True, False]:
+                md = markdown.Markdown(extensions=[IncludeExtension({'base_path': tmpdir, 'recursive_relative_path': True, 'allow_glob': True})])
+                pre = md.preprocessors['mdx_include']
+                for document, text in [('doc1', '{! b.md !}'), ('doc2', '{! d/ !}'), ('doc3', '{! d/x.md !}')]:
+                    md.mdx_include_set_document(document)
+                    md.convert(text)
+                changes = []
+                def callback(paths, documents):
+                    changes.append((paths, documents))
+                def wait_for(path):
+                    # a save can be reported in several changes
+                    deadline = time.time() + 5
+                    while time.time() < deadline:
+                        for paths, documents in list(changes):
+                            if path in paths:
+                                return documents
+                        time.sleep(0.01)
+                watcher = md.mdx_include_watch(callback, interval=0.05, inotify=inotify)
+                try:
+                    if inotify and sys.platform.startswith('linux'):
+                        self.assertEqual(watcher.backend, 'inotify')
+                    # cached content is not validated while watched
+                    self.assertTrue(pre.mdx_include_content_cache_local.watched)
+                    time.sleep(0.2)
+                    # saved by renaming, the file is never seen half written
+                    with open(a + '.tmp', 'w') as f:
+                        f.write('A2' if inotify else 'A3')
+                    os.rename(a + '.tmp', a)
+                    self.assertEqual(wait_for(a), ['doc1'])
+                    self.assertFalse(a in pre.mdx_include_content_cache_local)
+                    md.mdx_include_set_document('doc1')
+                    self.assertEqual(md.convert('{! b.md !}'), '<p>B A2</p>' if inotify else '<p>B A3</p>')
+                    # a new file changes the listing of the directory
+                    with open(os.path.join(tmpdir, 'd', 'y%s.md' % inotify), 'w') as f:
+                        f.write('Y')
+                    self.assertEqual(wait_for(os.path.join(tmpdir, 'd')), ['doc2'])
+                    self.assertTrue(os.path.join(tmpdir, 'd', 'x.md') in pre.mdx_include_content_cache_local)
+                    # paths removed from the caches are not watched anymore
+                    md.mdx_include_content_cache_clean_local()
+                    deadline = time.time() + 5
+                    watched = lambda: (watcher.signatures, watcher.abspaths, watcher.polled, watcher.dirs, watcher.wds)
+                    while any(watched()) and time.time() < deadline:
+                        time.sleep(0.01)
+                    self.assertEqual(watched(), ({}, {}, set(), set(), {}))
+                finally:
+                    watcher.stop()
+                self.assertTrue(pre.watcher is None)
+                self.assertFalse(watcher.thread.is_alive())
+                self.assertFalse(pre.mdx_include_content_cache_local.watched)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_render_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            a = os.path.join(tmpdir, 'a.md')
+            for name, text in [('a.md', 'A\nA2'), ('b.md', '# B {! a.md [ln:1] !}\n\n{! a.md !}'), ('d/x.md', 'X')]:
+                if not os.path.isdir(os.path.dirname(os.path.join(tmpdir, name))):
+                    os.makedirs(os.path.dirname(os.path.join(tmpdir, name)))
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write(text)
+            configs = {'base_path': tmpdir, 'render_cache': True, 'allow_glob': True, 'render_cache_dir': os.path.join(tmpdir, 'cache')}
+            md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+            cache = md.mdx_include_get_render_cache()
+            text = '{! b.md !}\n\n{! d/ !}'
+            html = '<h1>B A</h1>\n<p>A\nA2</p>\n<p>X</p>'
+            for i in range(2):
+                md.mdx_include_set_document('doc')
+                self.assertEqual(md.convert(text), html)
+                self.assertEqual(md.mdx_include_get_dependencies(), [a, os.path.join(tmpdir, 'b.md'), os.path.join(tmpdir, 'd'), os.path.join(tmpdir, 'd', 'x.md')])
+            self.assertEqual((cache.hits, cache.misses, cache.stores), (1, 1, 1))
+            self.assertEqual(md.mdx_include_get_dependency_graph().get_dependents(a), ['doc'])
+            # the same content with new metadata
+            os.utime(a, (time.time() + 10, time.time() + 10))
+            self.assertEqual(md.convert(text), html)
+            self.assertEqual(cache.hits, 2)
+            with open(a, 'w') as f:
+                f.write('Z\nA2')
+            self.assertEqual(md.convert(text), '<h1>B Z</h1>\n<p>Z\nA2</p>\n<p>X</p>')
+            with open(os.path.join(tmpdir, 'd', 'y.md'), 'w') as f:
+                f.write('Y')
+            os.utime(os.path.join(tmpdir, 'd'), (time.time() + 20, time.time() + 20))
+            self.assertEqual(md.convert(text), '<h1>B Z</h1>\n<p>Z\nA2</p>\n<p>X</p>\n<p>Y</p>')
+            self.assertEqual((cache.hits, cache.misses, cache.stores), (2, 3, 3))
+            # another process finds the documents on disk
+            other = markdown.Markdown(extensions=[IncludeExtension(configs)])
+            self.assertEqual(other.convert(text), '<h1>B Z</h1>\n<p>Z\nA2</p>\n<p>X</p>\n<p>Y</p>')
+            self.assertEqual(other.mdx_include_get_render_cache().hits, 1)
+            # different configs do not share documents
+            other = markdown.Markdown(extensions=[IncludeExtension(dict(configs, line_slice_separator=['-']))])
+            other.convert(text)
+            self.assertEqual(other.mdx_include_get_render_cache().hits, 0)
+            # failed includes are tried again
+            md.convert('{! missing.md !}')
+            md.convert('{! missing.md !}')
+            self.assertEqual(cache.stores, 3)
+            # the state set on the markdown object by meta and toc is restored
+            md = markdown.Markdown(extensions=['meta', 'toc', IncludeExtension(configs)])
+            docs = ['title: One\n\n# One {! d/x.md !}', 'title: Two\n\n# Two']
+            for doc in docs + docs:
+                md.convert(doc)
+                name = doc.split()[1]
+                self.assertEqual(md.Meta, {'title': [name]})
+                self.assertTrue(('>%s' % name) in md.toc)
+                self.assertEqual(md.toc_tokens[0]['id'], name.lower() + ('-x' if name == 'One' else ''))
+                md.Meta['title'].append('changed')
+            self.assertEqual(md.mdx_include_get_render_cache().hits, 2)
+            # a hit is validated with the metrics of its own conversion
+            server = RemoteServer({'r.md': 'R'})
+            try:
+                configs = {'render_cache': True, 'metrics': True, 'render_cache_dir': os.path.join(tmpdir, 'remote')}
+                md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+                text = '{! %s !}' % server.url('r.md')
+                md.convert(text)
+                first = md.mdx_include_get_metrics()
+                self.assertEqual(md.convert(text), '<p>R</p>')
+                self.assertEqual(md.mdx_include_get_render_cache().hits, 1)
+                self.assertEqual((first.remote_cache_hits, md.mdx_include_get_metrics().remote_cache_hits), (0, 1))
+                if asyncio is not None and hasattr(asyncio, 'run'):
+                    # a hit after downloads prefetched by aconvert does not keep them
+                    md = markdown.Markdown(extensions=[IncludeExtension(configs)])
+                    self.assertEqual(asyncio.run(md.mdx_include_aconvert(text)), '<p>R</p>')
+                    self.assertEqual(md.mdx_include_get_render_cache().hits, 1)
+                    self.assertEqual(md.preprocessors['mdx_include'].remote_prefetched, {})
+            finally:
+                server.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_connection_pool(self):
+        server = RemoteServer({'a.md': 'A ' * 500, 'b.md': '# B', 'r.md': 'x'}, handler=KeepAliveHandler)
+        server.gzip = True
+        text = '{! %s !}\n\n{! %s !}' % (server.url('a.md'), server.url('b.md'))
+        html = '<p>' + 'A ' * 500 + '</p>\n<h1>B</h1>'
+        try:
+            pool = markdown.Markdown(extensions=[IncludeExtension()]).mdx_include_get_connection_pool()
+            before = pool.stats()
+            # new markdown objects do not share the content caches, only the connections
+            for i in range(3):
+                md = markdown.Markdown(extensions=[IncludeExtension()])
+                self.assertEqual(md.convert(text), html)
+            stats = pool.stats()
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(stats['requests'] - before['requests'], 6)
+            self.assertEqual(stats['connections'] - before['connections'], 1)
+            self.assertEqual(stats['reused'] - before['reused'], 5)
+            self.assertEqual(stats['gzip_responses'] - before['gzip_responses'], 6)
+            self.assertEqual(stats['bytes_decoded'] - before['bytes_decoded'], 3 * (1000 + 3))
+            self.assertLess(stats['bytes_received'] - before['bytes_received'], 1000)
+            # larger than remote_max_size after decompression
+            md = markdown.Markdown(extensions=[IncludeExtension({'remote_max_size': 100})])
+            self.assertEqual(md.convert('{! %s !}' % server.url('a.md')), '')
+            self.assertEqual(md.convert('{! %s !}' % server.url('r.md')), '<p>x</p>')
+            # a new connection for each request without keep alive
+            connections = server.connections
+            md = markdown.Markdown(extensions=[IncludeExtension({'remote_keep_alive': False})])
+            self.assertEqual(md.convert(text), html)
+            self.assertEqual(server.connections, connections + 2)
+            # any 2xx status is a success
+            server.status = 203
+            md = markdown.Markdown(extensions=[IncludeExtension()])
+            self.assertEqual(md.convert(text), html)
+            # a timeout on a reused connection is not sent again
+            self.assertTrue(pool.stats()['idle'] > 0)
+            server.delay = 1
+            requests = len(server.requests)
+            retries = pool.stats()['retries']
+            md = markdown.Markdown(extensions=[IncludeExtension({'remote_timeout': 0.2})])
+            start = time.time()
+            self.assertEqual(md.convert('{! %s !}' % server.url('r.md')), '')
+            self.assertTrue(time.time() - start < 0.9)
+            self.assertEqual((len(server.requests), pool.stats()['retries']), (requests + 1, retries))
+            # a body trickling in faster than the timeout stops at the deadline
+            server.delay = 0
+            server.trickle = 0.05
+            md = markdown.Markdown(extensions=[IncludeExtension({'remote_timeout': 1, 'deadline': 0.3})])
+            start = time.time()
+            self.assertEqual(md.convert('{! %s !}' % server.url('a.md')), '')
+            self.assertTrue(time.time() - start < 0.9)
+        finally:
+            server.close()
+            pool.close()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+'''
+Watch mode for mdx_include
+===========================================
+
+Used by md.mdx_include_watch(). The local files and directories kept in the
+content caches are watched with inotify on Linux (one watch per directory)
+or by polling their metadata. A change evicts the entries of the changed
+paths and calls a callback with the documents depending on them, as
+recorded in the dependency graph.
+
+Copyright Md. Jahidul Hamid <jahidulhamid@yahoo.com>
+
+License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
+
+'''
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import sys
+import errno
+import struct
+import select
+import logging
+import threading
+from collections import deque
+from . import version
+from .mdx_include import get_file_signature
+
+LOGGER_NAME = 'mdx_include-' + version.__version__
+log = logging.getLogger(LOGGER_NAME)
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+
+# entries added, removed or renamed
+IN_ENTRIES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_ENTRIES | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct(str('iIII'))
+
+# seconds to wait for more events after an event, a save often makes several of them
+WATCH_SETTLE_TIME = 0.05
+
+FS_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+
+
+def encode_path(path):
+    if isinstance(path, bytes):
+        return path
+    return os.fsencode(path) if hasattr(os, 'fsencode') else path.encode(FS_ENCODING)
+
+def decode_path(path):
+    return os.fsdecode(path) if hasattr(os, 'fsdecode') else path.decode(FS_ENCODING)
+
+
+class Inotify(object):
+    """Minimal inotify binding with ctypes, raises OSError if inotify is not available"""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = self.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add(self, directory):
+        """Watch a directory and return the watch descriptor"""
+        wd = self.libc.inotify_add_watch(self.fd, encode_path(directory), WATCH_MASK)
+        if wd < 0:
+            err = self.get_errno()
+            raise OSError(err, os.strerror(err), directory)
+        return wd
+
+    def read(self, timeout):
+        """Return the list of (wd, mask, name) events available within timeout seconds"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except (OSError, IOError) as err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, decode_path(name)))
+        return events
+
+    def remove(self, wd):
+        """Stop watching a directory, errors are ignored (e.g. the directory is gone)"""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class IncludeWatcher(object):
+    """Watches the local paths of the content caches of an IncludePreprocessor.
+
+    Paths are watched as they are stored in the caches. Cached content is not
+    validated on use while the watcher runs: a change is seen when the watcher
+    evicts it (at once with inotify, within interval seconds with polling).
+    Conversions and evictions are serialized with lock. Paths removed from all
+    the caches are not watched anymore.
+    """
+
+    def __init__(self, pre, callback=None, interval=1.0, inotify=True):
+        self.pre = pre
+        self.callback = callback
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.added = deque() # (path, signature, is_dir) stored in (is_dir None: removed from) the caches since the last check
+        self.signatures = {} # key = path as in the caches, value = signature
+        self.dirs = set() # watched paths that are directories (listing cache)
+        self.abspaths = {} # key = absolute path, value = set of paths as in the caches
+        self.wds = {} # key = watch descriptor, value = absolute directory
+        self.watched_dirs = {} # key = absolute directory, value = watch descriptor
+        self.dir_paths = {} # key = absolute directory, value = set of absolute paths watched with it
+        self.polled = set() # paths checked by polling
+        self.changes = 0 # number of changes reported
+        self.inotify = None
+        if inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as err:
+                log.warning("W: inotify is not available (%s), polling every %s seconds" % (err, interval))
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def backend(self):
+        return 'polling' if self.inotify is None else 'inotify'
+
+    def get_caches(self):
+        pre = self.pre
+        return [(pre.mdx_include_content_cache_local, False), (pre.mdx_include_content_cache_local_heads, False),
+                (pre.mdx_include_listing_cache, True)]
+
+    def start(self):
+        """Watch the cached paths and the paths stored from now on in a background thread"""
+        for cache, is_dir in self.get_caches():
+            for path in list(cache):
+                self.added.append((path, cache.signatures.get(path), is_dir))
+            cache.on_store = self.add_dir if is_dir else self.add_file
+            cache.on_remove = self.remove
+            cache.watched = True
+        self.thread = threading.Thread(target=self.run, name='mdx_include-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching, cached content is validated on use again"""
+        for cache, is_dir in self.get_caches():
+            cache.on_store = None
+            cache.on_remove = None
+            cache.watched = False
+        self.stopping.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        if self.pre.watcher is self:
+            self.pre.watcher = None
+
+    def add_file(self, path, signature):
+        self.added.append((path, signature, False))
+
+    def add_dir(self, path, signature):
+        self.added.append((path, signature, True))
+
+    def remove(self, path):
+        self.added.append((path, None, None))
+
+    def register(self):
+        """Watch the paths added since the last call, return the paths changed since they were read"""
+        changed = []
+        while self.added:
+            path, signature, is_dir = self.added.popleft()
+            if is_dir is None:
+                self.forget(path)
+                continue
+            if is_dir:
+                self.dirs.add(path)
+            abspath = os.path.abspath(path)
+            self.abspaths.setdefault(abspath, set()).add(path)
+            if self.inotify is not None and path not in self.polled:
+                directory = abspath if is_dir else os.path.dirname(abspath)
+                if directory not in self.watched_dirs:
+                    try:
+                        wd = self.inotify.add(directory)
+                    except OSError as err:
+                        # e.g. too many watches (fs.inotify.max_user_watches)
+                        log.warning("W: Failed to watch %s (%s), polling it" % (directory, err))
+                        wd = None
+                    if wd is not None:
+                        self.watched_dirs[directory] = wd
+                        self.wds[wd] = directory
+                if directory not in self.watched_dirs:
+                    self.polled.add(path)
+                else:
+                    self.dir_paths.setdefault(directory, set()).add(abspath)
+            elif self.inotify is None:
+                self.polled.add(path)
+            current = get_file_signature(path)
+            if signature is None:
+                # nothing to compare with, e.g. content_cache_local_validate is False
+                signature = current
+            self.signatures[path] = current
+            if current != signature:
+                changed.append(path)
+        return changed
+
+    def forget(self, path):
+        """Stop watching a path removed from a cache, unless another cache still has it"""
+        for cache, is_dir in self.get_caches():
+            if path in cache:
+                return
+        self.signatures.pop(path, None)
+        self.polled.discard(path)
+        is_dir = path in self.dirs
+        self.dirs.discard(path)
+        abspath = os.path.abspath(path)
+        paths = self.abspaths.get(abspath)
+        if paths is None:
+            return
+        paths.discard(path)
+        if paths:
+            # watched under another spelling of the path
+            return
+        del self.abspaths[abspath]
+        directory = abspath if is_dir else os.path.dirname(abspath)
+        dir_paths = self.dir_paths.get(directory)
+        if dir_paths is None:
+            return
+        dir_paths.discard(abspath)
+        if not dir_paths:
+            del self.dir_paths[directory]
+            wd = self.watched_dirs.pop(directory, None)
+            if wd is not None:
+                del self.wds[wd]
+                self.inotify.remove(wd)
+
+    def poll(self):
+        """Return the polled paths whose signature has changed"""
+        changed = []
+        for path in self.polled:
+            current = get_file_signature(path)
+            if current != self.signatures.get(path):
+                self.signatures[path] = current
+                changed.append(path)
+        return changed
+
+    def get_event_paths(self, events):
+        """Return the paths changed according to inotify events"""
+        changed = set()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost
+                changed.update(self.signatures)
+                continue
+            directory = self.wds.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # the directory is gone, the paths under it are watched again when they are read again
+                for abspath, paths in self.abspaths.items():
+                    if abspath == directory or os.path.dirname(abspath) == directory:
+                        changed.update(paths)
+                if mask & IN_IGNORED:
+                    del self.wds[wd]
+                    self.watched_dirs.pop(directory, None)
+                    self.dir_paths.pop(directory, None)
+                continue
+            if name:
+                changed.update(self.abspaths.get(os.path.join(directory, name), ()))
+            if mask & IN_ENTRIES:
+                # the listing of the directory
+                changed.update(path for path in self.abspaths.get(directory, ()) if path in self.dirs)
+        return changed
+
+    def check(self):
+        """Wait for changes (at most interval seconds) and report them, return the changed paths"""
+        changed = set(self.register())
+        if self.inotify is not None:
+            events = self.inotify.read(self.interval)
+            while events:
+                changed.update(self.get_event_paths(events))
+                events = self.inotify.read(WATCH_SETTLE_TIME)
+        else:
+            self.stopping.wait(self.interval)
+        changed.update(self.poll())
+        changed = sorted(changed)
+        if changed and not self.stopping.is_set():
+            self.dispatch(changed)
+        return changed
+
+    def dispatch(self, paths):
+        """Evict the changed paths from the caches and call the callback with them
+        and the documents depending on them"""
+        pre = self.pre
+        with self.lock:
+            pre.mdx_include_content_cache_evict_local(paths)
+            documents = pre.dependency_graph.get_affected(paths)
+        self.changes += 1
+        if self.callback is not None:
+            try:
+                self.callback(paths, documents)
+            except Exception:
+                log.exception("E: The watch callback failed for: " + ', '.join(paths))
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.check()
+            except Exception:
+                if self.stopping.is_set():
+                    # the inotify file descriptor is closed
+                    break
+                log.exception("E: The watcher failed, retrying in %s seconds" % self.interval)
+                self.stopping.wait(self.interval)